@@ -0,0 +1,107 @@
+"""
+Logging overhead benchmark
+
+Times the logging done by one like request, --lines INFO lines written
+to a log file, as seen by the request thread:
+  before:  create_logger(app) looked up per line and the record formatted
+           and written synchronously, the way routes used to log
+  after:   the module logger handing records to the queue of
+           log_handlers.init_logging; a listener thread formats them as
+           JSON and writes them
+  sampled: the same with LOG_SAMPLE_RATES keeping 1% of like requests
+
+The file handler plays the part of gunicorn's error log. Importing the
+service connects to DATABASE_URI, which is otherwise left alone:
+  DATABASE_URI=sqlite:///bench.db python benchmarks/logging_overhead.py
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from flask import Flask
+from flask.logging import create_logger
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from service.utils.log_handlers import TEXT_FORMAT, init_logging  # noqa: E402 pylint: disable=wrong-import-position
+
+GUNICORN_LOGGER = "benchmark.gunicorn"
+
+
+def file_handler(folder, name):
+    """Returns a handler writing to a new log file, like gunicorn's error log"""
+    handler = logging.FileHandler(os.path.join(folder, name))
+    handler.setLevel(logging.INFO)
+    return handler
+
+
+def before_app(folder, lines):
+    """A Flask app whose logger writes synchronously to a file"""
+    app = Flask("before")
+    handler = file_handler(folder, "before.log")
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT, "%Y-%m-%d %H:%M:%S %z"))
+    app.logger.handlers = [handler]
+    app.logger.propagate = False
+    app.logger.setLevel(logging.INFO)
+
+    def log_request(rec_id):
+        for line in range(lines):
+            create_logger(app).info("Request to like Recommendation with id: %s (%d)", rec_id, line)
+    return app, log_request
+
+
+def after_app(folder, name, rates, lines):
+    """A Flask app logging through init_logging's queue"""
+    app = Flask(name)
+    app.config["LOG_SAMPLE_RATES"] = rates
+    gunicorn = logging.getLogger(GUNICORN_LOGGER)
+    gunicorn.handlers = [file_handler(folder, f"{name}.log")]
+    gunicorn.setLevel(logging.INFO)
+    listener = init_logging(app, GUNICORN_LOGGER)
+    logger = logging.getLogger("flask.app")
+
+    def log_request(rec_id):
+        for line in range(lines):
+            logger.info("Request to like Recommendation with id: %s (%d)", rec_id, line)
+    return app, log_request, listener
+
+
+def measure(label, app, log_request, requests, lines):
+    """Logs ``requests`` requests inside request contexts and prints the cost per request"""
+    timings = []
+    app.add_url_rule("/recommendations/<id>/like", "like_resource", lambda id: "")
+    for rec_id in range(requests):
+        with app.test_request_context(f"/recommendations/{rec_id}/like"):
+            app.preprocess_request()
+            start = time.perf_counter()
+            log_request(rec_id)
+            timings.append(time.perf_counter() - start)
+    elapsed = statistics.median(timings)
+    print(f"  {label:<8} {elapsed * 1e6:8.2f} us per request  ({elapsed * 1e6 / lines:6.2f} us per line)")
+    return elapsed
+
+
+def main():
+    """Prints the logging cost of a request before and after the queue"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--lines", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        print(f"{args.lines} INFO lines per request, {args.requests} requests:")
+        app, log_request = before_app(folder, args.lines)
+        before = measure("before", app, log_request, args.requests, args.lines)
+        for name, rates in (("after", {}), ("sampled", {"like_resource": 0.01})):
+            app, log_request, listener = after_app(folder, name, rates, args.lines)
+            elapsed = measure(name, app, log_request, args.requests, args.lines)
+            listener.stop()
+            print(f"  {'':<8} {before / elapsed:8.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
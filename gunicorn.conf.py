@@ -0,0 +1,29 @@
+"""
+Gunicorn configuration, read from the working directory at start up
+
+The workers share their Prometheus metrics through memory-mapped files in
+PROMETHEUS_MULTIPROC_DIR, which is emptied when gunicorn starts and
+defaults to a directory of its own in the temporary folder. The
+variable must be set before prometheus_client is first imported, which
+picks its value class then, so nothing here imports it at load time.
+"""
+import os
+import shutil
+import tempfile
+
+METRICS_DIR = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "recommendations-metrics")
+)
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Removes the metrics of a previous run before the workers start"""
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drops the live gauges of a worker that exited"""
+    from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+
+    multiprocess.mark_process_dead(worker.pid)
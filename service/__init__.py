@@ -11,8 +11,6 @@ from flask_restx import Api
 from service import config
 from .utils import log_handlers
 
-from flask.logging import create_logger
-
 # Create Flask application
 app = Flask(__name__)
 app.url_map.strict_slashes = False
@@ -35,6 +33,7 @@ api = Api(app,
 
 # Dependencies require we import the routes AFTER the Flask app is created
 from service import (  # noqa: F401, E402 # pylint: disable=wrong-import-position, wrong-import-order
+    commands,
     models,
     routes,
 )
@@ -46,15 +45,20 @@ from .utils import \
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
 
-create_logger(app).info(70 * "*")
-create_logger(app).info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
-create_logger(app).info(70 * "*")
+app.logger.info(70 * "*")
+app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
+app.logger.info(70 * "*")
 
 try:
     routes.init_db()  # make our SQLAlchemy tables
+    routes.init_like_buffer()
+    routes.init_adjacency()
+    routes.init_cache_listener()
+    routes.init_metrics()
+    routes.init_profiler()
 except Exception as error:
-    create_logger(app).critical("%s: Cannot continue", error)
+    app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
 
-create_logger(app).info("Service initialized!")
+app.logger.info("Service initialized!")
@@ -0,0 +1,266 @@
+"""
+Flask CLI Commands
+
+Maintenance commands for the recommendation table, run with the flask CLI:
+  flask create-columns
+  flask create-indexes
+  flask dedupe-recommendations
+  flask import-recommendations recommendations.csv
+  flask mine-buy-with order_lines.csv
+  flask purge-tombstones
+"""
+import csv
+import io
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+import click
+
+from service.models import (
+    DATA_COLUMNS,
+    LIKE_NUM,
+    PRODUCT_ID,
+    PRODUCT_NAME,
+    REC_ID,
+    REC_NAME,
+    REC_TYPE,
+    DataValidationError,
+    Recommendation,
+    Tombstone,
+    Type,
+    db,
+)
+
+# Import Flask application
+from . import app
+
+
+######################################################################
+# CREATE COLUMNS
+######################################################################
+@app.cli.command("create-columns")
+def create_columns():
+    """Adds the columns missing from an existing deployment's table"""
+    names = Recommendation.create_columns()
+    for name in names:
+        click.echo(f"Column {name} added")
+    if not names:
+        click.echo("All columns are in place")
+
+
+######################################################################
+# CREATE INDEXES
+######################################################################
+@app.cli.command("create-indexes")
+def create_indexes():
+    """Creates missing indexes on an existing deployment without downtime"""
+    for name in Recommendation.create_indexes():
+        click.echo(f"Index {name} is in place")
+
+
+######################################################################
+# DEDUPE RECOMMENDATIONS
+######################################################################
+@app.cli.command("dedupe-recommendations")
+def dedupe_recommendations():
+    """Merges duplicate edges, summing their likes, so the unique index can be built"""
+    merged, deleted = Recommendation.dedupe()
+    click.echo(f"Merged {merged} duplicated edges, deleted {deleted} rows")
+
+
+######################################################################
+# IMPORT RECOMMENDATIONS
+######################################################################
+@app.cli.command("import-recommendations")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format", "file_format", type=click.Choice(["csv", "ndjson"]),
+    help="The file format, guessed from the file extension by default",
+)
+def import_recommendations(path, file_format):
+    """Loads a CSV or NDJSON file into the table with PostgreSQL COPY
+
+    CSV files must start with a header naming the columns product_id,
+    product_name, rec_id, rec_name, rec_type and like_num in any order.
+    Rows that match an existing (product_id, rec_id, rec_type) update it.
+    """
+    if db.engine.dialect.name != "postgresql":
+        raise click.ClickException("import-recommendations needs a PostgreSQL DATABASE_URI")
+    file_format = file_format or ("ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv")
+    start = time.perf_counter()
+    with open(path, newline="", encoding="utf-8") as file:
+        try:
+            if file_format == "ndjson":
+                copied, inserted, updated = Recommendation.copy_import(NdjsonCsvStream(file))
+            else:
+                columns = read_csv_header(file)
+                copied, inserted, updated = Recommendation.copy_import(file, columns)
+        except (DataValidationError, ValueError) as error:
+            raise click.ClickException(str(error)) from error
+    elapsed = time.perf_counter() - start
+    click.echo(
+        f"Copied {copied} rows in {elapsed:.1f}s ({copied / max(elapsed, 1e-9):.0f} rows/sec): "
+        f"{inserted} inserted, {updated} updated"
+    )
+
+
+######################################################################
+# MINE BUY_WITH RECOMMENDATIONS
+######################################################################
+@app.cli.command("mine-buy-with")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--top-n", default=10, show_default=True, type=click.IntRange(min=1),
+              help="BUY_WITH recommendations kept per product")
+@click.option("--score", type=click.Choice(["lift", "jaccard"]), default="lift", show_default=True,
+              help="How co-purchased pairs are ranked")
+@click.option("--min-count", default=2, show_default=True, type=click.IntRange(min=1),
+              help="Orders a pair must appear in together")
+@click.option("--max-basket", default=100, show_default=True, type=click.IntRange(min=2),
+              help="Orders with more distinct products are ignored")
+@click.option("--workers", type=click.IntRange(min=1), help="Processes to use, all CPUs by default")
+@click.option("--chunk-size", default=1000000, show_default=True, type=click.IntRange(min=1),
+              help="Order lines converted to arrays at a time")
+@click.option("--dry-run", is_flag=True, help="Print the pairs as CSV instead of writing them")
+def mine_buy_with(path, top_n, score, min_count, max_basket, workers, chunk_size, dry_run):
+    """Generates BUY_WITH recommendations from an order-line CSV file
+
+    The file must start with a header naming the columns order_id and
+    product_id, and optionally product_name. Products without a name are
+    named after their other recommendations. Edges that already exist
+    are kept as they are, with their likes.
+    """
+    # NumPy and SciPy are only needed here, not by the web service
+    from service import mining  # pylint: disable=import-outside-toplevel
+
+    start = time.perf_counter()
+    names = {}
+    with open(path, newline="", encoding="utf-8") as file:
+        baskets = mining.read_baskets(read_order_lines(file, names), chunk_size, max_basket)
+    click.echo(
+        f"Read {baskets.lines} order lines ({baskets.orders} orders) "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    pairs = mining.mine_pairs(baskets, top_n, score, min_count, workers)
+    if dry_run:
+        click.echo("product_id,rec_id,score,count")
+        for product_id, rec_id, pair_score, count in pairs:
+            click.echo(f"{product_id},{rec_id},{pair_score:.6g},{count}")
+        return
+
+    missing = [product_id for product_id in baskets.product_ids.tolist() if product_id not in names]
+    names.update(Recommendation.find_product_names(missing))
+    mined, created = create_buy_with(pairs, names, app.config["BULK_CHUNK_SIZE"])
+    click.echo(
+        f"Mined {mined} BUY_WITH pairs in {time.perf_counter() - start:.1f}s: "
+        f"{created} created, {mined - created} already existed"
+    )
+
+
+######################################################################
+# PURGE TOMBSTONES
+######################################################################
+@app.cli.command("purge-tombstones")
+@click.option("--days", type=click.IntRange(min=0),
+              help="Tombstones kept, in days; TOMBSTONE_RETENTION_DAYS by default")
+def purge_tombstones(days):
+    """Deletes the tombstones older than the delta sync retention period
+
+    Clients whose watermark is older must export the table again
+    """
+    days = app.config["TOMBSTONE_RETENTION_DAYS"] if days is None else days
+    purged = Tombstone.purge(datetime.now(timezone.utc) - timedelta(days=days))
+    click.echo(f"Purged {purged} tombstones older than {days} days")
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def read_csv_header(file):
+    """Reads the header line of a CSV file and returns its column names"""
+    header = next(csv.reader([file.readline()]), [])
+    return tuple(name.strip() for name in header)
+
+
+def read_order_lines(file, names):
+    """Yields the (order_id, product_id) lines of an order-line CSV file
+
+    The product names found along the way are added to ``names``
+    """
+    columns = read_csv_header(file)
+    try:
+        order_column, product_column = columns.index("order_id"), columns.index("product_id")
+    except ValueError as error:
+        raise click.ClickException("The header must name the order_id and product_id columns") from error
+    name_column = columns.index(PRODUCT_NAME) if PRODUCT_NAME in columns else None
+    for line_number, line in enumerate(csv.reader(file), start=2):
+        try:
+            product_id = int(line[product_column])
+            if name_column is not None and line[name_column]:
+                names[product_id] = line[name_column]
+            yield line[order_column], product_id
+        except (IndexError, ValueError) as error:
+            raise click.ClickException(f"Invalid order line {line_number}: {error}") from error
+
+
+def create_buy_with(pairs, names, chunk_size):
+    """Bulk creates mined pairs as BUY_WITH recommendations and returns how many were mined and created"""
+    rows, mined, created = [], 0, 0
+    for product_id, rec_id, _, _ in pairs:
+        rows.append({
+            PRODUCT_ID: product_id,
+            PRODUCT_NAME: names.get(product_id, f"Product {product_id}"),
+            REC_ID: rec_id,
+            REC_NAME: names.get(rec_id, f"Product {rec_id}"),
+            REC_TYPE: Type.BUY_WITH,
+            LIKE_NUM: 0,
+        })
+        if len(rows) >= chunk_size:
+            mined, created = mined + len(rows), created + count_created(rows, chunk_size)
+            rows = []
+    return mined + len(rows), created + count_created(rows, chunk_size)
+
+
+def count_created(rows, chunk_size):
+    """Bulk creates rows, skipping existing edges, and returns how many were created"""
+    return sum(1 for rec_id in Recommendation.bulk_create(rows, chunk_size) if rec_id is not None)
+
+
+class NdjsonCsvStream:
+    """
+    A read-only file-like object that turns NDJSON into CSV for COPY
+
+    Lines are converted lazily as COPY reads, so the file is never
+    held in memory
+    """
+
+    def __init__(self, lines, columns=DATA_COLUMNS):
+        self._lines = iter(lines)
+        self._columns = columns
+        self._buffer = ""
+        self.line_number = 0
+
+    def read(self, size=-1):
+        """Returns up to ``size`` characters of CSV, or all of it if size < 0"""
+        chunk = io.StringIO()
+        writer = csv.writer(chunk, lineterminator="\n")
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self.line_number += 1
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                writer.writerow([data[column] for column in self._columns])
+            except (ValueError, KeyError, TypeError) as error:
+                raise DataValidationError(f"Invalid NDJSON on line {self.line_number}: {error}") from error
+            length = len(self._buffer) + chunk.tell()
+        data = self._buffer + chunk.getvalue()
+        if size < 0:
+            self._buffer = ""
+            return data
+        self._buffer = data[size:]
+        return data[:size]
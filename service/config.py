@@ -4,6 +4,7 @@ Global Configuration for Application
 import os
 import json
 import logging
+import tempfile
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -20,6 +21,116 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool of each worker: DB_POOL_SIZE connections plus up to
+# DB_MAX_OVERFLOW in bursts; a request waits DB_POOL_TIMEOUT seconds for one
+# before answering 503. Connections are checked before use, so a failover
+# costs a reconnect instead of failed requests, and replaced after
+# DB_POOL_RECYCLE seconds. On PostgreSQL, statements are cancelled with a 504
+# after DB_STATEMENT_TIMEOUT_MS (0 for never) and sessions show as
+# DB_APPLICATION_NAME
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+DB_APPLICATION_NAME = os.getenv("DB_APPLICATION_NAME", "recommendations")
+
+# Write-behind buffering of likes/unlikes: when enabled, like counters are
+# accumulated per recommendation and flushed in one batched UPDATE every
+# LIKE_BUFFER_FLUSH_MS milliseconds or LIKE_BUFFER_MAX_EVENTS events
+LIKE_BUFFER_ENABLED = os.getenv("LIKE_BUFFER_ENABLED", "false").lower() == "true"
+LIKE_BUFFER_FLUSH_MS = int(os.getenv("LIKE_BUFFER_FLUSH_MS", "500"))
+LIKE_BUFFER_MAX_EVENTS = int(os.getenv("LIKE_BUFFER_MAX_EVENTS", "1000"))
+
+# Keyset pagination of list responses
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Rows fetched per round-trip by the streaming export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# Delta syncs: changes younger than CHANGES_SETTLE_SECONDS are held back so
+# slower transactions can commit; it must be longer than the longest write
+# transaction (a COPY import included), whose rows are stamped before it
+# commits and would otherwise be skipped. Tombstones of deleted
+# recommendations are kept for TOMBSTONE_RETENTION_DAYS, the oldest watermark
+# accepted
+CHANGES_SETTLE_SECONDS = float(os.getenv("CHANGES_SETTLE_SECONDS", "5"))
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+
+# Bulk create: rows per INSERT statement and items accepted per request
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "50000"))
+
+# Products accepted per batch lookup
+BATCH_MAX_PRODUCTS = int(os.getenv("BATCH_MAX_PRODUCTS", "100"))
+
+# Read-through cache of the per-product recommendation lists; entries are
+# invalidated by writes and expire after CACHE_TTL_SECONDS
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+
+# Cross-worker invalidation: on PostgreSQL writers NOTIFY the changed product
+# ids on CACHE_NOTIFY_CHANNEL and every worker LISTENs to drop its entries
+CACHE_LISTEN_ENABLED = os.getenv("CACHE_LISTEN_ENABLED", "true").lower() == "true"
+CACHE_NOTIFY_CHANNEL = os.getenv("CACHE_NOTIFY_CHANNEL", "recommendation_changes")
+
+# Precomputed top-K rankings: TOP_K_DEPTH rows are held per product (the
+# largest k served), for up to TOP_K_MAX_PRODUCTS product/rec_type pairs
+TOP_K_DEFAULT = int(os.getenv("TOP_K_DEFAULT", "10"))
+TOP_K_DEPTH = int(os.getenv("TOP_K_DEPTH", "100"))
+TOP_K_MAX_PRODUCTS = int(os.getenv("TOP_K_MAX_PRODUCTS", "10000"))
+TOP_K_TTL_SECONDS = float(os.getenv("TOP_K_TTL_SECONDS", "300"))
+
+# Multi-hop traversals: the adjacency index is loaded at startup unless
+# ADJACENCY_PRELOAD is false, in which case the first traversal loads it
+ADJACENCY_PRELOAD = os.getenv("ADJACENCY_PRELOAD", "true").lower() == "true"
+TRAVERSE_MAX_DEPTH = int(os.getenv("TRAVERSE_MAX_DEPTH", "3"))
+
+# Response compression: gzip, and brotli when the brotli package is installed,
+# of compressible responses of at least COMPRESSION_MIN_SIZE bytes
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+# Cache-Control of successful API reads, overridden per route with a JSON
+# object such as {"/api/recommendations/top": "public, max-age=30"}; static
+# files requested with their ?v= fingerprint are immutable for STATIC_MAX_AGE
+API_CACHE_CONTROL = os.getenv("API_CACHE_CONTROL", "no-cache")
+API_CACHE_CONTROL_ROUTES = json.loads(os.getenv("API_CACHE_CONTROL_ROUTES", "{}"))
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "31536000"))
+
+# Query log: statements taking SLOW_QUERY_MS or more are logged with their
+# parameters and route, and requests issuing more than MAX_QUERIES_PER_REQUEST
+# statements are flagged as a likely N+1 pattern; 0 turns either off
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+MAX_QUERIES_PER_REQUEST = int(os.getenv("MAX_QUERIES_PER_REQUEST", "10"))
+
+# Prometheus metrics on /metrics; under gunicorn, gunicorn.conf.py points
+# PROMETHEUS_MULTIPROC_DIR at a directory shared by the workers
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# On-demand profiling, off by default: requests whose X-Profile header is
+# PROFILING_TOKEN, and a PROFILING_SAMPLE_RATE share of all requests, are
+# profiled by a stack sampler ("sample", folded stacks for flame graphs) or
+# cProfile ("cprofile", pstats files) into PROFILING_DIR, which keeps the
+# newest PROFILING_KEEP profiles, listed on /profiles to holders of the token
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_MODE = os.getenv("PROFILING_MODE", "sample")
+PROFILING_DIR = os.getenv("PROFILING_DIR", os.path.join(tempfile.gettempdir(), "recommendation-profiles"))
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", "5"))
+PROFILING_KEEP = int(os.getenv("PROFILING_KEEP", "100"))
+
+# Logging under gunicorn: "json" lines or "text", written by a background
+# thread; INFO lines of the endpoints in LOG_SAMPLE_RATES are only kept for
+# that share of their requests, e.g. {"like_resource": 0.01}
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_SAMPLE_RATES = json.loads(os.getenv("LOG_SAMPLE_RATES", "{}"))
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
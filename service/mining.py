@@ -0,0 +1,176 @@
+"""
+Co-purchase Mining
+
+Generates BUY_WITH recommendations from order logs. Order lines are read
+in chunks into a sparse orders x products basket matrix B; the product
+co-occurrence counts are B.T @ B, computed one block of products at a
+time across a process pool. Each pair is scored by lift or Jaccard and
+only the best ``top_n`` pairs of every product are kept.
+
+This module needs NumPy and SciPy and is only imported by the
+mine-buy-with CLI command, never by the web service.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger("flask.app")
+
+SCORES = ("lift", "jaccard")
+
+# set in every worker process by _init_worker
+_worker = {}
+
+
+class Baskets:  # pylint: disable=too-few-public-methods
+    """The orders x products 0/1 matrix read from the order lines"""
+
+    def __init__(self, matrix, product_ids, lines):
+        """
+        Args:
+            matrix (csr_matrix): 1 where an order contains a product
+            product_ids (ndarray): the product id of every matrix column
+            lines (int): the number of order lines read
+        """
+        self.matrix = matrix
+        self.product_ids = product_ids
+        self.lines = lines
+
+    @property
+    def orders(self):
+        """The number of orders"""
+        return self.matrix.shape[0]
+
+
+def read_baskets(order_lines, chunk_size=1000000, max_basket=None):
+    """
+    Builds the basket matrix from (order_id, product_id) pairs
+
+    The pairs are converted to arrays ``chunk_size`` lines at a time, so
+    Python objects are only held for one chunk. Orders with more than
+    ``max_basket`` distinct products (bulk or test orders) are dropped,
+    as their pairs grow quadratically and say little about affinity.
+
+    Raises:
+        ValueError: if a product_id is not an integer
+    """
+    order_index = {}
+    orders, products = [], []
+    chunk_orders, chunk_products = [], []
+    lines = 0
+    for order_id, product_id in order_lines:
+        chunk_orders.append(order_index.setdefault(order_id, len(order_index)))
+        chunk_products.append(int(product_id))
+        if len(chunk_orders) >= chunk_size:
+            orders.append(np.array(chunk_orders, dtype=np.int32))
+            products.append(np.array(chunk_products, dtype=np.int64))
+            lines += len(chunk_orders)
+            chunk_orders, chunk_products = [], []
+    orders.append(np.array(chunk_orders, dtype=np.int32))
+    products.append(np.array(chunk_products, dtype=np.int64))
+    lines += len(chunk_orders)
+    del order_index
+
+    product_ids, columns = np.unique(np.concatenate(products), return_inverse=True)
+    del products
+    rows = np.concatenate(orders)
+    del orders
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, columns.astype(np.int32))),
+        shape=(int(rows.max()) + 1 if len(rows) else 0, len(product_ids)),
+    )
+    matrix.sum_duplicates()
+    matrix.data[:] = 1  # a product bought twice in one order counts once
+    if max_basket:
+        matrix = matrix[np.diff(matrix.indptr) <= max_basket]
+    logger.info(
+        "Read %d order lines: %d orders, %d products", lines, matrix.shape[0], len(product_ids)
+    )
+    return Baskets(matrix, product_ids, lines)
+
+
+def mine_pairs(baskets, top_n=10, score="lift", min_count=2, workers=None, block_size=1024):
+    """
+    Yields the best co-purchased products of every product
+
+    Args:
+        baskets (Baskets): the basket matrix from read_baskets
+        top_n (int): pairs kept per product
+        score (str): "lift" (count * orders / (count_a * count_b)) or
+            "jaccard" (count / (count_a + count_b - count))
+        min_count (int): orders a pair needs to appear in to be scored
+        workers (int): processes to use, all CPUs by default; 1 runs in
+            this process
+        block_size (int): products whose pairs are computed per task
+
+    Yields:
+        tuple: (product_id, rec_id, score, count) with the pairs of each
+        product in descending score order
+    """
+    if score not in SCORES:
+        raise ValueError(f"Unknown score '{score}', expected one of {', '.join(SCORES)}")
+    matrix = baskets.matrix
+    settings = {
+        "matrix": matrix,
+        "transposed": matrix.T.tocsr(),
+        "counts": np.asarray(matrix.sum(axis=0)).ravel(),
+        "orders": matrix.shape[0],
+        "top_n": top_n,
+        "score": score,
+        "min_count": min_count,
+    }
+    blocks = [
+        (start, min(start + block_size, matrix.shape[1]))
+        for start in range(0, matrix.shape[1], block_size)
+    ]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _init_worker(settings)
+        results = map(_score_block, blocks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(settings,))
+        results = pool.map(_score_block, blocks)
+    try:
+        for products, recs, scores, counts in results:
+            ids = baskets.product_ids
+            yield from zip(
+                ids[products].tolist(), ids[recs].tolist(), scores.tolist(), counts.tolist()
+            )
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        _worker.clear()
+
+
+def _init_worker(settings):
+    """Keeps the matrices in the worker so each task only sends a block range"""
+    _worker.update(settings)
+
+
+def _score_block(block):
+    """Scores the pairs of the products in [start, stop) and keeps the best"""
+    start, stop = block
+    counts = _worker["counts"]
+    co_counts = (_worker["transposed"][start:stop] @ _worker["matrix"]).tocoo()
+    products = co_counts.row + start
+    keep = (co_counts.col != products) & (co_counts.data >= _worker["min_count"])
+    products, recs, pair_counts = products[keep], co_counts.col[keep], co_counts.data[keep]
+
+    count_a = counts[products].astype(np.float64)
+    count_b = counts[recs].astype(np.float64)
+    if _worker["score"] == "lift":
+        scores = pair_counts * float(_worker["orders"]) / (count_a * count_b)
+    else:
+        scores = pair_counts / (count_a + count_b - pair_counts)
+
+    # best first within each product: sort by product, then descending score
+    order = np.lexsort((recs, -scores, products))
+    products, recs, scores, pair_counts = products[order], recs[order], scores[order], pair_counts[order]
+    # rank of every pair within its product, keeping the first top_n
+    first = np.searchsorted(products, products, side="left")
+    keep = np.arange(len(products)) - first < _worker["top_n"]
+    return products[keep], recs[keep], scores[keep], pair_counts[keep]
@@ -4,11 +4,34 @@ Models for YourResourceModel
 All of the models are stored in this module
 """
 import enum
+import hashlib
+import heapq
 import logging
+import uuid
+from datetime import datetime, timedelta, timezone
 
 
+import orjson
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Enum
+from sqlalchemy import (
+    Enum, Integer, any_, bindparam, case, column, func, literal, literal_column, select, text, tuple_, values,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.orm import column_property
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.pool import QueuePool
+
+from service.utils.adjacency import AdjacencyIndex
+from service.utils.cache import LRUCache
+from service.utils.query_log import query_log
+from service.utils.ranking import Ranking
 
 ID = "id"
 PRODUCT_ID = "product_id"
@@ -17,6 +40,28 @@ REC_ID = "rec_id"
 REC_NAME = "rec_name"
 REC_TYPE = "rec_type"
 LIKE_NUM = "like_num"
+VERSION = "version"
+UPDATED_AT = "updated_at"
+DELETED = "deleted"
+
+# every column a client supplies, i.e. all but the generated id
+DATA_COLUMNS = (PRODUCT_ID, PRODUCT_NAME, REC_ID, REC_NAME, REC_TYPE, LIKE_NUM)
+
+# the logical edge: at most one recommendation of a type between two products
+EDGE_COLUMNS = (PRODUCT_ID, REC_ID, REC_TYPE)
+
+# the columns of a serialized recommendation, as selected by the fast read paths
+SERIALIZED_COLUMNS = (ID,) + DATA_COLUMNS + (VERSION,)
+
+# session.info keys collecting the products changed by the current transaction
+# and the rows whose new like counts are applied to the rankings in place,
+# and the product id that stands for every product
+CHANGED_PRODUCTS = "changed_products"
+RANKED_ROWS = "ranked_rows"
+ALL_PRODUCTS = "*"
+
+# identifies this worker in NOTIFY payloads so it skips its own notifications
+WORKER_ID = uuid.uuid4().hex[:12]
 
 logger = logging.getLogger("flask.app")
 
@@ -24,6 +69,30 @@ logger = logging.getLogger("flask.app")
 db = SQLAlchemy()
 
 
+class ProductRows(list):
+    """The serialized recommendations of a product as cached, with a content digest"""
+
+    _digest = None
+
+    @property
+    def digest(self):
+        """A hash of the rows, computed once per cached list"""
+        if self._digest is None:
+            self._digest = hashlib.blake2b(orjson.dumps(self), digest_size=16).hexdigest()
+        return self._digest
+
+
+# Serialized recommendation lists keyed on (product_id, rec_type) and tagged
+# with the product_id, configured in init_db()
+list_cache = LRUCache()
+
+# Precomputed top-K rankings per (product_id, rec_type), tagged by product_id
+top_cache = LRUCache()
+
+# In-memory recommendation graph for multi-hop traversals
+adjacency = AdjacencyIndex()
+
+
 class Type(str, enum.Enum):
     CROSS_SELL = "CROSS_SELL"
     UP_SELL = "UP_SELL"
@@ -41,21 +110,99 @@ class DataValidationError(Exception):
     pass
 
 
+class DataConflictError(Exception):
+    """Used when a write would duplicate an existing recommendation"""
+
+
+class StaleVersionError(DataConflictError):
+    """Used when a write was based on a version of a recommendation that has changed since"""
+
+
+def _utcnow():
+    """Returns the current time in UTC, the time of every change"""
+    return datetime.now(timezone.utc)
+
+
+def _created_at(context):
+    """Returns the created_at of a row being inserted, its first updated_at
+
+    A multi-row INSERT names the parameters of its later rows apart, so
+    a row without a created_at of its own is stamped with the current time.
+    """
+    return context.get_current_parameters().get("created_at") or _utcnow()
+
+
+class clock_timestamp(FunctionElement):  # pylint: disable=invalid-name,too-many-ancestors
+    """
+    The time when a statement writes a row
+
+    PostgreSQL's now() is the start of the transaction, which a long
+    import would stamp on rows committed much later
+    """
+
+    type = db.DateTime(timezone=True)
+    inherit_cache = True
+
+
+@compiles(clock_timestamp)
+def _compile_clock_timestamp(element, compiler, **kwargs):
+    """Renders clock_timestamp() as the current time of other databases"""
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(clock_timestamp, "postgresql")
+def _compile_clock_timestamp_postgresql(element, compiler, **kwargs):
+    """Renders clock_timestamp() on PostgreSQL"""
+    return "clock_timestamp()"
+
+
 class Recommendation(db.Model):
     """
     Class that represents a YourResourceModel
     """
 
     app = None
+    # channel announcing changed product ids to every worker's cache
+    notify_channel = "recommendation_changes"
+    # rows held per precomputed ranking, the largest K that can be served
+    top_depth = 100
+
+    # Indexes for the find_by_* access paths; product_id leads the composite
+    # index so it also serves product_id-only lookups
+    __table_args__ = (
+        db.Index("ix_recommendation_product_id_rec_type", "product_id", "rec_type"),
+        db.Index("ix_recommendation_rec_id", "rec_id"),
+        db.Index("ix_recommendation_product_name", "product_name"),
+        db.Index("ix_recommendation_rec_name", "rec_name"),
+        db.Index("uq_recommendation_edge", *EDGE_COLUMNS, unique=True),
+        # the keyset order of find_changes
+        db.Index("ix_recommendation_updated_at_id", "updated_at", "id"),
+    )
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, nullable=False)
+    # active_history loads the old value when a product_id is reassigned on an
+    # expired instance, so the product it moves away from is invalidated too
+    product_id = column_property(db.Column(db.Integer, nullable=False), active_history=True)
     product_name = db.Column(db.String(256), nullable=False)
     rec_id = db.Column(db.Integer, nullable=False)
     rec_name = db.Column(db.String(256), nullable=False)
     rec_type = db.Column(Enum(Type), nullable=False)
     like_num = db.Column(db.Integer, nullable=False)
+    # increased by every write; ORM updates only apply to the version they
+    # read, and raise StaleVersionError when another write came first
+    version = db.Column(db.Integer, nullable=False, server_default=text("1"))
+    # set by every write, Core statements included, for delta syncs; the
+    # server defaults only fill the rows existing when the columns are added
+    created_at = db.Column(
+        db.DateTime(timezone=True), nullable=False, default=_utcnow, server_default=clock_timestamp()
+    )
+    updated_at = db.Column(
+        db.DateTime(timezone=True), nullable=False, default=_created_at, onupdate=_utcnow,
+        server_default=clock_timestamp(),
+    )
+
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return "<id=[%s] Recommendation object for %r>" % (
@@ -70,7 +217,72 @@ class Recommendation(db.Model):
         logger.info("Creating %s", self.product_name)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
-        db.session.commit()
+        self._commit_edge()
+
+    def _commit_edge(self):
+        """Commits the session, reporting a duplicated edge as a conflict"""
+        # the product this row belongs to, and belonged to before an update
+        _changed(self.product_id, *inspect(self).attrs.product_id.history.deleted)
+        try:
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            raise self._integrity_error(error) from error
+        except StaleDataError as error:
+            db.session.rollback()
+            raise StaleVersionError(
+                f"Recommendation {self.id} was changed by another request, read it again"
+            ) from error
+
+    def upsert(self):
+        """
+        Creates the recommendation or updates the one with the same edge
+
+        The edge is (product_id, rec_id, rec_type); the write is a single
+        INSERT ... ON CONFLICT DO UPDATE so it is safe to retry.
+
+        Returns:
+            bool: True if a new row was created
+        """
+        logger.info("Upserting %s", self.product_name)
+        table = self.__table__
+        row = {name: getattr(self, name) for name in DATA_COLUMNS}
+        statement = _dialect_insert(table).values(row)
+        updates = {name: statement.excluded[name] for name in DATA_COLUMNS if name not in EDGE_COLUMNS}
+        statement = statement.on_conflict_do_update(
+            index_elements=EDGE_COLUMNS,
+            # ON CONFLICT DO UPDATE does not apply onupdate
+            set_=dict(updates, version=table.c.version + 1, updated_at=statement.excluded.updated_at),
+        )
+        # a NOT NULL column left empty is rejected by the database
+        try:
+            if db.engine.dialect.full_returning:
+                result = db.session.execute(
+                    statement.returning(table.c.id, literal_column("xmax = 0").label("created"))
+                ).first()
+                self.id, created = result.id, result.created
+            else:
+                edge = [table.c[name] == row[name] for name in EDGE_COLUMNS]
+                existing = db.session.execute(table.select().where(*edge)).first()
+                db.session.execute(statement)
+                self.id = db.session.execute(table.select().where(*edge)).first().id
+                created = existing is None
+            _changed(row[PRODUCT_ID])
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            raise self._integrity_error(error) from error
+        return created
+
+    def _integrity_error(self, error):
+        """Returns the error for a rejected write: a conflict if the edge exists, else invalid data"""
+        if _is_duplicate_edge(error):
+            return DataConflictError(
+                f"A {self.rec_type} recommendation from product {self.product_id} "
+                f"to product {self.rec_id} already exists"
+            )
+        reason = str(error.orig).splitlines()[0] if str(error.orig) else type(error.orig).__name__
+        return DataValidationError(f"Invalid recommendation: {reason}")
 
     def update(self):
         """
@@ -79,27 +291,61 @@ class Recommendation(db.Model):
         logger.info("Saving %s", self.product_name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
+        self._commit_edge()
 
     def delete(self):
-        """Removes a recommendation from the data store"""
+        """Removes a recommendation from the data store, whatever its version
+
+        A tombstone is left in the same transaction so delta syncs see it go
+        """
         logger.info("Deleting %s", self.product_name)
-        db.session.delete(self)
+        _ranked(self.serialize(), removed=True)
+        # a plain DELETE: the ORM's would also match the version and fail
+        # when a like landed since the row was read
+        table = self.__table__
+        _bury(select(table.c.id, table.c.product_id).where(table.c.id == self.id))
+        db.session.execute(table.delete().where(table.c.id == self.id))
+        if self in db.session:
+            db.session.expunge(self)
         db.session.commit()
 
     def like(self):
         """Like a recommendation from the data store"""
-        logger.info("Saving %s", self.product_name)
+        logger.info("Liking %s", self.product_name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
+        # pending changes are written at the version they were made to
+        db.session.flush()
+        self._refresh_likes(self.like_by_id(self.id))
 
     def unlike(self):
         """Unlike a recommendation from the data store"""
-        logger.info("Saving %s", self.product_name)
+        logger.info("Unliking %s", self.product_name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
-        db.session.commit()
+        # pending changes are written at the version they were made to
+        db.session.flush()
+        self._refresh_likes(self.unlike_by_id(self.id))
+
+    def _refresh_likes(self, updated):
+        """Copies the like count and version written by the database onto this instance"""
+        if updated is not None:
+            set_committed_value(self, LIKE_NUM, updated.like_num)
+            set_committed_value(self, VERSION, updated.version)
+
+    def expect_version(self, version):
+        """
+        Checks that the recommendation is still at the version a client read
+
+        The update re-checks it, so a write landing in between fails too
+
+        Raises:
+            StaleVersionError: if the recommendation is at another version
+        """
+        if self.version != version:
+            raise StaleVersionError(
+                f"Recommendation {self.id} is at version {self.version}, not {version}, read it again"
+            )
 
     def serialize(self):
         """Serializes a recommendation into a dictionary"""
@@ -111,16 +357,22 @@ class Recommendation(db.Model):
             REC_NAME: self.rec_name,
             REC_TYPE: self.rec_type.name,
             LIKE_NUM: self.like_num,
+            VERSION: self.version,
         }
 
     def deserialize(self, data):
         """
         Deserializes a recommendation from a dictionary
 
+        The version is optional; when it is sent for a stored recommendation
+        it must be the current one (see expect_version)
+
         Args:
             data (dict): A dictionary containing the recommendation
         """
         try:
+            if data.get(VERSION) is not None and self.version is not None:
+                self.expect_version(data[VERSION])
             self.id = data[ID]
             self.product_id = data[PRODUCT_ID]
             self.product_name = data[PRODUCT_NAME]
@@ -132,7 +384,7 @@ class Recommendation(db.Model):
             raise DataValidationError(
                 "Invalid Recommendation: missing " + error.args[0]
             )
-        except TypeError as error:
+        except (TypeError, AttributeError) as error:
             raise DataValidationError(
                 """Invalid Recommendation: body of request contained bad or no data""" + error.args[0]
             )
@@ -143,10 +395,84 @@ class Recommendation(db.Model):
         """Initializes the database session"""
         logger.info("Initializing database")
         cls.app = app
+        # the pool settings of this database, under any DB_ENGINE_OPTIONS given
+        # outright; worked out anew so initializing with another database drops them
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            **engine_options(app.config),
+            **app.config.get("DB_ENGINE_OPTIONS", {}),
+        }
         # This is where we initialize SQLAlchemy from the Flask app
+        db.session.remove()  # a session still bound to the database of another app
         db.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
+        query_log.configure(
+            slow_ms=app.config.get("SLOW_QUERY_MS", 200),
+            max_queries=app.config.get("MAX_QUERIES_PER_REQUEST", 10),
+        )
+        query_log.init_app(app, db.engine)
+        cls.notify_channel = app.config.get("CACHE_NOTIFY_CHANNEL", cls.notify_channel)
+        list_cache.configure(
+            max_size=app.config.get("CACHE_MAX_SIZE", 10000),
+            ttl=app.config.get("CACHE_TTL_SECONDS", 30),
+            enabled=app.config.get("CACHE_ENABLED", True),
+        )
+        cls.top_depth = app.config.get("TOP_K_DEPTH", cls.top_depth)
+        top_cache.configure(
+            max_size=app.config.get("TOP_K_MAX_PRODUCTS", 10000),
+            ttl=app.config.get("TOP_K_TTL_SECONDS", 300),
+            enabled=app.config.get("CACHE_ENABLED", True),
+        )
+
+    @classmethod
+    def create_indexes(cls):
+        """Creates any missing indexes on an existing table
+
+        On PostgreSQL the indexes are built with CREATE INDEX CONCURRENTLY
+        so reads and writes are not blocked while they build. A concurrent
+        build that fails leaves an INVALID index behind which must be
+        dropped before running this again.
+
+        Returns:
+            list: the names of the indexes that were processed
+        """
+        engine = db.engine
+        concurrently = engine.dialect.name == "postgresql"
+        names = []
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for index in sorted(cls.__table__.indexes, key=lambda idx: idx.name):
+                ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+                if concurrently:
+                    ddl = ddl.replace("INDEX ", "INDEX CONCURRENTLY ", 1)
+                logger.info("Creating index %s", index.name)
+                conn.execute(text(ddl))
+                names.append(index.name)
+        return names
+
+    @classmethod
+    def create_columns(cls):
+        """Adds the columns missing from an existing table
+
+        Every column added since the table was first created has a server
+        default, which fills the existing rows; on PostgreSQL 11+ adding a
+        column with a constant default does not rewrite the table.
+
+        Returns:
+            list: the names of the columns that were added
+        """
+        engine = db.engine
+        existing = {info["name"] for info in inspect(engine).get_columns(cls.__tablename__)}
+        names = []
+        with engine.begin() as conn:
+            for model_column in cls.__table__.columns:
+                if model_column.name in existing:
+                    continue
+                ddl = str(CreateColumn(model_column).compile(dialect=engine.dialect))
+                logger.info("Adding column %s", model_column.name)
+                conn.execute(text(f"ALTER TABLE {cls.__tablename__} ADD COLUMN {ddl}"))
+                names.append(model_column.name)
+        return names
 
     @classmethod
     def drop_db(cls, app):
@@ -177,6 +503,257 @@ class Recommendation(db.Model):
         logger.info("Processing lookup or 404 for id %s ...", id)
         return cls.query.get_or_404(id)
 
+    @classmethod
+    def bulk_create(cls, rows, chunk_size=1000):
+        """
+        Inserts many recommendations with one INSERT per chunk of rows
+
+        Rows whose edge already exists, in the table or earlier in
+        ``rows``, are skipped rather than failing the chunk. The rows of
+        a chunk share one created_at, which is also their updated_at.
+
+        Args:
+            rows (list): dictionaries of column values, without an id
+            chunk_size (int): the number of rows written per statement and commit
+
+        Returns:
+            list: the generated ids in the same order as ``rows``, with
+            None for each skipped duplicate
+        """
+        logger.info("Bulk creating %d recommendations", len(rows))
+        table = cls.__table__
+        ids = []
+        for start in range(0, len(rows), chunk_size):
+            now = _utcnow()
+            chunk = [dict(row, created_at=now, updated_at=now) for row in rows[start:start + chunk_size]]
+            if db.engine.dialect.full_returning:
+                # a single multi-row INSERT ... VALUES ... RETURNING
+                statement = (
+                    _dialect_insert(table).values(chunk)
+                    .on_conflict_do_nothing(index_elements=EDGE_COLUMNS)
+                    .returning(table.c.id, *(table.c[name] for name in EDGE_COLUMNS))
+                )
+                created = {
+                    tuple(row[name] for name in EDGE_COLUMNS): row.id
+                    for row in db.session.execute(statement)
+                }
+                ids.extend(created.pop(_edge(row), None) for row in chunk)
+            else:
+                statement = _dialect_insert(table).on_conflict_do_nothing(index_elements=EDGE_COLUMNS)
+                for row in chunk:
+                    result = db.session.execute(statement, row)
+                    ids.append(result.inserted_primary_key[0] if result.rowcount else None)
+            _changed(*(row[PRODUCT_ID] for row in chunk))
+            db.session.commit()
+        return ids
+
+    @classmethod
+    def copy_import(cls, stream, columns=DATA_COLUMNS):
+        """
+        Loads CSV rows with PostgreSQL COPY and merges them into the table
+
+        The rows are streamed from ``stream`` into a temporary staging table
+        with COPY FROM STDIN and then merged with INSERT ... ON CONFLICT on
+        (product_id, rec_id, rec_type), so loading the same file twice
+        updates rows instead of duplicating them. An edge repeated in the
+        file keeps its last row, and one timestamp is the updated_at of
+        every row merged and the created_at of those inserted.
+
+        Args:
+            stream: a file-like object with CSV rows and no header line
+            columns (tuple): the order of the columns in each row
+
+        Returns:
+            tuple: the number of rows copied, inserted and updated
+        """
+        unknown = set(columns) ^ set(DATA_COLUMNS)
+        if unknown:
+            raise DataValidationError(f"Invalid import columns: {', '.join(sorted(unknown))}")
+        logger.info("Importing recommendations with COPY")
+        enum_name = cls.__table__.c.rec_type.type.name
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                "CREATE TEMP TABLE recommendation_staging ("
+                "product_id integer, product_name varchar(256), rec_id integer, "
+                "rec_name varchar(256), rec_type text, like_num integer, seq bigserial"
+                ") ON COMMIT DROP"
+            )
+            cursor.copy_expert(
+                f"COPY recommendation_staging ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                stream,
+            )
+            copied = cursor.rowcount
+            cursor.execute(
+                "WITH stamp AS (SELECT clock_timestamp() AS now), merged AS ("
+                "INSERT INTO recommendation "
+                "(product_id, product_name, rec_id, rec_name, rec_type, like_num, created_at, updated_at) "
+                f"SELECT product_id, product_name, rec_id, rec_name, rec_type::{enum_name}, like_num, "
+                "stamp.now, stamp.now FROM stamp, ("
+                "SELECT DISTINCT ON (product_id, rec_id, rec_type) * FROM recommendation_staging "
+                "ORDER BY product_id, rec_id, rec_type, seq DESC"
+                ") AS latest "
+                "ON CONFLICT (product_id, rec_id, rec_type) DO UPDATE SET "
+                "product_name = EXCLUDED.product_name, rec_name = EXCLUDED.rec_name, "
+                "like_num = EXCLUDED.like_num, version = recommendation.version + 1, "
+                "updated_at = EXCLUDED.updated_at "
+                "RETURNING (xmax = 0) AS inserted"
+                ") SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) "
+                "FROM merged"
+            )
+            inserted, updated = cursor.fetchone()
+            cursor.execute("SELECT pg_notify(%s, %s)", (cls.notify_channel, _payload(ALL_PRODUCTS)))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        invalidate_product(ALL_PRODUCTS)
+        return copied, inserted, updated
+
+    @classmethod
+    def dedupe(cls):
+        """
+        Merges recommendations that share an edge into the oldest one
+
+        The surviving row (lowest id) gets the sum of the like counts of
+        its duplicates, which are then deleted and leave tombstones for
+        delta syncs like any other delete. Run this before creating
+        the unique edge index on a table that may contain duplicates.
+
+        Returns:
+            tuple: the number of edges merged and of rows deleted
+        """
+        logger.info("Merging duplicate recommendations")
+        table = cls.__table__
+        edge = [table.c[name] for name in EDGE_COLUMNS]
+        survivors = (
+            db.select(func.min(table.c.id))
+            .group_by(*edge)
+            .having(func.count() > 1)
+            .scalar_subquery()
+        )
+        duplicate = table.alias("duplicate")
+        total_likes = (
+            db.select(func.sum(duplicate.c.like_num))
+            .where(*(duplicate.c[name] == table.c[name] for name in EDGE_COLUMNS))
+            .scalar_subquery()
+        )
+        merged = db.session.execute(
+            table.update().where(table.c.id.in_(survivors))
+            .values(like_num=total_likes, version=table.c.version + 1)
+        ).rowcount
+        keep = db.select(func.min(table.c.id)).group_by(*edge).scalar_subquery()
+        _bury(select(table.c.id, table.c.product_id).where(table.c.id.notin_(keep)))
+        deleted = db.session.execute(table.delete().where(table.c.id.notin_(keep))).rowcount
+        _changed(ALL_PRODUCTS)
+        db.session.commit()
+        return merged, deleted
+
+    @classmethod
+    def like_by_id(cls, by_id, version=None):
+        """Atomically adds a like and returns the updated Recommendation
+
+        Returns None if there is no Recommendation with the given id. With
+        a ``version`` the like only applies to that version, otherwise
+        StaleVersionError is raised
+        """
+        logger.info("Processing like for id %s ...", by_id)
+        return cls._add_likes(by_id, 1, version)
+
+    @classmethod
+    def unlike_by_id(cls, by_id, version=None):
+        """Atomically removes a like and returns the updated Recommendation
+
+        The like count never goes below zero. Returns None if there is no
+        Recommendation with the given id. With a ``version`` the unlike
+        only applies to that version, otherwise StaleVersionError is raised
+        """
+        logger.info("Processing unlike for id %s ...", by_id)
+        return cls._add_likes(by_id, -1, version)
+
+    @classmethod
+    def _add_likes(cls, by_id, delta, version=None):
+        """Applies ``delta`` to like_num with a single UPDATE statement
+
+        The counter is computed by the database (like_num = like_num + delta)
+        so concurrent workers never overwrite each other's increments, and
+        the floor at zero is enforced in SQL. The version check is part of
+        the same statement, so no row lock is held in between.
+        """
+        table = cls.__table__
+        new_count = table.c.like_num + delta
+        statement = (
+            table.update()
+            .where(table.c.id == by_id)
+            .values(like_num=case((new_count < 0, 0), else_=new_count), version=table.c.version + 1)
+        )
+        if version is not None:
+            statement = statement.where(table.c.version == version)
+        if db.engine.dialect.full_returning:
+            row = db.session.execute(statement.returning(*table.c)).first()
+        else:
+            # no RETURNING support (e.g. SQLite): read the row back inside
+            # the same transaction, which still holds the write lock
+            result = db.session.execute(statement)
+            row = None
+            if result.rowcount:
+                row = db.session.execute(
+                    table.select().where(table.c.id == by_id)
+                ).first()
+        if row is None:
+            db.session.commit()
+            if version is not None and cls.find_row(by_id, (ID,)) is not None:
+                raise StaleVersionError(f"Recommendation {by_id} is not at version {version}, read it again")
+            return None
+        rec = cls(**row._mapping)
+        _ranked(rec.serialize())
+        db.session.commit()
+        return rec
+
+    @classmethod
+    def apply_like_deltas(cls, deltas):
+        """Adds buffered like deltas to many recommendations in one transaction
+
+        Args:
+            deltas (dict): maps a recommendation id to the number of likes
+                to add (negative for unlikes); like_num never goes below zero
+        """
+        logger.info("Processing like deltas for %d recommendations ...", len(deltas))
+        if not deltas:
+            return
+        table = cls.__table__
+        if db.engine.dialect.name == "postgresql":
+            # one UPDATE ... FROM (VALUES ...) statement for the whole batch
+            batch = values(
+                column("id", Integer), column("delta", Integer), name="deltas"
+            ).data(list(deltas.items()))
+            new_count = table.c.like_num + batch.c.delta
+            statement = (
+                table.update()
+                .where(table.c.id == batch.c.id)
+                .values(like_num=case((new_count < 0, 0), else_=new_count), version=table.c.version + 1)
+            )
+            product_ids = db.session.execute(statement.returning(table.c.product_id)).scalars().all()
+        else:
+            product_ids = db.session.execute(
+                db.select(table.c.product_id).where(table.c.id.in_(list(deltas)))
+            ).scalars().all()
+            new_count = table.c.like_num + bindparam("delta")
+            statement = (
+                table.update()
+                .where(table.c.id == bindparam("by_id"))
+                .values(like_num=case((new_count < 0, 0), else_=new_count), version=table.c.version + 1)
+            )
+            db.session.execute(
+                statement,
+                [{"by_id": rec_id, "delta": delta} for rec_id, delta in deltas.items()],
+            )
+        _changed(*product_ids)
+        db.session.commit()
+
     @classmethod
     def find_by_product_id(cls, product_id):
         """Finds a Recommendation by it's product ID"""
@@ -193,6 +770,27 @@ class Recommendation(db.Model):
         logger.info("Processing name query for %s ...", product_name)
         return cls.query.filter(cls.product_name == product_name)
 
+    @classmethod
+    def find_product_names(cls, product_ids, chunk_size=1000):
+        """Returns {product_id: name} for the products named anywhere in the table
+
+        Args:
+            product_ids (iterable): the products to look up
+            chunk_size (int): the number of ids per IN list
+        """
+        logger.info("Processing product name query ...")
+        product_ids = list(product_ids)
+        names = {}
+        for start in range(0, len(product_ids), chunk_size):
+            chunk = product_ids[start:start + chunk_size]
+            query = (
+                db.session.query(cls.product_id, cls.product_name)
+                .filter(cls.product_id.in_(chunk))
+                .union(db.session.query(cls.rec_id, cls.rec_name).filter(cls.rec_id.in_(chunk)))
+            )
+            names.update(query.all())
+        return names
+
     @classmethod
     def find_by_rec_id(cls, rec_id):
         """Finds a Recommendation by it's rec ID"""
@@ -219,6 +817,316 @@ class Recommendation(db.Model):
         logger.info("Processing name query for %s ...", rec_type)
         return cls.query.filter(cls.rec_type == rec_type)
 
+    @classmethod
+    def find_page(cls, product_id=None, rec_type=None, after_id=None, limit=100):
+        """ Returns one page of recommendations ordered by id
+        Args:
+            :param product_id: query by product_id
+            :param rec_type: query by rec_type
+            :param after_id: only return recommendations with an id greater than this
+            :param limit: the maximum number of recommendations to return, None for all
+        """
+        logger.info("Processing page query for product_id: %s, "
+                    "rec_type: %s after id %s ...",
+                    product_id, rec_type, after_id)
+        result = cls.query
+        if product_id:
+            result = result.filter(cls.product_id == product_id)
+        if rec_type:
+            result = result.filter(cls.rec_type == rec_type)
+        if after_id is not None:
+            result = result.filter(cls.id > after_id)
+        return result.order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def find_row(cls, by_id, columns=SERIALIZED_COLUMNS):
+        """Returns the serialized recommendation with an id, or None
+
+        Only ``columns`` are selected and returned
+        """
+        logger.info("Processing row lookup for id %s ...", by_id)
+        try:
+            by_id = int(by_id)
+        except (TypeError, ValueError):
+            return None
+        statement = _filtered_rows(None, None, columns).where(cls.__table__.c.id == by_id)
+        row = db.session.execute(statement).first()
+        return _serializer(columns)(row) if row is not None else None
+
+    @classmethod
+    def find_rows(cls, product_id=None, rec_type=None, after_id=None, limit=100, columns=SERIALIZED_COLUMNS):
+        """ Returns one page of serialized recommendations ordered by id
+
+        Like find_page, but the columns are selected as plain tuples, so no
+        Recommendation objects are built or tracked by the session
+        Args:
+            :param product_id: query by product_id
+            :param rec_type: query by rec_type
+            :param after_id: only return recommendations with an id greater than this
+            :param limit: the maximum number of recommendations to return, None for all
+            :param columns: the SERIALIZED_COLUMNS to select and return
+        """
+        logger.info("Processing row query for product_id: %s, "
+                    "rec_type: %s after id %s ...",
+                    product_id, rec_type, after_id)
+        statement = _filtered_rows(product_id, rec_type, columns)
+        if after_id is not None:
+            statement = statement.where(cls.__table__.c.id > after_id)
+        statement = statement.order_by(cls.__table__.c.id).limit(limit)
+        serialize = _serializer(columns)
+        return [serialize(row) for row in db.session.execute(statement)]
+
+    @classmethod
+    def stream_rows(cls, product_id=None, rec_type=None, batch_size=1000):
+        """ Yields every matching serialized recommendation using a server-side cursor
+        Args:
+            :param product_id: query by product_id
+            :param rec_type: query by rec_type
+            :param batch_size: the number of rows fetched per round-trip
+        """
+        logger.info("Processing row stream for product_id: %s, "
+                    "rec_type: %s ...",
+                    product_id, rec_type)
+        statement = (
+            _filtered_rows(product_id, rec_type)
+            .order_by(cls.__table__.c.id)
+            .execution_options(stream_results=True, max_row_buffer=batch_size)
+        )
+        for row in db.session.execute(statement):
+            yield _serialize_row(row)
+
+    @classmethod
+    def find_changes(cls, after=None, limit=100, settle=0.0):
+        """ Returns the recommendations changed or deleted after a watermark
+
+        Changes are ordered by (updated_at, id), rows and tombstones merged,
+        and keyset paginated on that order. Changes from the last ``settle``
+        seconds are held back for a later call, so a transaction that took
+        its timestamp earlier but commits later is not skipped over; a
+        transaction that outlasts ``settle`` is.
+        Args:
+            :param after: the (updated_at, id) watermark to continue after, None for all
+            :param limit: the maximum number of changes to return
+            :param settle: the age in seconds a change must reach to be returned
+        Returns:
+            tuple: the changes and the watermark to continue after. Changed
+            rows are serialized with their updated_at and deleted False;
+            deleted ones only have an id, product_id, updated_at and deleted True
+        """
+        logger.info("Processing changes after %s ...", after)
+        until = _utcnow() - timedelta(seconds=settle)
+        rows, deletes = _change_selects(after, until)
+        changes = list(
+            _merged_changes(db.session.execute(rows.limit(limit)), db.session.execute(deletes.limit(limit)))
+        )[:limit]
+        watermark = after
+        if changes:
+            watermark = (changes[-1][UPDATED_AT], changes[-1][ID])
+        if len(changes) < limit:
+            # every change up to ``until`` has been seen
+            watermark = max(watermark or (until, 0), (until, 0))
+        return changes, watermark
+
+    @classmethod
+    def stream_changes(cls, after, until, product_id=None, rec_type=None, batch_size=1000):
+        """ Yields the matching recommendations changed or deleted after a watermark
+
+        Changes are serialized like find_changes and ordered by (updated_at, id),
+        reading rows and tombstones through server-side cursors. Tombstones
+        do not keep the rec_type, so a rec_type filter still yields every
+        delete of the product.
+        Args:
+            :param after: the (updated_at, id) watermark to continue after
+            :param until: the time of the last change to yield
+            :param product_id: query by product_id
+            :param rec_type: query by rec_type
+            :param batch_size: the number of rows fetched per round-trip
+        """
+        logger.info("Processing change stream after %s for product_id: %s, rec_type: %s ...",
+                    after, product_id, rec_type)
+        options = {"stream_results": True, "max_row_buffer": batch_size}
+        rows, deletes = _change_selects(after, until, product_id, rec_type)
+        yield from _merged_changes(
+            db.session.execute(rows.execution_options(**options)),
+            db.session.execute(deletes.execution_options(**options)),
+        )
+
+    @classmethod
+    def export_watermark(cls, settle=0.0):
+        """Returns the watermark find_changes continues from after an export started now"""
+        return _utcnow() - timedelta(seconds=settle), 0
+
+    @classmethod
+    def find_serialized(cls, product_id, rec_type=None):
+        """ Returns the serialized recommendations of a product ordered by id
+
+        Reads through the list cache, so the returned list is shared and
+        must not be modified
+        Args:
+            :param product_id: query by product_id
+            :param rec_type: query by rec_type
+        """
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(f"Invalid product_id '{product_id}'") from error
+        key = (product_id, rec_type)
+        rows = list_cache.get(key)
+        if rows is None:
+            logger.info("Processing cached query for product_id: %s, "
+                        "rec_type: %s ...",
+                        product_id, rec_type)
+            generation = list_cache.generation(product_id)
+            rows = ProductRows(cls.find_rows(product_id, rec_type, limit=None))
+            list_cache.put(key, rows, tag=product_id, generation=generation)
+        return rows
+
+    @classmethod
+    def list_version(cls, product_id, rec_type=None):
+        """ Returns a string that changes whenever the recommendations of a product do
+
+        Read with one aggregate query of their count, version sum and latest
+        updated_at, so a list can be tagged without reading or hashing it
+        Args:
+            :param product_id: query by product_id
+            :param rec_type: query by rec_type
+        """
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(f"Invalid product_id '{product_id}'") from error
+        table = cls.__table__
+        statement = select(func.count(), func.sum(table.c.version), func.max(table.c.updated_at)).where(
+            table.c.product_id == product_id
+        )
+        if rec_type:
+            statement = statement.where(table.c.rec_type == rec_type)
+        count, versions, updated_at = db.session.execute(statement).one()
+        return f"{count}-{versions or 0}-{_as_utc(updated_at).isoformat() if updated_at else ''}"
+
+    @classmethod
+    def find_serialized_many(cls, product_ids, rec_type=None):
+        """ Returns the serialized recommendations of many products, by product
+
+        Shares the list cache with find_serialized; the products missing
+        from it are read with a single query. The returned lists are
+        shared and must not be modified
+        Args:
+            :param product_ids: the products to look up
+            :param rec_type: query by rec_type
+        Returns:
+            dict: maps every product id to its recommendations ordered by id
+        """
+        try:
+            product_ids = list(dict.fromkeys(int(product_id) for product_id in product_ids))
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(f"Invalid product_id in {product_ids}") from error
+        results = {product_id: list_cache.get((product_id, rec_type)) for product_id in product_ids}
+        missing = [product_id for product_id, rows in results.items() if rows is None]
+        if missing:
+            logger.info("Processing cached query for %d product_ids, "
+                        "rec_type: %s ...",
+                        len(missing), rec_type)
+            generations = {product_id: list_cache.generation(product_id) for product_id in missing}
+            table = cls.__table__
+            if db.engine.dialect.name == "postgresql":
+                # a single array parameter: one statement whatever the number of ids
+                condition = table.c.product_id == any_(
+                    bindparam("product_ids", missing, type_=postgresql.ARRAY(Integer))
+                )
+            else:
+                condition = table.c.product_id.in_(missing)
+            statement = _filtered_rows(None, rec_type).where(condition)
+            for product_id in missing:
+                results[product_id] = ProductRows()
+            for row in db.session.execute(statement.order_by(table.c.product_id, table.c.id)):
+                results[row.product_id].append(_serialize_row(row))
+            for product_id in missing:
+                list_cache.put(
+                    (product_id, rec_type), results[product_id],
+                    tag=product_id, generation=generations[product_id],
+                )
+        return results
+
+    @classmethod
+    def find_top(cls, product_id, rec_type=None, k=10):
+        """ Returns the ``k`` most liked recommendations of a product
+
+        Served from a precomputed ranking that is loaded once and kept up
+        to date in place by likes, unlikes and deletes. The returned list
+        is shared and must not be modified
+        Args:
+            :param product_id: query by product_id
+            :param rec_type: query by rec_type
+            :param k: the number of recommendations, at most top_depth
+        """
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(f"Invalid product_id '{product_id}'") from error
+        key = (product_id, rec_type)
+        ranking = top_cache.get(key)
+        rows = ranking.top(k) if ranking is not None else None
+        if rows is None:
+            logger.info("Ranking recommendations for product_id: %s, "
+                        "rec_type: %s ...",
+                        product_id, rec_type)
+            generation = top_cache.generation(product_id)
+            query = cls.query.filter(cls.product_id == product_id)
+            if rec_type is not None:
+                query = query.filter(cls.rec_type == rec_type)
+            query = query.order_by(cls.like_num.desc(), cls.id).limit(cls.top_depth + 1)
+            ranking = Ranking([rec.serialize() for rec in query], cls.top_depth)
+            top_cache.put(key, ranking, tag=product_id, generation=generation)
+            rows = ranking.top(k)
+        return rows
+
+    @classmethod
+    def load_adjacency(cls, batch_size=10000):
+        """Loads the whole recommendation graph into the adjacency index with one query"""
+        logger.info("Loading the adjacency index ...")
+        table = cls.__table__
+        statement = (
+            _edge_select()
+            .order_by(table.c.product_id, table.c.id)
+            .execution_options(stream_results=True, max_row_buffer=batch_size)
+        )
+        adjacency.load(tuple(row) for row in db.session.execute(statement))
+        logger.info("Adjacency index loaded: %s", adjacency.stats())
+
+    @classmethod
+    def traverse(cls, product_id, depth=2, limit=20, rec_type=None, min_depth=1):
+        """ Returns the products reachable from a product within ``depth`` hops
+
+        Follows the adjacency index, re-reading only the products changed
+        since it was loaded
+        Args:
+            :param product_id: the product to start from
+            :param depth: the number of hops to follow
+            :param limit: the number of products to return
+            :param rec_type: only follow recommendations of this rec_type
+            :param min_depth: leave out products reached in fewer hops
+        """
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(f"Invalid product_id '{product_id}'") from error
+        adjacency.ensure_loaded(cls.load_adjacency)
+        logger.info("Processing traversal from product_id: %s, depth: %s ...", product_id, depth)
+        return adjacency.traverse(
+            product_id, depth, limit, rec_type, min_depth, read=cls._read_edges
+        )
+
+    @classmethod
+    def _read_edges(cls, product_ids):
+        """Returns {product_id: edge rows} for the adjacency index, in one query"""
+        table = cls.__table__
+        statement = _edge_select().where(table.c.product_id.in_(product_ids)).order_by(table.c.id)
+        edges = {}
+        for row in db.session.execute(statement):
+            edges.setdefault(row.product_id, []).append(tuple(row))
+        return edges
+
     @classmethod
     def find_by_params(cls, product_id, rec_type):
         """ Returns all  recommendation with specific parameters
@@ -235,3 +1143,302 @@ class Recommendation(db.Model):
         if rec_type:
             result = result.filter(cls.rec_type == rec_type)
         return result.all()
+
+
+class Tombstone(db.Model):
+    """
+    Class that represents a deleted Recommendation
+
+    Tombstones let delta syncs see deletes; they are kept for the sync
+    retention period and then purged
+    """
+
+    __tablename__ = "recommendation_tombstone"
+    __table_args__ = (
+        # the keyset order of Recommendation.find_changes, also used to purge
+        db.Index("ix_recommendation_tombstone_deleted_at_id", "deleted_at", "id"),
+    )
+
+    # the id of the deleted recommendation
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime(timezone=True), nullable=False, default=_utcnow)
+
+    def __repr__(self):
+        return "<id=[%s] Tombstone deleted at %s>" % (self.id, self.deleted_at)
+
+    @classmethod
+    def purge(cls, before):
+        """Deletes the tombstones of recommendations deleted before a time
+
+        Returns:
+            int: the number of tombstones deleted
+        """
+        logger.info("Purging tombstones older than %s", before)
+        table = cls.__table__
+        purged = db.session.execute(table.delete().where(table.c.deleted_at < before)).rowcount
+        db.session.commit()
+        return purged
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def _changed(*product_ids):
+    """Records products whose recommendations change in this transaction
+
+    The products are announced with NOTIFY when the transaction commits and
+    their cached lists and rankings are dropped once it has committed
+    """
+    db.session.info.setdefault(CHANGED_PRODUCTS, set()).update(product_ids)
+
+
+def _ranked(row, removed=False):
+    """Records a serialized row whose like count changes, or that is removed
+
+    Like _changed, but this worker updates the row's rankings in place
+    instead of dropping them
+    """
+    db.session.info.setdefault(RANKED_ROWS, []).append((row, removed))
+
+
+@event.listens_for(db.session, "before_commit")
+def _notify_changes(session):
+    """Sends a NOTIFY per changed product inside the committing transaction"""
+    product_ids = set(session.info.get(CHANGED_PRODUCTS, ()))
+    product_ids.update(row[PRODUCT_ID] for row, _ in session.info.get(RANKED_ROWS, ()))
+    if not product_ids or session.bind.dialect.name != "postgresql":
+        return
+    session.execute(
+        text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"),
+        {"channel": Recommendation.notify_channel, "payloads": sorted(_payload(pid) for pid in product_ids)},
+    )
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_changes(session):
+    """Drops or updates the cached data of the products changed by the commit"""
+    for product_id in session.info.pop(CHANGED_PRODUCTS, ()):
+        invalidate_product(product_id)
+    for row, removed in session.info.pop(RANKED_ROWS, ()):
+        list_cache.invalidate(row[PRODUCT_ID])
+        if removed:
+            adjacency.remove(row[PRODUCT_ID], row[ID])
+        else:
+            adjacency.update_weight(row[PRODUCT_ID], row[ID], row[LIKE_NUM])
+        if not top_cache.advance(row[PRODUCT_ID]):
+            continue
+        for key in ((row[PRODUCT_ID], None), (row[PRODUCT_ID], Type(row[REC_TYPE]))):
+            ranking = top_cache.peek(key)
+            if ranking is None:
+                continue
+            if removed:
+                ranking.remove(row[ID])
+            else:
+                ranking.update(row)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_changes(session):
+    """Forgets the changes of a transaction that was rolled back"""
+    session.info.pop(CHANGED_PRODUCTS, None)
+    session.info.pop(RANKED_ROWS, None)
+
+
+def invalidate_product(product_id):
+    """Drops the cached data of one product, or of all of them for ALL_PRODUCTS"""
+    if product_id == ALL_PRODUCTS:
+        list_cache.clear()
+        top_cache.clear()
+        adjacency.clear()
+    else:
+        list_cache.invalidate(int(product_id))
+        top_cache.invalidate(int(product_id))
+        adjacency.invalidate(int(product_id))
+
+
+def handle_notification(payload):
+    """Drops the cached data of a product changed by another worker"""
+    source, _, product_id = payload.rpartition(":")
+    if source != WORKER_ID:
+        invalidate_product(product_id)
+
+
+def engine_options(config):
+    """Returns the create_engine() options of the DB_* pool settings in ``config``
+
+    SQLite keeps the pool Flask-SQLAlchemy picks for it; server databases
+    get a sized QueuePool whose connections are checked before use, and on
+    PostgreSQL a statement timeout and an application_name
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        return {}
+    options = {
+        "pool_size": config.get("DB_POOL_SIZE", 5),
+        "max_overflow": config.get("DB_MAX_OVERFLOW", 10),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": config.get("DB_POOL_RECYCLE", -1),
+        "pool_pre_ping": config.get("DB_POOL_PRE_PING", True),
+    }
+    if backend == "postgresql":
+        connect_args = {"application_name": config.get("DB_APPLICATION_NAME", "recommendations")}
+        statement_timeout = config.get("DB_STATEMENT_TIMEOUT_MS", 0)
+        if statement_timeout:
+            connect_args["options"] = f"-c statement_timeout={int(statement_timeout)}"
+        options["connect_args"] = connect_args
+    return options
+
+
+def pool_stats(pool):
+    """Returns the connections of a QueuePool by state, None for other pools"""
+    if not isinstance(pool, QueuePool):
+        return None
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        # overflow() counts down from -size while the pool fills
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": pool._max_overflow,  # pylint: disable=protected-access
+        "timeout": pool.timeout(),
+    }
+
+
+def _payload(product_id):
+    """Returns the NOTIFY payload announcing a changed product"""
+    return f"{WORKER_ID}:{product_id}"
+
+
+def _filtered_rows(product_id, rec_type, names=SERIALIZED_COLUMNS):
+    """Returns a SELECT of the named columns filtered like find_page"""
+    columns = Recommendation.__table__.c
+    statement = select(*(columns[name] for name in names))
+    if product_id:
+        statement = statement.where(columns.product_id == product_id)
+    if rec_type:
+        statement = statement.where(columns.rec_type == rec_type)
+    return statement
+
+
+def _change_selects(after, until, product_id=None, rec_type=None):
+    """Returns the SELECTs of the rows and tombstones changed after ``after`` up to ``until``, in change order"""
+    table, tombstones = Recommendation.__table__, Tombstone.__table__
+    rows = _filtered_rows(product_id, rec_type).add_columns(table.c.updated_at).where(table.c.updated_at <= until)
+    deletes = select(tombstones.c.id, tombstones.c.product_id, tombstones.c.deleted_at).where(
+        tombstones.c.deleted_at <= until
+    )
+    if product_id:
+        deletes = deletes.where(tombstones.c.product_id == product_id)
+    if after is not None:
+        rows = rows.where(tuple_(table.c.updated_at, table.c.id) > tuple_(*after))
+        deletes = deletes.where(tuple_(tombstones.c.deleted_at, tombstones.c.id) > tuple_(*after))
+    return (
+        rows.order_by(table.c.updated_at, table.c.id),
+        deletes.order_by(tombstones.c.deleted_at, tombstones.c.id),
+    )
+
+
+def _merged_changes(rows, deletes):
+    """Merges the results of _change_selects into changes ordered by (updated_at, id)"""
+    changed = (
+        dict(_serialize_row(row), **{UPDATED_AT: _as_utc(row.updated_at), DELETED: False})
+        for row in rows
+    )
+    deleted = (
+        {ID: row.id, PRODUCT_ID: row.product_id, UPDATED_AT: _as_utc(row.deleted_at), DELETED: True}
+        for row in deletes
+    )
+    return heapq.merge(changed, deleted, key=lambda change: (change[UPDATED_AT], change[ID]))
+
+
+def _serializer(columns):
+    """Returns the function serializing rows of ``columns``"""
+    if columns == SERIALIZED_COLUMNS:
+        return _serialize_row
+    if REC_TYPE not in columns:
+        return lambda row: dict(zip(columns, row))
+    position = columns.index(REC_TYPE)
+
+    def serialize(row):
+        data = dict(zip(columns, row))
+        data[REC_TYPE] = row[position].name
+        return data
+
+    return serialize
+
+
+def _serialize_row(row):
+    """Serializes a row of SERIALIZED_COLUMNS like Recommendation.serialize"""
+    return {
+        ID: row[0],
+        PRODUCT_ID: row[1],
+        PRODUCT_NAME: row[2],
+        REC_ID: row[3],
+        REC_NAME: row[4],
+        REC_TYPE: row[5].name,
+        LIKE_NUM: row[6],
+        VERSION: row[7],
+    }
+
+
+def _edge_select():
+    """Returns a SELECT of the columns held by the adjacency index"""
+    columns = Recommendation.__table__.c
+    return select(
+        columns.id, columns.product_id, columns.rec_id, columns.rec_type,
+        columns.like_num, columns.product_name, columns.rec_name,
+    )
+
+
+def _bury(rows):
+    """Records tombstones for the (id, product_id) rows of a SELECT about to be deleted
+
+    The SELECT needs a WHERE clause: SQLite cannot parse INSERT ... SELECT
+    ... ON CONFLICT without one
+    """
+    tombstones = Tombstone.__table__
+    statement = _dialect_insert(tombstones).from_select(
+        ["id", "product_id", "deleted_at"],
+        rows.add_columns(literal(_utcnow(), tombstones.c.deleted_at.type)),
+    )
+    # an id deleted again, possible where ids are reused, moves its tombstone
+    statement = statement.on_conflict_do_update(
+        index_elements=["id"],
+        set_={"product_id": statement.excluded.product_id, "deleted_at": statement.excluded.deleted_at},
+    )
+    db.session.execute(statement)
+
+
+def _is_duplicate_edge(error):
+    """Returns True if an IntegrityError is a unique violation of uq_recommendation_edge"""
+    orig = error.orig
+    if getattr(orig, "pgcode", None) is not None:
+        # 23505 is unique_violation
+        constraint = getattr(getattr(orig, "diag", None), "constraint_name", None)
+        return orig.pgcode == "23505" and constraint in (None, "uq_recommendation_edge")
+    message = str(orig)
+    return message.startswith("UNIQUE constraint failed") and all(
+        f"recommendation.{name}" in message for name in EDGE_COLUMNS
+    )
+
+
+def _as_utc(value):
+    """Returns a timestamp read back from the database as an aware UTC datetime
+
+    SQLite stores timestamps without their zone, and they are all UTC
+    """
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def _dialect_insert(table):
+    """Returns an INSERT for the current database that supports ON CONFLICT"""
+    if db.engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def _edge(row):
+    """Returns the (product_id, rec_id, rec_type) key of a row of values"""
+    return (int(row[PRODUCT_ID]), int(row[REC_ID]), Type(row[REC_TYPE]))
@@ -3,15 +3,69 @@ My Service
 
 Describe what your service does here
 """
-from flask import abort, jsonify, request
-from flask.logging import create_logger
-from flask_restx import Resource, fields, reqparse
-
-from service.models import Recommendation, Type
+import atexit
+import base64
+import binascii
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+
+import orjson
+
+from flask import Response, abort, jsonify, request, send_from_directory, stream_with_context
+from flask_restx import Resource, fields, inputs, reqparse
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from service.models import (
+    ALL_PRODUCTS,
+    ID,
+    LIKE_NUM,
+    PRODUCT_ID,
+    PRODUCT_NAME,
+    REC_ID,
+    REC_NAME,
+    REC_TYPE,
+    SERIALIZED_COLUMNS,
+    VERSION,
+    DataValidationError,
+    Recommendation,
+    StaleVersionError,
+    Type,
+    adjacency,
+    db,
+    handle_notification,
+    invalidate_product,
+    list_cache,
+    pool_stats,
+    top_cache,
+)
 
 # Import Flask application
 from . import app, api
 from .utils import status  # HTTP Status Codes
+from .utils.cache_listener import CacheListener
+from .utils.compression import StaticFiles, compress_response, matching_etag, strip_encoding
+from .utils.like_buffer import LikeBuffer
+from .utils.metrics import CacheMetrics, RequestMetrics, instrument_engine, render
+from .utils.profiling import Profiler
+
+logger = logging.getLogger("flask.app")
+
+# Write-behind buffer for likes, created by init_like_buffer() when enabled
+like_buffer = None
+
+# Cross-worker cache invalidation, started by init_cache_listener() on PostgreSQL
+cache_listener = None
+
+# Request profiler, installed by init_profiler() when enabled
+profiler = None
+
+# Hit and miss counters of the caches, reported on /metrics by init_metrics()
+cache_metrics = CacheMetrics({"list": list_cache, "top": top_cache})
+
+# The static folder, served compressed and with fingerprinted asset URLs
+static_files = StaticFiles(app.static_folder, app.config["STATIC_MAX_AGE"])
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
@@ -23,7 +77,46 @@ from .utils import status  # HTTP Status Codes
 @app.route("/health")
 def health():
     """Health Status"""
-    return jsonify(dict(status="OK")), status.HTTP_200_OK
+    message = dict(status="OK")
+    if like_buffer:
+        message["pending_likes"] = like_buffer.pending()
+    if list_cache.enabled:
+        message["cache"] = list_cache.stats()
+        message["top_cache"] = top_cache.stats()
+    if adjacency.loaded:
+        message["adjacency"] = adjacency.stats()
+    pool = pool_stats(db.engine.pool)
+    if pool:
+        message["pool"] = pool
+    return jsonify(message), status.HTTP_200_OK
+
+
+######################################################################
+# Metrics Endpoint
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """Prometheus metrics of every worker"""
+    cache_metrics.sync()
+    return Response(render(), content_type=CONTENT_TYPE_LATEST)
+
+
+######################################################################
+# Profiles Endpoints
+######################################################################
+@app.route("/profiles")
+def profiles():
+    """Lists the newest request profiles of every worker"""
+    check_profiles_access()
+    limit = request.args.get("limit", 50, type=int)
+    return jsonify(profiler.recent(max(limit, 1))), status.HTTP_200_OK
+
+
+@app.route("/profiles/<name>")
+def profile(name):
+    """Downloads a request profile"""
+    check_profiles_access()
+    return send_from_directory(profiler.folder, name, as_attachment=True)
 
 
 ######################################################################
@@ -32,8 +125,40 @@ def health():
 @app.route("/")
 def index():
     """Root URL response"""
-    create_logger(app).info("Request for Root URL ")
-    return app.send_static_file("index.html")
+    logger.info("Request for Root URL ")
+    return static_files.page("index.html", request)
+
+
+def send_static(filename):
+    """Serves a static file, replacing Flask's static view"""
+    return static_files.send(filename, request)
+
+
+app.view_functions["static"] = send_static
+
+
+@app.after_request
+def apply_response_policy(response):
+    """Sets the Cache-Control of API reads and compresses the response"""
+    rule = request.url_rule.rule if request.url_rule else None
+    if (
+        request.method in ("GET", "HEAD")
+        and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED)
+        and rule is not None
+        and rule.startswith(api.prefix)
+        and "Cache-Control" not in response.headers
+    ):
+        response.headers["Cache-Control"] = app.config["API_CACHE_CONTROL_ROUTES"].get(
+            rule, app.config["API_CACHE_CONTROL"]
+        )
+    if app.config["COMPRESSION_ENABLED"]:
+        compress_response(
+            response,
+            request.accept_encodings,
+            app.config["COMPRESSION_MIN_SIZE"],
+            {"br": app.config["COMPRESSION_BROTLI_QUALITY"], "gzip": app.config["COMPRESSION_GZIP_LEVEL"]},
+        )
+    return response
 
 
 # Define the model so that the docs reflect what can be sent
@@ -60,13 +185,79 @@ recommendation_model = api.inherit(
         'id': fields.Integer(
             readOnly=True, description='The unique id assigned internally by service'
         ),
+        'version': fields.Integer(
+            description='Increased by every write; send back the version read to update '
+                        'only if the Recommendation has not changed since'
+        ),
     }
 )
 
+bulk_error_model = api.model('BulkError', {
+    'index': fields.Integer(description='The position of the rejected item in the request'),
+    'message': fields.String(description='Why the item was rejected'),
+})
+
+bulk_result_model = api.model('BulkResult', {
+    'created': fields.List(fields.Integer, description='The ids of the created Recommendations, in request order'),
+    'errors': fields.List(fields.Nested(bulk_error_model), description='The items that were not created'),
+})
+
 # query string arguments
+FIELDS_HELP = f"Comma-separated fields to return, out of {','.join(SERIALIZED_COLUMNS)}; all by default"
+
 rec_args = reqparse.RequestParser()
 rec_args.add_argument('product_id', type=str, required=False, help='List Recommendations by product_id')
 rec_args.add_argument('rec_type', type=str, required=False, help='List Recommendations by rec_type')
+rec_args.add_argument('limit', type=inputs.positive, required=False, help='Maximum number of Recommendations per page')
+rec_args.add_argument('cursor', type=str, required=False, help='The X-Next-Cursor value of the previous page')
+rec_args.add_argument('fields', type=str, required=False, help=FIELDS_HELP)
+
+get_args = reqparse.RequestParser()
+get_args.add_argument('fields', type=str, location='args', required=False, help=FIELDS_HELP)
+
+product_recommendations_model = api.model('ProductRecommendations', {
+    'product_id': fields.Integer(description='A requested product'),
+    'recommendations': fields.List(fields.Nested(recommendation_model), description='Its recommendations by id'),
+})
+
+batch_args = reqparse.RequestParser()
+batch_args.add_argument('product_ids', type=int, action='split', required=True,
+                        help='Comma-separated product ids to look up')
+batch_args.add_argument('rec_type', type=str, required=False, help='Only return Recommendations of this rec_type')
+
+traversal_model = api.model('Traversal', {
+    'product_id': fields.Integer(description='A product reached from the source product'),
+    'name': fields.String(description='The name of the product'),
+    'score': fields.Float(description='The share of likes flowing to the product from the source'),
+    'depth': fields.Integer(description='The fewest hops the product was reached in'),
+    'via': fields.Integer(description='The product it was first reached from'),
+})
+
+traverse_args = reqparse.RequestParser()
+traverse_args.add_argument('product_id', type=int, required=True, help='The product to start from')
+traverse_args.add_argument('depth', type=inputs.positive, required=False, help='Number of hops to follow')
+traverse_args.add_argument('min_depth', type=inputs.positive, required=False,
+                           help='Leave out products reached in fewer hops, 2 for second-degree only')
+traverse_args.add_argument('rec_type', type=str, choices=Type._member_names_, required=False,
+                           help='Only follow Recommendations of this rec_type')
+traverse_args.add_argument('limit', type=inputs.positive, required=False, help='Number of products to return')
+
+top_args = reqparse.RequestParser()
+top_args.add_argument('product_id', type=int, required=True, help='The product to rank Recommendations for')
+top_args.add_argument('rec_type', type=str, choices=Type._member_names_, required=False,
+                      help='Rank only Recommendations of this rec_type')
+top_args.add_argument('k', type=inputs.positive, required=False, help='Number of Recommendations to return')
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('since', type=str, required=False,
+                          help='The X-Watermark value of the previous page or export, everything by default')
+changes_args.add_argument('limit', type=inputs.positive, required=False, help='Maximum number of changes per page')
+
+export_args = reqparse.RequestParser()
+export_args.add_argument('product_id', type=str, required=False, help='Export Recommendations by product_id')
+export_args.add_argument('rec_type', type=str, required=False, help='Export Recommendations by rec_type')
+export_args.add_argument('since', type=str, required=False,
+                         help='The X-Watermark of an earlier export, to export only what changed since')
 
 
 ######################################################################
@@ -88,23 +279,30 @@ class RecommendationResource(Resource):
     # RETRIEVE A RECOMMENDATION
     # ------------------------------------------------------------------
     @api.doc('get_recommendations')
+    @api.expect(get_args, validate=True)
     @api.response(404, 'Recommendation not found')
-    @api.marshal_with(recommendation_model)
+    @api.response(400, 'Unknown fields requested')
+    @api.response(304, 'The Recommendation matches the If-None-Match ETag')
+    @api.response(200, 'Success', recommendation_model, headers={'ETag': 'The version of the Recommendation'})
     def get(self, id):
         """
         Retrieve a single Recommendation
 
-        This endpoint will return a Recommendation based on it's id
+        This endpoint will return a Recommendation based on it's id,
+        limited to the requested fields
         """
-        create_logger(app).info("Request for Recommendation with id: %s", id)
-        rec = Recommendation.find(id)
-        if not rec:
+        logger.info("Request for Recommendation with id: %s", id)
+        names = parse_fields(get_args.parse_args()['fields'])
+        # the id and version are read for the ETag whatever the fields
+        row = Recommendation.find_row(id, tuple(dict.fromkeys(names + (ID, VERSION))))
+        if not row:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Recommendation with id '{id}' was not found.",
             )
-        create_logger(app).info("Returning recommendation: %s", rec.product_name)
-        return rec.serialize(), status.HTTP_200_OK
+        logger.info("Returning recommendation: %s", id)
+        rec = {name: row[name] for name in names}
+        return conditional_response(rec, row_etag(row[ID], row[VERSION], names))
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING Recommendation
@@ -112,29 +310,41 @@ class RecommendationResource(Resource):
     @api.doc('update_recommendations')
     @api.response(404, 'Recommendation not found')
     @api.response(400, 'The posted Recommendation data was not valid')
+    @api.response(409, 'Another Recommendation has the same edge, or the version sent is not the current one')
+    @api.response(412, 'The Recommendation does not match the If-Match ETag')
+    @api.header('ETag', 'The version of the updated Recommendation')
     @api.expect(recommendation_model)
     @api.marshal_with(recommendation_model)
     def put(self, id):
         """
         Update a Recommendation
 
-        This endpoint will update a Recommendation based the body that is posted
+        This endpoint will update a Recommendation based the body that is posted,
+        if it is still at the version sent in the body or the If-Match ETag
         """
-        create_logger(app).info("Request to update Recommendation with id: %s", id)
+        logger.info("Request to update Recommendation with id: %s", id)
+        version = if_match_version(id)
         rec = Recommendation.find(id)
-        create_logger(app).info("found rec!")
         if not rec:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Recommendation with id '{id}' was not found.",
             )
-        create_logger(app).debug('Payload = %s', api.payload)
-        create_logger(app).info(api.payload)
-        rec.deserialize(api.payload)
-        rec.id = id
-        rec.update()
-        create_logger(app).info("Recommendation with ID [%s] updated.", id)
-        return rec.serialize(), status.HTTP_200_OK
+        logger.info("found rec!")
+        logger.debug('Payload = %s', api.payload)
+        logger.info(api.payload)
+        try:
+            if version is not None:
+                rec.expect_version(version)
+            rec.deserialize(api.payload)
+            rec.id = id
+            rec.update()
+        except StaleVersionError as error:
+            if version is None:
+                raise
+            abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
+        logger.info("Recommendation with ID [%s] updated.", id)
+        return rec.serialize(), status.HTTP_200_OK, {'ETag': f'"{row_etag(rec.id, rec.version)}"'}
 
     # ------------------------------------------------------------------
     # DELETE A RECOMMENDATION
@@ -146,11 +356,11 @@ class RecommendationResource(Resource):
         Delete a Recommendation
         This endpoint will delete a Recommendation based the id specified in the path
         """
-        create_logger(app).info("Request to delete recommendation with id: %s", id)
+        logger.info("Request to delete recommendation with id: %s", id)
         rec = Recommendation.find(id)
         if rec:
             rec.delete()
-            create_logger(app).info("Recommendation with ID [%s] delete complete.", id)
+            logger.info("Recommendation with ID [%s] delete complete.", id)
         return "", status.HTTP_204_NO_CONTENT
 
 
@@ -165,33 +375,55 @@ class RecommendationsCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_recommendations')
     @api.expect(rec_args, validate=True)
-    @api.marshal_list_with(recommendation_model)
+    @api.header('X-Next-Cursor', 'Pass as cursor to get the next page, absent on the last page')
+    @api.response(304, 'The product list matches the If-None-Match ETag')
+    @api.response(200, 'Success', [recommendation_model], headers={'ETag': 'The version of a product list'})
     def get(self):
         """
         Retrieves all recommendations
 
-        This endpoint will return all the recommendations available
+        This endpoint will return the recommendations one page at a time,
+        ordered by id. Lists filtered by product_id carry an ETag
         """
-        create_logger(app).info("Request to list all the recommendations")
-        rec = []
+        logger.info("Request to list all the recommendations")
         args = rec_args.parse_args()
-        if args['product_id'] or args['rec_type']:
-            rec = Recommendation.find_by_params(args['product_id'], args['rec_type'])
-            if not rec:
-                abort(
-                    status.HTTP_404_NOT_FOUND,
-                    "Recommendation was not found.",
-                    )
+        limit = min(args['limit'] or app.config['DEFAULT_PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+        after_id = decode_cursor(args['cursor'])
+        names = parse_fields(args['fields'])
+        # only the requested columns are read, plus the id for the cursor
+        columns = names if ID in names else (ID,) + names
+        etag = None
+        # fetch one extra row to find out whether there is a next page
+        if args['product_id']:
+            message, version = product_page(args['product_id'], args['rec_type'], after_id, limit + 1, columns)
+            # the page only depends on the product's list and the query string
+            etag = hashlib.blake2b(version.encode() + request.query_string, digest_size=16).hexdigest()
         else:
-            rec = Recommendation.all()
-        message = [recommendation.serialize() for recommendation in rec]
-        return message, status.HTTP_200_OK
+            message = Recommendation.find_rows(None, args['rec_type'], after_id, limit + 1, columns)
+        if not message and after_id is None and (args['product_id'] or args['rec_type']):
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                "Recommendation was not found.",
+                )
+        headers = {}
+        if len(message) > limit:
+            message = message[:limit]
+            headers['X-Next-Cursor'] = encode_cursor(message[-1][ID])
+        cached = matching_etag(request.if_none_match, etag) if etag is not None else None
+        if cached is not None:
+            return not_modified(cached, headers)
+        if names != SERIALIZED_COLUMNS:
+            message = [{name: row[name] for name in names} for row in message]
+        if etag is not None:
+            headers['ETag'] = f'"{etag}"'
+        return json_response(message, status.HTTP_200_OK, headers)
 
     # ------------------------------------------------------------------
     # ADD A NEW RECOMMENDATION
     # ------------------------------------------------------------------
     @api.doc('create_recommendations')
     @api.response(400, 'The posted data was not valid')
+    @api.response(409, 'A Recommendation with the same product_id, rec_id and rec_type exists')
     @api.expect(recommendation_model)
     @api.marshal_with(recommendation_model, code=201)
     def post(self):
@@ -199,15 +431,244 @@ class RecommendationsCollection(Resource):
         Creates a Recommendation
         This endpoint will create a Recommendation based the data in the body this is posted
         """
-        create_logger(app).info("Request to create a Recommendation")
+        logger.info("Request to create a Recommendation")
         rec = Recommendation()
-        create_logger(app).debug('Payload = %s', api.payload)
+        logger.debug('Payload = %s', api.payload)
         rec.deserialize(api.payload)
         rec.create()
-        create_logger(app).info("Recommendation with new id [%s] created!", rec.id)
+        logger.info("Recommendation with new id [%s] created!", rec.id)
         location_url = api.url_for(RecommendationResource, id=rec.id, _external=True)
         return rec.serialize(), status.HTTP_201_CREATED,  {'Location': location_url}
 
+    # ------------------------------------------------------------------
+    # CREATE OR REPLACE A RECOMMENDATION
+    # ------------------------------------------------------------------
+    @api.doc('upsert_recommendations')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(201, 'Recommendation created', recommendation_model)
+    @api.expect(create_model)
+    @api.marshal_with(recommendation_model)
+    def put(self):
+        """
+        Creates or replaces a Recommendation
+
+        This endpoint is an idempotent create: if a Recommendation with the same
+        product_id, rec_id and rec_type exists it is updated, otherwise it is created
+        """
+        logger.info("Request to upsert a Recommendation")
+        rec = Recommendation(**validated_row(api.payload))
+        created = rec.upsert()
+        logger.info("Recommendation with id [%s] %s", rec.id, "created" if created else "updated")
+        location_url = api.url_for(RecommendationResource, id=rec.id, _external=True)
+        code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        return Recommendation.find(rec.id).serialize(), code, {'Location': location_url}
+
+
+######################################################################
+#  PATH: /recommendations/bulk
+######################################################################
+@api.route('/recommendations/bulk')
+class BulkResource(Resource):
+    """ Creates many Recommendations in one request """
+    @api.doc('bulk_create_recommendations')
+    @api.expect([create_model])
+    @api.response(201, 'Recommendations created', bulk_result_model)
+    @api.response(400, 'None of the posted data was valid or new', bulk_result_model)
+    @api.response(413, 'Too many Recommendations in one request')
+    def post(self):
+        """
+        Creates many Recommendations
+
+        This endpoint accepts a JSON array of Recommendations, or one
+        Recommendation per line with Content-Type application/x-ndjson.
+        Valid items are inserted in chunks; invalid ones and duplicates of
+        an existing edge are reported by their position in the request
+        """
+        items = read_bulk_items()
+        logger.info("Request to bulk create %d Recommendations", len(items))
+        if len(items) > app.config['BULK_MAX_ITEMS']:
+            abort(
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                f"At most {app.config['BULK_MAX_ITEMS']} Recommendations can be created at once.",
+            )
+        rows, positions, errors = [], [], []
+        for index, data in enumerate(items):
+            try:
+                rows.append(validated_row(data))
+                positions.append(index)
+            except DataValidationError as error:
+                errors.append({'index': index, 'message': str(error)})
+        created = []
+        for index, rec_id in zip(positions, Recommendation.bulk_create(rows, app.config['BULK_CHUNK_SIZE'])):
+            if rec_id is None:
+                errors.append({'index': index, 'message': 'Duplicate Recommendation: the edge already exists'})
+            else:
+                created.append(rec_id)
+        errors.sort(key=lambda error: error['index'])
+        logger.info("Bulk created %d Recommendations, rejected %d", len(created), len(errors))
+        code = status.HTTP_201_CREATED if created or not errors else status.HTTP_400_BAD_REQUEST
+        return {'created': created, 'errors': errors}, code
+
+
+######################################################################
+#  PATH: /recommendations/top
+######################################################################
+@api.route('/recommendations/top')
+class TopResource(Resource):
+    """ The most liked Recommendations of a product """
+    @api.doc('top_recommendations')
+    @api.expect(top_args, validate=True)
+    @api.response(200, 'Success', [recommendation_model])
+    def get(self):
+        """
+        Top Recommendations
+
+        This endpoint will return the k most liked recommendations of a
+        product, highest like_num first, from a precomputed ranking
+        """
+        logger.info("Request for the top recommendations")
+        args = top_args.parse_args()
+        k = min(args['k'] or app.config['TOP_K_DEFAULT'], Recommendation.top_depth)
+        return json_response(Recommendation.find_top(args['product_id'], args['rec_type'], k))
+
+
+######################################################################
+#  PATH: /recommendations/batch
+######################################################################
+@api.route('/recommendations/batch')
+class BatchResource(Resource):
+    """ Recommendations of many products at once """
+    @api.doc('batch_recommendations')
+    @api.expect(batch_args, validate=True)
+    @api.response(400, 'Too many or invalid product_ids')
+    @api.response(200, 'Success', [product_recommendations_model])
+    def get(self):
+        """
+        Batch Recommendations
+
+        This endpoint will return the recommendations of every requested
+        product, grouped by product in request order, with one query for
+        the products that are not cached
+        """
+        logger.info("Request for recommendations of many products")
+        args = batch_args.parse_args()
+        product_ids = list(dict.fromkeys(args['product_ids']))
+        if len(product_ids) > app.config['BATCH_MAX_PRODUCTS']:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"At most {app.config['BATCH_MAX_PRODUCTS']} product_ids can be requested at once",
+            )
+        results = Recommendation.find_serialized_many(product_ids, args['rec_type'])
+        message = [
+            {'product_id': product_id, 'recommendations': results[product_id]}
+            for product_id in product_ids
+        ]
+        return json_response(message)
+
+
+######################################################################
+#  PATH: /recommendations/traverse
+######################################################################
+@api.route('/recommendations/traverse')
+class TraverseResource(Resource):
+    """ Recommendations of recommendations """
+    @api.doc('traverse_recommendations')
+    @api.expect(traverse_args, validate=True)
+    @api.marshal_list_with(traversal_model)
+    def get(self):
+        """
+        Traverse Recommendations
+
+        This endpoint will return the products reachable from a product by
+        following recommendations up to depth hops, weighted by likes
+        """
+        logger.info("Request to traverse recommendations")
+        args = traverse_args.parse_args()
+        depth = min(args['depth'] or 2, app.config['TRAVERSE_MAX_DEPTH'])
+        limit = min(args['limit'] or app.config['DEFAULT_PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+        products = Recommendation.traverse(
+            args['product_id'], depth, limit, args['rec_type'], args['min_depth'] or 1
+        )
+        return products, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /recommendations/export
+######################################################################
+@api.route('/recommendations/export')
+class ExportResource(Resource):
+    """ Streams the whole Recommendation table """
+    @api.doc('export_recommendations')
+    @api.expect(export_args, validate=True)
+    @api.produces(['application/x-ndjson'])
+    @api.header('X-Watermark', 'Pass as since to /recommendations/changes or this export to follow the export')
+    @api.response(410, 'The watermark is older than the tombstones kept, export without since')
+    @api.response(200, 'One JSON Recommendation per line')
+    def get(self):
+        """
+        Export Recommendations
+
+        This endpoint will stream every matching Recommendation as
+        newline-delimited JSON, reading the table through a server-side cursor.
+        With since, it streams the changes after that watermark instead,
+        deletes included, like /recommendations/changes without pages
+        """
+        logger.info("Request to export recommendations")
+        args = export_args.parse_args()
+        after = decode_watermark(args['since'])
+        check_retained(after)
+        # taken before the rows are read, so following changes may repeat some
+        watermark = Recommendation.export_watermark(app.config['CHANGES_SETTLE_SECONDS'])
+        if after is None:
+            rows = Recommendation.stream_rows(
+                args['product_id'], args['rec_type'], app.config['EXPORT_BATCH_SIZE']
+            )
+        else:
+            rows = Recommendation.stream_changes(
+                after, watermark[0], args['product_id'], args['rec_type'], app.config['EXPORT_BATCH_SIZE']
+            )
+            watermark = max(after, watermark)
+
+        def generate():
+            for row in rows:
+                yield orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE)
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='application/x-ndjson',
+            headers={'X-Watermark': encode_watermark(watermark)},
+        )
+
+
+######################################################################
+#  PATH: /recommendations/changes
+######################################################################
+@api.route('/recommendations/changes')
+class ChangesResource(Resource):
+    """ Recommendations changed or deleted since a watermark """
+    @api.doc('recommendation_changes')
+    @api.expect(changes_args, validate=True)
+    @api.header('X-Watermark', 'Pass as since to get the next changes')
+    @api.response(410, 'The watermark is older than the tombstones kept, export again')
+    @api.response(200, 'Changed Recommendations with updated_at and deleted, oldest first')
+    def get(self):
+        """
+        Changes of Recommendations
+
+        This endpoint will return the recommendations created, updated or
+        deleted after the since watermark, ordered by (updated_at, id).
+        Deleted ones only have an id, product_id and updated_at. A page
+        shorter than the limit means the client has caught up
+        """
+        logger.info("Request for recommendation changes")
+        args = changes_args.parse_args()
+        limit = min(args['limit'] or app.config['DEFAULT_PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+        after = decode_watermark(args['since'])
+        check_retained(after)
+        changes, watermark = Recommendation.find_changes(after, limit, app.config['CHANGES_SETTLE_SECONDS'])
+        headers = {'X-Watermark': encode_watermark(watermark)} if watermark is not None else {}
+        return json_response(changes, status.HTTP_200_OK, headers)
+
 
 ######################################################################
 #  PATH: /recommendations/{id}/like
@@ -219,24 +680,31 @@ class LikeResource(Resource):
     @api.doc('like_recommendations')
     @api.response(404, 'Recommendation not found')
     @api.response(409, 'The Recommendation is not available for like')
+    @api.response(412, 'The Recommendation does not match the If-Match ETag')
+    @api.header('ETag', 'The version of the liked Recommendation')
     def put(self, id):
         """
         Like a Recommendation
 
-        This endpoint will like a Recommendation based on the id
+        This endpoint will like a Recommendation based on the id,
+        if it still matches the If-Match ETag when one is sent
         """
-        create_logger(app).info("Request to like Recommendation with id: %s", id)
-        rec = Recommendation.find(id)
+        logger.info("Request to like Recommendation with id: %s", id)
+        version = if_match_version(id)
+        if like_buffer and not request.if_match:
+            return buffer_like(id, 1), status.HTTP_200_OK
+        try:
+            rec = Recommendation.like_by_id(id, version)
+        except StaleVersionError as error:
+            abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
         if not rec:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Recommendation with id '{id}' was not found.",
             )
-        rec.like_num += 1
-        rec.update()
 
-        create_logger(app).info("Recommendation with ID [%s] is liked.", rec.id)
-        return rec.serialize(), status.HTTP_200_OK
+        logger.info("Recommendation with ID [%s] is liked.", rec.id)
+        return rec.serialize(), status.HTTP_200_OK, {'ETag': f'"{row_etag(rec.id, rec.version)}"'}
 
 
 ######################################################################
@@ -249,44 +717,349 @@ class UnlikeResource(Resource):
     @api.doc('unlike_recommendations')
     @api.response(404, 'Recommendation not found')
     @api.response(409, 'The Recommendation is not available for unlike')
+    @api.response(412, 'The Recommendation does not match the If-Match ETag')
+    @api.header('ETag', 'The version of the unliked Recommendation')
     def put(self, id):
         """
         Unlike a Recommendation
 
-        This endpoint will unlike a Recommendation based on the id
+        This endpoint will unlike a Recommendation based on the id,
+        if it still matches the If-Match ETag when one is sent
         """
-        create_logger(app).info("Request to unlike Recommendation with id: %s", id)
-        rec = Recommendation.find(id)
+        logger.info("Request to unlike Recommendation with id: %s", id)
+        version = if_match_version(id)
+        if like_buffer and not request.if_match:
+            return buffer_like(id, -1), status.HTTP_200_OK
+        try:
+            rec = Recommendation.unlike_by_id(id, version)
+        except StaleVersionError as error:
+            abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
         if not rec:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Recommendation with id '{id}' was not found.",
             )
 
-        if rec.like_num >= 1:
-            rec.like_num -= 1
-        rec.update()
-
-        create_logger(app).info("Recommendation with ID [%s] is unliked.", rec.id)
-        return rec.serialize(), status.HTTP_200_OK
+        logger.info("Recommendation with ID [%s] is unliked.", rec.id)
+        return rec.serialize(), status.HTTP_200_OK, {'ETag': f'"{row_etag(rec.id, rec.version)}"'}
 
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
+def json_response(data, code=status.HTTP_200_OK, headers=None):
+    """Encodes ``data`` with orjson, skipping flask-restx marshalling
+
+    For the hot list endpoints, whose rows are already serialized with
+    every field of their documented model
+    """
+    return Response(orjson.dumps(data), status=code, headers=headers, mimetype='application/json')
+
+
+def row_etag(rec_id, version, names=SERIALIZED_COLUMNS):
+    """Returns the ETag of a Recommendation at a version, or of a projection of it"""
+    if names == SERIALIZED_COLUMNS:
+        return f"{rec_id}-{version}"
+    return f"{rec_id}-{version}-{hashlib.blake2b(','.join(names).encode(), digest_size=4).hexdigest()}"
+
+
+def product_page(product_id, rec_type, after_id, limit, columns):
+    """Returns a page of a product's recommendations and the version of the whole list
+
+    Per-product lists are small and hot, so they come from the cache and
+    are versioned by their digest. Without the cache the version is read
+    first with one aggregate query, so a change before the page is read
+    tags the new rows with the old version rather than the reverse.
+    """
+    if list_cache.enabled:
+        rows = Recommendation.find_serialized(product_id, rec_type)
+        page = [row for row in rows if after_id is None or row[ID] > after_id][:limit]
+        return page, rows.digest
+    version = Recommendation.list_version(product_id, rec_type)
+    return Recommendation.find_rows(product_id, rec_type, after_id, limit, columns), version
+
+
+def not_modified(etag, headers=None):
+    """Returns a 304 response for a representation the client already has"""
+    response = Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.set_etag(etag)
+    return response
+
+
+def conditional_response(data, etag):
+    """Returns ``data`` with its ETag, or a 304 if it matches If-None-Match"""
+    cached = matching_etag(request.if_none_match, etag)
+    if cached is not None:
+        return not_modified(cached)
+    response = json_response(data)
+    response.set_etag(etag)
+    return response
+
+
+def if_match_version(id):
+    """Returns the version of a Recommendation named by the If-Match header
+
+    None when there is no If-Match header or it is "*"; the write then
+    applies to any version. Aborts with 412 if no ETag of the header is
+    one of this Recommendation's
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    prefix = f"{id}-"
+    for etag in map(strip_encoding, request.if_match.as_set()):
+        version = etag[len(prefix):]
+        if etag.startswith(prefix) and version.isdigit():
+            return int(version)
+    abort(
+        status.HTTP_412_PRECONDITION_FAILED,
+        f"Recommendation with id '{id}' has changed.",
+    )
+
+
 def init_db():
     """Initializes the SQLAlchemy app"""
     global app
     Recommendation.init_db(app)
 
 
+def init_like_buffer():
+    """Starts the write-behind like buffer if it is enabled in the config"""
+    global like_buffer
+    if like_buffer or not app.config.get("LIKE_BUFFER_ENABLED"):
+        return
+    like_buffer = LikeBuffer(
+        flush_likes,
+        interval_ms=app.config["LIKE_BUFFER_FLUSH_MS"],
+        max_events=app.config["LIKE_BUFFER_MAX_EVENTS"],
+    )
+    like_buffer.start()
+    atexit.register(like_buffer.stop)
+    logger.info("Like buffer started")
+
+
+def init_metrics():
+    """Starts counting requests, queries and cache lookups if it is enabled in the config"""
+    if not app.config.get("METRICS_ENABLED"):
+        return
+    RequestMetrics(app).start()
+    instrument_engine(db.engine)
+    # other workers report their caches when they serve a request
+    app.after_request(sync_cache_metrics)
+    logger.info("Metrics started")
+
+
+def init_profiler():
+    """Installs the request profiler if it is enabled in the config"""
+    global profiler
+    if profiler or not app.config.get("PROFILING_ENABLED"):
+        return
+    profiler = Profiler(
+        app.wsgi_app,
+        app.config["PROFILING_DIR"],
+        mode=app.config["PROFILING_MODE"],
+        token=app.config["PROFILING_TOKEN"],
+        sample_rate=app.config["PROFILING_SAMPLE_RATE"],
+        keep=app.config["PROFILING_KEEP"],
+        interval=app.config["PROFILING_INTERVAL_MS"] / 1000,
+    )
+    app.wsgi_app = profiler
+    logger.info("Profiler installed, writing to %s", profiler.folder)
+
+
+def sync_cache_metrics(response):
+    """Reports the cache lookups of this worker"""
+    cache_metrics.sync()
+    return response
+
+
+def init_adjacency():
+    """Loads the adjacency index if it is enabled in the config"""
+    if app.config.get("ADJACENCY_PRELOAD"):
+        Recommendation.load_adjacency()
+
+
+def init_cache_listener():
+    """Starts listening for cache invalidations from other workers"""
+    global cache_listener
+    if (
+        cache_listener
+        or not list_cache.enabled
+        or not app.config.get("CACHE_LISTEN_ENABLED")
+        or db.engine.dialect.name != "postgresql"
+    ):
+        return
+    cache_listener = CacheListener(
+        listen_connection,
+        Recommendation.notify_channel,
+        invalidate=handle_notification,
+        clear=clear_caches,
+    )
+    cache_listener.start()
+    atexit.register(cache_listener.stop)
+    logger.info("Cache listener started")
+
+
+def clear_caches():
+    """Drops all the cached data, as notifications may have been missed while disconnected"""
+    invalidate_product(ALL_PRODUCTS)
+
+
+def listen_connection():
+    """Returns an autocommit DBAPI connection kept outside the pool"""
+    with app.app_context():
+        connection = db.engine.raw_connection()
+    connection.detach()
+    dbapi_connection = connection.connection
+    dbapi_connection.autocommit = True
+    return dbapi_connection
+
+
+def flush_likes(deltas):
+    """Writes a batch of buffered like deltas to the database"""
+    with app.app_context():
+        Recommendation.apply_like_deltas(deltas)
+
+
+def buffer_like(id, delta):
+    """Buffers a like or unlike and returns the Recommendation as it will be"""
+    rec = Recommendation.find(id)
+    if not rec:
+        abort(
+            status.HTTP_404_NOT_FOUND,
+            f"Recommendation with id '{id}' was not found.",
+        )
+    like_buffer.add(rec.id, delta)
+    message = rec.serialize()
+    message[LIKE_NUM] = max(message[LIKE_NUM] + like_buffer.pending_delta(rec.id), 0)
+    logger.info("Like delta %s buffered for Recommendation [%s].", delta, rec.id)
+    return message
+
+
+def read_bulk_items():
+    """Reads the items of a bulk request from a JSON array or NDJSON body"""
+    if request.mimetype == "application/x-ndjson":
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                # keep the position so the error points at the right line
+                items.append(None)
+        return items
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise DataValidationError("Invalid request: body must be a JSON array of Recommendations")
+    return items
+
+
+def validated_row(data):
+    """Validates the fields and types of one Recommendation and returns its column values"""
+    if isinstance(data, dict):
+        data = {ID: None, **data}
+    rec = Recommendation().deserialize(data)
+    for name in (PRODUCT_ID, REC_ID, LIKE_NUM):
+        value = getattr(rec, name)
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise DataValidationError(f"Invalid Recommendation: {name} must be an integer, not {value!r}")
+    for name in (PRODUCT_NAME, REC_NAME):
+        value = getattr(rec, name)
+        if not isinstance(value, str):
+            raise DataValidationError(f"Invalid Recommendation: {name} must be a string, not {value!r}")
+    try:
+        rec_type = Type(rec.rec_type)
+    except ValueError as error:
+        raise DataValidationError(f"Invalid Recommendation: bad rec_type {rec.rec_type!r}") from error
+    return {
+        PRODUCT_ID: rec.product_id,
+        PRODUCT_NAME: rec.product_name,
+        REC_ID: rec.rec_id,
+        REC_NAME: rec.rec_name,
+        REC_TYPE: rec_type,
+        LIKE_NUM: rec.like_num,
+    }
+
+
+def parse_fields(value):
+    """Returns the SERIALIZED_COLUMNS named in a ?fields= value, all of them by default"""
+    names = tuple(dict.fromkeys(name.strip() for name in (value or "").split(",") if name.strip()))
+    unknown = [name for name in names if name not in SERIALIZED_COLUMNS]
+    if unknown:
+        raise DataValidationError(
+            f"Unknown fields {','.join(unknown)}: choose from {','.join(SERIALIZED_COLUMNS)}"
+        )
+    if not names or set(names) == set(SERIALIZED_COLUMNS):
+        return SERIALIZED_COLUMNS
+    return names
+
+
+def encode_cursor(last_id):
+    """Encodes the id of the last row on a page as an opaque cursor"""
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor back into the id to continue after"""
+    if not cursor:
+        return None
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError) as error:
+        raise DataValidationError(f"Invalid cursor '{cursor}'") from error
+
+
+def encode_watermark(watermark):
+    """Encodes an (updated_at, id) watermark as an opaque string"""
+    updated_at, last_id = watermark
+    return base64.urlsafe_b64encode(f"{updated_at.isoformat()}|{last_id}".encode()).decode()
+
+
+def decode_watermark(since):
+    """Decodes a watermark back into the (updated_at, id) to continue after"""
+    if not since:
+        return None
+    try:
+        updated_at, _, last_id = base64.urlsafe_b64decode(since.encode()).decode().partition("|")
+        updated_at = datetime.fromisoformat(updated_at)
+        if updated_at.tzinfo is None:
+            raise ValueError("naive timestamp")
+        return updated_at, int(last_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as error:
+        raise DataValidationError(f"Invalid watermark '{since}'") from error
+
+
+def check_retained(after):
+    """Aborts with 410 Gone if the deletes after a watermark are no longer tracked"""
+    retention = timedelta(days=app.config['TOMBSTONE_RETENTION_DAYS'])
+    if after is not None and after[0] < datetime.now(timezone.utc) - retention:
+        abort(
+            status.HTTP_410_GONE,
+            "Deletes this old are no longer tracked, export the recommendations again.",
+        )
+
+
+def check_profiles_access():
+    """Aborts unless profiling is enabled and the X-Profile header has the token
+
+    Without a token the profiles are only on disk, as they name the paths
+    and query strings of requests
+    """
+    if profiler is None:
+        abort(status.HTTP_404_NOT_FOUND, "Profiling is not enabled.")
+    if not profiler.token:
+        abort(status.HTTP_403_FORBIDDEN, "Set a PROFILING_TOKEN to read the profiles over HTTP.")
+    if not profiler.authorized(request.headers.get("X-Profile", "")):
+        abort(status.HTTP_403_FORBIDDEN, "The X-Profile header does not match the profiling token.")
+
+
 def check_content_type(media_type):
     """Checks that the media type is correct"""
     content_type = request.headers.get("Content-Type")
     if content_type and content_type == media_type:
         return
-    create_logger(app).error("Invalid Content-Type: %s", content_type)
+    logger.error("Invalid Content-Type: %s", content_type)
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
         "Content-Type must be {}".format(media_type),
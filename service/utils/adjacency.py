@@ -0,0 +1,314 @@
+"""
+Adjacency Index
+
+This module contains an in-memory index of the recommendation graph
+(product_id -> rec_id, with the rec_type and like_num of every edge)
+used for multi-hop "recommendations of recommendations" without a query
+per product.
+
+The whole table is loaded once into compressed sparse row (CSR) arrays:
+the products sorted in ``_products``, and the edges of the i-th product
+at ``_offsets[i]:_offsets[i + 1]`` of the edge arrays. Writes are applied
+to a small overlay of per-product edge lists that shadows the arrays and
+is merged back into them once it grows past a fraction of the products.
+Products changed in ways the index cannot apply itself are marked dirty
+and re-read, in one query per hop, the next time a traversal reaches them.
+"""
+import bisect
+import heapq
+import threading
+from array import array
+
+
+class AdjacencyIndex:
+    """CSR adjacency lists of the recommendation graph with a write overlay"""
+
+    def __init__(self, compact_ratio=0.1):
+        """
+        Args:
+            compact_ratio (float): the fraction of products held in the
+                overlay that triggers merging it into the arrays
+        """
+        self.compact_ratio = compact_ratio
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._loading = False
+        self._types = []  # rec_type of each type code
+        self._names = {}  # product_id -> name
+        self._reset()
+
+    def _reset(self):
+        """Empties the arrays and the overlay; the caller holds the lock"""
+        self._products = array("q")
+        self._offsets = array("q", [0])
+        self._edge_ids = array("q")
+        self._targets = array("q")
+        self._type_codes = array("b")
+        self._weights = array("q")
+        self._overlay = {}  # product_id -> list of (edge_id, rec_id, rec_type, like_num)
+        self._dirty = set()
+
+    ##################################################
+    # LOADING
+    ##################################################
+
+    def load(self, rows):
+        """
+        Builds the index from every recommendation
+
+        Args:
+            rows (iterable): (id, product_id, rec_id, rec_type, like_num,
+                product_name, rec_name) tuples ordered by product_id
+        """
+        with self._lock:
+            self._loading = True
+            self._dirty = set()
+        products, offsets = array("q"), array("q", [0])
+        edge_ids, targets, type_codes, weights = array("q"), array("q"), array("b"), array("q")
+        names = {}
+        try:
+            for edge_id, product_id, rec_id, rec_type, like_num, product_name, rec_name in rows:
+                if not products or products[-1] != product_id:
+                    if products:
+                        offsets.append(len(targets))
+                    products.append(product_id)
+                edge_ids.append(edge_id)
+                targets.append(rec_id)
+                type_codes.append(self._type_code(rec_type))
+                weights.append(like_num)
+                names[product_id] = product_name
+                names[rec_id] = rec_name
+            if products:
+                offsets.append(len(targets))
+        finally:
+            with self._lock:
+                self._loading = False
+        with self._lock:
+            # products changed while loading stay dirty and are re-read
+            dirty = self._dirty
+            self._reset()
+            self._dirty = dirty
+            self._products, self._offsets = products, offsets
+            self._edge_ids, self._targets = edge_ids, targets
+            self._type_codes, self._weights = type_codes, weights
+            self._names = names
+            self.loaded = True
+
+    def ensure_loaded(self, load):
+        """
+        Calls ``load`` to build the index unless it is already loaded
+
+        Only one caller loads at a time: the others wait for its load
+        rather than reading the whole table again themselves.
+        """
+        with self._load_lock:
+            if not self.loaded:
+                load()
+
+    def refresh(self, product_id, rows):
+        """
+        Replaces the edges of one product with freshly read rows
+
+        Args:
+            rows (iterable): the product's (id, product_id, rec_id,
+                rec_type, like_num, product_name, rec_name) tuples
+        """
+        edges = []
+        with self._lock:
+            for edge_id, _, rec_id, rec_type, like_num, product_name, rec_name in rows:
+                edges.append((edge_id, rec_id, rec_type, like_num))
+                self._names[product_id] = product_name
+                self._names[rec_id] = rec_name
+            self._dirty.discard(product_id)
+            self._replace(product_id, edges)
+
+    ##################################################
+    # WRITES
+    ##################################################
+
+    def invalidate(self, product_id):
+        """Marks a product whose edges changed to be re-read"""
+        with self._lock:
+            if self.loaded or self._loading:
+                self._dirty.add(product_id)
+
+    def clear(self):
+        """Drops the whole index so the next traversal reloads it"""
+        with self._lock:
+            self._reset()
+            self.loaded = False
+
+    def update_weight(self, product_id, edge_id, like_num):
+        """Sets the like count of one edge"""
+        with self._lock:
+            if not self.loaded:
+                self.invalidate(product_id)
+                return
+            edges = self.neighbors(product_id)
+            for index, edge in enumerate(edges):
+                if edge[0] == edge_id:
+                    edges = edges[:]
+                    edges[index] = (edge_id, edge[1], edge[2], like_num)
+                    self._replace(product_id, edges)
+                    break
+            else:
+                self._dirty.add(product_id)
+
+    def remove(self, product_id, edge_id):
+        """Removes a deleted edge"""
+        with self._lock:
+            if not self.loaded:
+                self.invalidate(product_id)
+                return
+            edges = self.neighbors(product_id)
+            self._replace(product_id, [edge for edge in edges if edge[0] != edge_id])
+
+    ##################################################
+    # READS
+    ##################################################
+
+    def neighbors(self, product_id):
+        """Returns the (edge_id, rec_id, rec_type, like_num) edges of a product"""
+        with self._lock:
+            edges = self._overlay.get(product_id)
+            if edges is not None:
+                return edges
+            index = bisect.bisect_left(self._products, product_id)
+            if index == len(self._products) or self._products[index] != product_id:
+                return []
+            return [
+                (self._edge_ids[i], self._targets[i], self._types[self._type_codes[i]], self._weights[i])
+                for i in range(self._offsets[index], self._offsets[index + 1])
+            ]
+
+    def dirty(self, product_ids):
+        """Returns the given products that must be re-read before use"""
+        with self._lock:
+            return [product_id for product_id in product_ids if product_id in self._dirty]
+
+    def name(self, product_id):
+        """Returns the name of a product, if the index has seen it"""
+        return self._names.get(product_id)
+
+    def traverse(self, source, depth=2, limit=20, rec_type=None, min_depth=1, read=None):
+        """
+        Ranks the products reachable from ``source`` within ``depth`` hops
+
+        Every product passes its score on to its recommendations in
+        proportion to their likes (like_num + 1, so unliked edges still
+        count, and negative counts weigh as 0), like a random walk
+        started at ``source``. Scores reaching a product by several paths
+        are summed, and every product is listed once, with the fewest
+        hops it was reached in.
+
+        Args:
+            source (int): the product to start from, never part of the result
+            depth (int): the number of hops to follow
+            limit (int): the number of products to return
+            rec_type: only follow edges of this rec_type
+            min_depth (int): leave out products reached in fewer hops,
+                e.g. 2 for second-degree recommendations only
+            read (callable): called with a list of dirty products and
+                returns {product_id: rows} to refresh them
+
+        Returns:
+            list: dicts of product_id, name, score, depth and via (the
+            product it was first reached from), highest score first
+        """
+        scores = {}
+        reached = {}  # product_id -> (depth, via)
+        frontier = {source: 1.0}
+        for hop in range(1, depth + 1):
+            self._refresh_dirty(list(frontier), read)
+            following = {}
+            for product_id, mass in frontier.items():
+                edges = [
+                    edge for edge in self.neighbors(product_id)
+                    if rec_type is None or edge[2] == rec_type
+                ]
+                # unlikes can take like_num below zero, which weighs as zero
+                total = sum(max(edge[3], 0) + 1 for edge in edges)
+                for _, rec_id, _, like_num in edges:
+                    if rec_id == source:
+                        continue
+                    share = mass * (max(like_num, 0) + 1) / total
+                    following[rec_id] = following.get(rec_id, 0.0) + share
+                    scores[rec_id] = scores.get(rec_id, 0.0) + share
+                    reached.setdefault(rec_id, (hop, product_id))
+            frontier = following
+            if not frontier:
+                break
+        ranked = heapq.nsmallest(
+            limit,
+            (product_id for product_id in scores if reached[product_id][0] >= min_depth),
+            key=lambda product_id: (-scores[product_id], product_id),
+        )
+        return [
+            {
+                "product_id": product_id,
+                "name": self.name(product_id),
+                "score": scores[product_id],
+                "depth": reached[product_id][0],
+                "via": reached[product_id][1],
+            }
+            for product_id in ranked
+        ]
+
+    def stats(self):
+        """Returns the size of the index"""
+        with self._lock:
+            return {
+                "products": len(self._products),
+                "edges": len(self._targets),
+                "overlay": len(self._overlay),
+                "dirty": len(self._dirty),
+            }
+
+    ##################################################
+    # HELPERS
+    ##################################################
+
+    def _refresh_dirty(self, product_ids, read):
+        """Re-reads the dirty products among ``product_ids`` in one call"""
+        dirty = self.dirty(product_ids)
+        if dirty and read is not None:
+            rows = read(dirty)
+            for product_id in dirty:
+                self.refresh(product_id, rows.get(product_id, ()))
+
+    def _type_code(self, rec_type):
+        """Returns the small integer stored for a rec_type"""
+        try:
+            return self._types.index(rec_type)
+        except ValueError:
+            self._types.append(rec_type)
+            return len(self._types) - 1
+
+    def _replace(self, product_id, edges):
+        """Puts a product's edges in the overlay; the caller holds the lock"""
+        self._overlay[product_id] = edges
+        if len(self._overlay) > max(self.compact_ratio * len(self._products), 64):
+            self._compact()
+
+    def _compact(self):
+        """Merges the overlay into the arrays; the caller holds the lock"""
+        products = sorted(set(self._products).union(self._overlay))
+        offsets = array("q", [0])
+        edge_ids, targets, type_codes, weights = array("q"), array("q"), array("b"), array("q")
+        kept = array("q")
+        for product_id in products:
+            edges = self.neighbors(product_id)
+            if not edges:
+                continue
+            kept.append(product_id)
+            for edge_id, rec_id, rec_type, like_num in edges:
+                edge_ids.append(edge_id)
+                targets.append(rec_id)
+                type_codes.append(self._type_code(rec_type))
+                weights.append(like_num)
+            offsets.append(len(targets))
+        self._products, self._offsets = kept, offsets
+        self._edge_ids, self._targets = edge_ids, targets
+        self._type_codes, self._weights = type_codes, weights
+        self._overlay = {}
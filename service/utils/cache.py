@@ -0,0 +1,141 @@
+"""
+Cache
+
+This module contains a thread-safe in-process LRU cache with a TTL.
+Entries are tagged (e.g. with a product id) so every entry for a tag can
+be invalidated at once, and each tag carries a generation counter that
+keeps a reader from storing a value it loaded before a concurrent write.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache with expiry, size limit and counters"""
+
+    def __init__(self, max_size=10000, ttl=30.0, enabled=True):
+        """
+        Args:
+            max_size (int): the number of entries kept before evicting
+            ttl (float): seconds an entry stays valid
+            enabled (bool): when False every lookup is a miss and nothing is stored
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires, tag, value)
+        self._tags = {}  # tag -> set of keys
+        self._generations = {}  # tag -> number of invalidations
+        self._epoch = 0  # number of clears
+        self._lock = threading.RLock()
+
+    def configure(self, max_size, ttl, enabled):
+        """Applies new settings and empties the cache"""
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self.enabled = enabled
+            self.clear()
+
+    def get(self, key):
+        """Returns the cached value for ``key`` or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def peek(self, key):
+        """Returns the cached value for ``key`` without counting a lookup"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[2]
+
+    def generation(self, tag):
+        """Returns the generation of ``tag``; read it before loading a value"""
+        with self._lock:
+            return (self._epoch, self._generations.get(tag, 0))
+
+    def put(self, key, value, tag=None, generation=None):
+        """
+        Stores ``value`` under ``key``
+
+        If ``generation`` is given and ``tag`` has been invalidated since it
+        was read, the value may be stale and is not stored
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(tag, 0)):
+                return
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, tag, value)
+            self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tag):
+        """Removes every entry stored with ``tag``"""
+        with self._lock:
+            if self.advance(tag):
+                for key in self._tags.pop(tag, ()):
+                    self._entries.pop(key, None)
+
+    def advance(self, tag):
+        """
+        Bumps the generation of ``tag`` without removing its entries
+
+        Used when the entries were updated in place: values loaded for
+        ``tag`` before the update are no longer stored by ``put``.
+        Returns False if the whole cache was cleared instead
+        """
+        with self._lock:
+            if len(self._generations) >= 10 * self.max_size:
+                # keep the generation counters bounded
+                self.clear()
+                return False
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            return True
+
+    def clear(self):
+        """Removes every entry"""
+        with self._lock:
+            self._epoch += 1
+            self._generations.clear()
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        """Returns the size and hit/miss counters of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        """Removes one entry; the caller holds the lock"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._tags.get(entry[1])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[entry[1]]
@@ -0,0 +1,94 @@
+"""
+Cache Listener
+
+This module contains a background listener that keeps the in-process
+list cache of every worker coherent. Writers send the changed product
+ids with PostgreSQL NOTIFY on commit; each worker LISTENs on the same
+channel and hands every payload to an invalidate function. Notifications
+sent while the listener is disconnected are lost, so the whole cache is
+cleared after every (re)connect.
+"""
+import logging
+import select
+import threading
+
+logger = logging.getLogger("flask.app")
+
+
+class CacheListener:
+    """Listens for change notifications and invalidates the local cache"""
+
+    def __init__(self, connect, channel, invalidate, clear, poll_seconds=1.0, max_backoff=30.0):
+        """
+        Args:
+            connect (callable): returns a new autocommit psycopg2 connection
+            channel (str): the NOTIFY channel to LISTEN on
+            invalidate (callable): called with each notification payload
+            clear (callable): empties the cache after a (re)connect
+            poll_seconds (float): how often the stop flag is checked
+            max_backoff (float): longest wait between reconnect attempts
+        """
+        self._connect = connect
+        self.channel = channel
+        self._invalidate = invalidate
+        self._clear = clear
+        self.poll_seconds = poll_seconds
+        self.max_backoff = max_backoff
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def dispatch(self, payloads):
+        """Invalidates the cache for a batch of notification payloads"""
+        for payload in payloads:
+            try:
+                self._invalidate(payload)
+            except ValueError:
+                logger.warning("Ignoring cache notification %r", payload)
+
+    def start(self):
+        """Starts the background thread that listens for notifications"""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="cache-listener", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """Connect and listen loop run by the background thread"""
+        backoff = 0.5
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+                backoff = 0.5
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Cache listener disconnected: %s", error)
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def _listen(self):
+        """Listens on one connection until it fails or the listener is stopped"""
+        connection = self._connect()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN "{self.channel}"')
+            # anything sent before LISTEN took effect was missed
+            self._clear()
+            logger.info("Cache listener listening on %s", self.channel)
+            while not self._stopped.is_set():
+                if select.select([connection], [], [], self.poll_seconds) == ([], [], []):
+                    continue
+                connection.poll()
+                payloads = [notify.payload for notify in connection.notifies]
+                connection.notifies.clear()
+                self.dispatch(payloads)
+        finally:
+            connection.close()
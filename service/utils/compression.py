@@ -0,0 +1,238 @@
+"""
+Compression
+
+This module contains the negotiated compression of responses: gzip, and
+brotli when the optional brotli package is installed. Buffered responses
+are compressed in one call once they reach a minimum size; streamed
+responses are compressed chunk by chunk as they are sent.
+
+It also serves the static files. Compressible static files are
+compressed once, at the highest level, and the compressed copies are
+kept in memory and served from there. URLs carrying the file's
+fingerprint (``?v=``) never change content, so they can be cached as
+immutable.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import zlib
+
+from flask import Response, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Content-Encodings in order of preference
+ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+# the ETag suffixes of the encoded representations, brotli's included as
+# another worker may have it installed
+ETAG_SUFFIXES = ("-br", "-gzip")
+
+# Types worth compressing; images and fonts are compressed already
+COMPRESSIBLE_TYPES = frozenset((
+    "application/javascript",
+    "application/json",
+    "application/x-ndjson",
+    "image/svg+xml",
+    "text/css",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+))
+
+# Compression levels of responses, a trade of CPU time for bytes, and of the
+# static files, which are compressed only once
+RESPONSE_LEVELS = {"br": 4, "gzip": 6}
+STATIC_LEVELS = {"br": 11, "gzip": 9}
+
+# href="static/..." and src="static/..." references in an HTML page
+STATIC_REFERENCE = re.compile(r"""((?:href|src)\s*=\s*["'])(static/([^"'?#]+))""")
+
+
+def negotiate(accept_encodings, encodings=ENCODINGS):
+    """Returns the encoding the client prefers, or None to send it uncompressed"""
+    return accept_encodings.best_match(encodings)
+
+
+def compress_stream(chunks, encoding, level):
+    """Compresses an iterable of bytes, yielding the compressed bytes"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+        process, finish = compressor.process, compressor.finish
+    else:
+        # wbits 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = process(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compress(data, encoding, level):
+    """Returns ``data`` compressed with ``encoding``"""
+    return b"".join(compress_stream((data,), encoding, level))
+
+
+def compress_response(response, accept_encodings, min_size=1024, levels=RESPONSE_LEVELS):
+    """
+    Compresses a response in place if the client accepts it
+
+    Each encoding is a representation of its own, so a strong ETag gets
+    the encoding as a suffix ("5-3" becomes "5-3-gzip"); matching_etag()
+    and strip_encoding() read it back.
+
+    Args:
+        response (Response): the response to compress
+        accept_encodings (Accept): the request's Accept-Encoding header
+        min_size (int): buffered responses smaller than this many bytes
+            are sent uncompressed, where compression saves nothing
+        levels (dict): the compression level of each encoding
+
+    Returns:
+        Response: the same response
+    """
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate(accept_encodings)
+    if encoding is None:
+        return response
+    level = levels[encoding]
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding, level))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(f"{etag}-{encoding}")
+    return response
+
+
+def strip_encoding(etag):
+    """Returns an ETag without the encoding suffix compress_response() gives it"""
+    for suffix in ETAG_SUFFIXES:
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)]
+    return etag
+
+
+def matching_etag(etags, etag):
+    """Returns the tag of ``etags`` naming any encoding of ``etag``, weakly compared, or None"""
+    if etags.star_tag:
+        return etag
+    return next((tag for tag in etags.as_set(include_weak=True) if strip_encoding(tag) == etag), None)
+
+
+class StaticFiles:
+    """The static folder, served with compressed copies and fingerprinted URLs"""
+
+    def __init__(self, folder, max_age=31536000):
+        """
+        Args:
+            folder (str): the static folder
+            max_age (int): the seconds fingerprinted URLs are cached for
+        """
+        self.folder = folder
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # (path, encoding) -> (stat key, content); encoding None for the digest
+        self._copies = {}
+
+    def fingerprint(self, filename):
+        """Returns a digest of a static file's content, or None if there is no such file"""
+        path = safe_join(self.folder, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        return self._copy(path, None)
+
+    def versioned(self, html):
+        """Adds the fingerprint to the static file references of an HTML page"""
+        def add_version(match):
+            version = self.fingerprint(match.group(3))
+            if version is None:
+                return match.group(0)
+            return f"{match.group(1)}{match.group(2)}?v={version}"
+        return STATIC_REFERENCE.sub(add_version, html)
+
+    def page(self, filename, request):
+        """Serves an HTML page of the static folder with fingerprinted references"""
+        path = safe_join(self.folder, filename)
+        if path is None or not os.path.isfile(path):
+            raise NotFound()
+        with open(path, encoding="utf-8") as page:
+            body = self.versioned(page.read()).encode()
+        response = Response(body, mimetype="text/html")
+        response.set_etag(hashlib.blake2b(body, digest_size=16).hexdigest())
+        # the page names the current assets, so it is always revalidated
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def send(self, filename, request):
+        """
+        Serves a static file, compressed if the client accepts it
+
+        Requests whose ``v`` argument is the file's fingerprint are cached
+        for ``max_age`` seconds as immutable; others are revalidated.
+        """
+        path = safe_join(self.folder, filename)
+        if path is None or not os.path.isfile(path):
+            raise NotFound()
+        version = self._copy(path, None)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        encoding = None
+        if mimetype in COMPRESSIBLE_TYPES:
+            encoding = negotiate(request.accept_encodings)
+        if encoding is None:
+            response = send_from_directory(self.folder, filename, conditional=False, etag=False)
+        else:
+            response = Response(self._copy(path, encoding), mimetype=mimetype)
+            response.headers["Content-Encoding"] = encoding
+        if mimetype in COMPRESSIBLE_TYPES:
+            response.vary.add("Accept-Encoding")
+        response.set_etag(version if encoding is None else f"{version}-{encoding}")
+        response.cache_control.no_cache = None
+        if request.args.get("v") == version:
+            response.cache_control.public = True
+            response.cache_control.max_age = self.max_age
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def _copy(self, path, encoding):
+        """Returns the digest (encoding None) or compressed copy of a file, read once per change"""
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._copies.get((path, encoding))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with open(path, "rb") as source:
+            data = source.read()
+        if encoding is None:
+            content = hashlib.blake2b(data, digest_size=8).hexdigest()
+        else:
+            content = compress(data, encoding, STATIC_LEVELS[encoding])
+        with self._lock:
+            self._copies[(path, encoding)] = (key, content)
+        return content
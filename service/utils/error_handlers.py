@@ -17,8 +17,10 @@
 """
 Module: error_handlers
 """
+from sqlalchemy import exc
+
 from service import app, api
-from service.models import DataValidationError, DatabaseConnectionError
+from service.models import DataConflictError, DataValidationError, DatabaseConnectionError
 from . import status
 
 
@@ -37,6 +39,18 @@ def request_validation_error(error):
     }, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(DataConflictError)
+def data_conflict_error(error):
+    """ Handles writes that would duplicate an existing Recommendation """
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_409_CONFLICT,
+        'error': 'Conflict',
+        'message': message
+    }, status.HTTP_409_CONFLICT
+
+
 @api.errorhandler(DatabaseConnectionError)
 def database_connection_error(error):
     """ Handles Database Errors from connection attempts """
@@ -47,3 +61,30 @@ def database_connection_error(error):
         'error': 'Service Unavailable',
         'message': message
     }, status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+# the SQLSTATE of a statement cancelled by statement_timeout, psycopg2's QueryCanceled
+QUERY_CANCELED = "57014"
+
+
+@api.errorhandler(exc.TimeoutError)
+@api.errorhandler(exc.OperationalError)
+def database_unavailable(error):
+    """ Handles an exhausted connection pool or an unreachable database """
+    if getattr(getattr(error, "orig", None), "pgcode", None) == QUERY_CANCELED:
+        return statement_timeout(error)
+    app.logger.error("Database unavailable: %s", error)
+    body, code = database_connection_error(
+        DatabaseConnectionError("The database is unavailable, please retry later")
+    )
+    return body, code, {"Retry-After": "1"}
+
+
+def statement_timeout(error):
+    """ Handles a statement the database cancelled for running too long """
+    app.logger.error("Statement timed out: %s", error)
+    return {
+        'status_code': status.HTTP_504_GATEWAY_TIMEOUT,
+        'error': 'Gateway Timeout',
+        'message': 'The database took too long to answer and the query was cancelled'
+    }, status.HTTP_504_GATEWAY_TIMEOUT
@@ -0,0 +1,103 @@
+"""
+Like Buffer
+
+This module contains a write-behind buffer for like/unlike counters.
+Likes are accumulated per recommendation id in memory and handed to a
+flush function as one batch of {id: delta} every ``interval_ms``
+milliseconds, whenever ``max_events`` events have been buffered, and
+when the buffer is stopped.
+"""
+import logging
+import threading
+
+logger = logging.getLogger("flask.app")
+
+
+class LikeBuffer:
+    """Accumulates like deltas per id and flushes them in batches"""
+
+    def __init__(self, flush, interval_ms=500, max_events=1000):
+        """
+        Args:
+            flush (callable): called with a dict of {id: delta} to persist
+            interval_ms (int): maximum time a delta stays in the buffer
+            max_events (int): number of buffered events that forces a flush
+        """
+        self._flush = flush
+        self.interval = interval_ms / 1000.0
+        self.max_events = max_events
+        self._deltas = {}
+        self._events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, rec_id, delta):
+        """Buffers a like (+1) or unlike (-1) for a recommendation"""
+        with self._lock:
+            self._deltas[rec_id] = self._deltas.get(rec_id, 0) + delta
+            self._events += 1
+            full = self._events >= self.max_events
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        """Returns the number of recommendations with unflushed deltas"""
+        with self._lock:
+            return len(self._deltas)
+
+    def pending_delta(self, rec_id):
+        """Returns the unflushed delta for one recommendation"""
+        with self._lock:
+            return self._deltas.get(rec_id, 0)
+
+    def flush(self):
+        """Writes all buffered deltas and returns how many ids were flushed"""
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, {}
+                self._events = 0
+            deltas = {rec_id: delta for rec_id, delta in deltas.items() if delta}
+            if not deltas:
+                return 0
+            try:
+                self._flush(deltas)
+            except Exception:
+                # put the deltas back so they are retried on the next flush
+                with self._lock:
+                    for rec_id, delta in deltas.items():
+                        self._deltas[rec_id] = self._deltas.get(rec_id, 0) + delta
+                raise
+            logger.debug("Flushed likes for %d recommendations", len(deltas))
+            return len(deltas)
+
+    def start(self):
+        """Starts the background thread that flushes periodically"""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="like-buffer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and flushes whatever is left"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        """Flush loop run by the background thread"""
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Like buffer flush failed: %s", error)
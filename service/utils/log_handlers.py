@@ -18,19 +18,147 @@
 Log Handlers
 
 This module contains utility functions to set up logging
-consistently
+consistently. Request threads only put records on a queue; a
+QueueListener thread formats them, as JSON lines by default, and writes
+them to gunicorn's handlers. INFO lines of hot endpoints can be sampled.
 """
+import atexit
+import contextvars
+import copy
 import logging
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
+from flask import request
+
+# the module loggers of the service, besides the app's own logger
+LOGGER_NAMES = ("flask.app",)
+
+# the attributes of every LogRecord; any other one was passed with extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON object on one line, with its extra= fields"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a share of the INFO records logged while serving some endpoints
+
+    The choice is made once per request, in start_request, so the lines
+    of a request are kept or dropped together and checking a record is a
+    context variable lookup. Other levels, and records logged outside
+    requests, are always kept.
+    """
+
+    def __init__(self, rates, rand=random.random):
+        """
+        Args:
+            rates (dict): maps an endpoint name to the share of its requests logged
+            rand (callable): returns a float in [0, 1)
+        """
+        super().__init__()
+        self.rates = dict(rates)
+        self._random = rand
+        self._keep = contextvars.ContextVar("log_sampled", default=True)
+
+    def start_request(self):
+        """Draws whether the INFO lines of the current request are kept"""
+        rate = self.rates.get(request.endpoint)
+        self._keep.set(rate is None or self._random() < rate)
+
+    def end_request(self, _error=None):
+        """Keeps the records logged after the request again"""
+        self._keep.set(True)
+
+    def filter(self, record):
+        return record.levelno != logging.INFO or self._keep.get()
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    A QueueHandler that leaves the formatting to the listener thread
+
+    Only the message is merged with its arguments here, since they may
+    change once the call returns, and a traceback is rendered while it
+    still exists
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogListener(QueueListener):
+    """A QueueListener that can be stopped again, e.g. at exit after a test stopped it"""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
 
 
 def init_logging(app, logger_name: str):
-    """Set up logging for production"""
-    app.logger.propagate = False
+    """Set up logging for production
+
+    The app logger and LOGGER_NAMES hand their records to a queue whose
+    listener thread writes them to the handlers of ``logger_name``. Without
+    such handlers (flask run, tests) Flask's default logging is left alone
+
+    Returns:
+        LogListener: the started listener, or None
+    """
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    handlers = list(gunicorn_logger.handlers)
+    if not handlers:
+        return None
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT", "json") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, "%Y-%m-%d %H:%M:%S %z")
+    for handler in handlers:
         handler.setFormatter(formatter)
+    queue_handler = AsyncQueueHandler(queue.SimpleQueue())
+    sampling = SamplingFilter(app.config.get("LOG_SAMPLE_RATES", {}))
+    if sampling.rates:
+        queue_handler.addFilter(sampling)
+        app.before_request(sampling.start_request)
+        app.teardown_request(sampling.end_request)
+    listener = LogListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    for logger in (app.logger, *(logging.getLogger(name) for name in LOGGER_NAMES)):
+        logger.propagate = False
+        logger.handlers = [queue_handler]
+        logger.setLevel(gunicorn_logger.level)
+    listener.start()
+    # flushes the queue on shutdown
+    atexit.register(listener.stop)
     app.logger.info("Logging handler established")
+    return listener
@@ -0,0 +1,214 @@
+"""
+Metrics
+
+This module contains the Prometheus metrics of the service: requests and
+their latency per resource, SQL statements and their duration, the wait
+for a pooled connection, and cache hits and misses.
+
+Under gunicorn every worker writes its samples to memory-mapped files in
+PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py) and render() adds
+up the files of all the workers; without it the samples are this
+process's own.
+"""
+import contextvars
+import os
+import threading
+import time
+
+from flask import request
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+
+from service.utils.query_log import query_log
+
+# Latency buckets in seconds, from a cached read to a slow bulk request, and
+# from an index lookup to a full scan
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+
+# SQL statements are labelled by their first keyword, one of these or OTHER
+OPERATIONS = frozenset(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "COPY"))
+
+# the resource label of requests that matched no route
+UNMATCHED = "unmatched"
+
+# the time the current request started, per thread or greenlet
+_request_start = contextvars.ContextVar("request_start", default=None)
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests served", ("resource", "method", "status")
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent serving HTTP requests",
+    ("resource", "method"), buckets=REQUEST_BUCKETS,
+)
+QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "Time spent executing SQL statements, counted by operation",
+    ("operation",), buckets=QUERY_BUCKETS,
+)
+POOL_WAIT = Histogram(
+    "db_pool_checkout_duration_seconds", "Time spent waiting for a pooled database connection",
+    buckets=QUERY_BUCKETS,
+)
+POOL_IN_USE = Gauge(
+    "db_pool_connections_in_use", "Database connections checked out of the pool",
+    multiprocess_mode="livesum",
+)
+CACHE_HITS = Counter("cache_hits_total", "Cache lookups that found an entry", ("cache",))
+CACHE_MISSES = Counter("cache_misses_total", "Cache lookups that found no entry", ("cache",))
+
+# the statement histograms by operation, labelled once
+_QUERY_LATENCIES = {operation: QUERY_LATENCY.labels(operation) for operation in OPERATIONS}
+_OTHER_QUERY_LATENCY = QUERY_LATENCY.labels("OTHER")
+
+
+class RequestMetrics:
+    """Counts and times the requests of a Flask app per resource"""
+
+    def __init__(self, app):
+        self.app = app
+        # endpoint -> resource name, and the labelled children of the metrics
+        self._resources = {}
+        self._latencies = {}
+        self._counts = {}
+
+    def start(self):
+        """Registers the request hooks on the app"""
+        self.app.before_request(self.before_request)
+        # after_request functions run in reverse order: first in the list
+        # runs last, so the time spent compressing the response is included
+        self.app.after_request_funcs.setdefault(None, []).insert(0, self.after_request)
+
+    def resource(self, endpoint):
+        """Returns the label of an endpoint: its flask-restx Resource class, or the endpoint"""
+        name = self._resources.get(endpoint)
+        if name is None:
+            view_class = getattr(self.app.view_functions.get(endpoint), "view_class", None)
+            name = view_class.__name__ if view_class is not None else endpoint or UNMATCHED
+            self._resources[endpoint] = name
+        return name
+
+    def before_request(self):
+        """Notes when the request started"""
+        _request_start.set(time.perf_counter())
+
+    def after_request(self, response):
+        """Counts the request and records how long it took"""
+        start = _request_start.get()
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        _request_start.set(None)
+        key = (self.resource(request.endpoint), request.method)
+        latency = self._latencies.get(key)
+        if latency is None:
+            latency = self._latencies[key] = REQUEST_LATENCY.labels(*key)
+        latency.observe(elapsed)
+        key += (response.status_code,)
+        count = self._counts.get(key)
+        if count is None:
+            count = self._counts[key] = REQUESTS.labels(*key)
+        count.inc()
+        return response
+
+
+class CacheMetrics:
+    """
+    Reports the hit and miss counters of LRU caches as Prometheus counters
+
+    The caches count lookups themselves; sync() adds what they counted
+    since the last call, so their hot path is left alone
+    """
+
+    def __init__(self, caches):
+        """
+        Args:
+            caches (dict): maps a cache label to an LRUCache
+        """
+        self.caches = dict(caches)
+        self._seen = {name: (0, 0) for name in self.caches}
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """Adds the hits and misses counted since the last sync"""
+        # a sync already running in another thread reports them
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            for name, cache in self.caches.items():
+                hits, misses = cache.hits, cache.misses
+                seen_hits, seen_misses = self._seen[name]
+                if hits != seen_hits:
+                    CACHE_HITS.labels(name).inc(hits - seen_hits if hits > seen_hits else hits)
+                if misses != seen_misses:
+                    CACHE_MISSES.labels(name).inc(misses - seen_misses if misses > seen_misses else misses)
+                self._seen[name] = (hits, misses)
+        finally:
+            self._lock.release()
+
+
+def instrument_engine(engine):
+    """Times the SQL statements of an engine and the wait for its pooled connections"""
+    # the statements are timed once, by the query log
+    query_log.instrument(engine)
+    query_log.add_observer(observe_statement)
+    event.listen(engine, "checkout", _checkout)
+    event.listen(engine, "checkin", _checkin)
+    event.listen(engine, "engine_disposed", lambda _: _time_pool(engine))
+    _time_pool(engine)
+
+
+def observe_statement(statement, elapsed):
+    """Records how long a statement took, by operation"""
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement else ""
+    _QUERY_LATENCIES.get(operation, _OTHER_QUERY_LATENCY).observe(elapsed)
+
+
+def render():
+    """Returns the samples of every worker in the Prometheus text format"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    """Counts a connection taken from the pool"""
+    POOL_IN_USE.inc()
+
+
+def _checkin(dbapi_connection, connection_record):
+    """Counts a connection returned to the pool"""
+    POOL_IN_USE.dec()
+
+
+def _time_pool(engine):
+    """Wraps the connect() of the engine's current pool to time the wait for a connection"""
+    pool = engine.pool
+    connect = pool.connect
+    if getattr(connect, "timed", False):
+        return
+
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - start)
+
+    timed_connect.timed = True
+    pool.connect = timed_connect
@@ -0,0 +1,214 @@
+"""
+Profiling
+
+This module contains the opt-in profiling of single requests. Profiler
+is a WSGI middleware, installed only when profiling is enabled, that
+profiles the requests carrying the X-Profile token and a sampled share
+of the others, and saves each profile to a local folder:
+  sample:   a stack sampler thread; folded stacks ("a;b;c count" lines)
+            for flamegraph.pl, speedscope or inferno
+  cprofile: cProfile; pstats files for pstats, snakeviz or flameprof
+Each profile has a JSON sidecar describing the request, listed by recent().
+"""
+import cProfile
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from werkzeug.wsgi import ClosingIterator
+
+# the request header naming a request to profile, as found in the WSGI environ
+PROFILE_HEADER = "HTTP_X_PROFILE"
+
+# the file extension of the profiles of each mode
+EXTENSIONS = {"sample": "folded", "cprofile": "prof"}
+
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled every ``interval`` seconds from another"""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        """Starts sampling"""
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and waits for the sampler thread"""
+        self._stop.set()
+        self._thread.join()
+
+    def save(self, path):
+        """Writes the stacks in the folded format, one "frame;frame;frame count" line each"""
+        with open(path, "w", encoding="utf-8") as folded:
+            for stack, count in self.stacks.most_common():
+                folded.write(f"{stack} {count}\n")
+
+    def _run(self):
+        """Samples the stack of the profiled thread until stopped"""
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+            if frame is not None:
+                self.stacks[fold(frame)] += 1
+
+
+class CProfileCollector:
+    """Runs cProfile on the current thread"""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        """Starts profiling"""
+        self.profile.enable()
+
+    def stop(self):
+        """Stops profiling"""
+        self.profile.disable()
+
+    def save(self, path):
+        """Writes the pstats file"""
+        self.profile.dump_stats(path)
+
+
+class Profiler:
+    """
+    WSGI middleware profiling some requests into a folder
+
+    Requests whose X-Profile header is the token are profiled, and so is
+    a ``sample_rate`` share of all requests. A streamed response is
+    profiled until it has been sent.
+    """
+
+    def __init__(self, wsgi_app, folder, mode="sample", token="", sample_rate=0.0, keep=100,
+                 interval=0.005, rand=random.random):
+        """
+        Args:
+            wsgi_app: the application to profile
+            folder (str): the folder the profiles are saved to
+            mode (str): "sample" for folded stacks or "cprofile" for pstats files
+            token (str): the X-Profile value asking for a profile, "" to only sample
+            sample_rate (float): the share of requests profiled without asking
+            keep (int): the number of profiles kept, the oldest are deleted
+            interval (float): the seconds between two stack samples
+            rand (callable): returns a float in [0, 1)
+        """
+        if mode not in EXTENSIONS:
+            raise ValueError(f"Unknown profiling mode '{mode}': choose from {', '.join(EXTENSIONS)}")
+        self.wsgi_app = wsgi_app
+        self.folder = folder
+        self.mode = mode
+        self.token = token
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.interval = interval
+        self._random = rand
+        os.makedirs(folder, exist_ok=True)
+
+    def __call__(self, environ, start_response):
+        if not self.wanted(environ):
+            return self.wsgi_app(environ, start_response)
+        return self._profile(environ, start_response)
+
+    def wanted(self, environ):
+        """Returns True if the request should be profiled"""
+        header = environ.get(PROFILE_HEADER)
+        if header is not None and self.authorized(header):
+            return True
+        return self.sample_rate > 0 and self._random() < self.sample_rate
+
+    def authorized(self, token):
+        """Returns True if ``token`` is the profiling token"""
+        return bool(self.token) and hmac.compare_digest(token.encode(), self.token.encode())
+
+    def recent(self, limit=50):
+        """Returns the descriptions of the newest profiles, newest first"""
+        names = sorted((name for name in os.listdir(self.folder) if name.endswith(".json")), reverse=True)
+        profiles = []
+        for name in names[:limit]:
+            try:
+                with open(os.path.join(self.folder, name), encoding="utf-8") as sidecar:
+                    profiles.append(json.load(sidecar))
+            except (OSError, ValueError):
+                continue  # deleted or being written by another worker
+        return profiles
+
+    def _profile(self, environ, start_response):
+        """Serves the request under a profiler and saves the profile once it is sent"""
+        if self.mode == "cprofile":
+            collector = CProfileCollector()
+        else:
+            collector = StackSampler(threading.get_ident(), self.interval)
+        statuses = []
+
+        def capture(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        start = time.perf_counter()
+        collector.start()
+        try:
+            app_iter = self.wsgi_app(environ, capture)
+        except Exception:
+            collector.stop()
+            raise
+
+        def finish():
+            collector.stop()
+            self._save(collector, environ, statuses[-1] if statuses else None, time.perf_counter() - start)
+
+        return ClosingIterator(app_iter, finish)
+
+    def _save(self, collector, environ, status, elapsed):
+        """Writes a profile and its description, then drops the oldest profiles"""
+        created = datetime.now(timezone.utc)
+        name = f"{created:%Y%m%dT%H%M%S.%f}-{os.getpid()}"
+        filename = f"{name}.{EXTENSIONS[self.mode]}"
+        collector.save(os.path.join(self.folder, filename))
+        description = {
+            "name": name,
+            "file": filename,
+            "mode": self.mode,
+            "method": environ.get("REQUEST_METHOD"),
+            "path": environ.get("PATH_INFO"),
+            "query": environ.get("QUERY_STRING", ""),
+            "status": int(status.split(None, 1)[0]) if status else None,
+            "duration_ms": round(elapsed * 1000, 3),
+            "created": created.isoformat(),
+            "pid": os.getpid(),
+        }
+        with open(os.path.join(self.folder, f"{name}.json"), "w", encoding="utf-8") as sidecar:
+            json.dump(description, sidecar)
+        self._prune()
+
+    def _prune(self):
+        """Deletes the profiles beyond the ``keep`` newest"""
+        names = sorted((name for name in os.listdir(self.folder) if name.endswith(".json")), reverse=True)
+        for name in names[self.keep:]:
+            stem = name[:-len(".json")]
+            for extension in ("json", *EXTENSIONS.values()):
+                try:
+                    os.remove(os.path.join(self.folder, f"{stem}.{extension}"))
+                except FileNotFoundError:
+                    pass
+
+
+def fold(frame):
+    """Returns a stack as "outermost;...;innermost" frames named function (file:line)"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
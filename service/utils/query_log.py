@@ -0,0 +1,170 @@
+"""
+Query Log
+
+This module contains the per-request accounting of SQL statements, driven
+by the engine's cursor events: statements slower than a threshold are
+logged with their parameters and the route that issued them, and
+requests that issue more than a number of statements, the signature of
+an N+1 query pattern, are flagged.
+
+The query log owns the only timing of statements: other consumers, such
+as the Prometheus metrics, register an observer instead of timing them
+again.
+
+Tests use the same accounting as an assertion:
+
+    with assert_max_queries(1):
+        client.get("/api/recommendations/1")
+"""
+import contextlib
+import contextvars
+import logging
+import time
+
+from flask import request
+from sqlalchemy import event
+
+logger = logging.getLogger("flask.app")
+
+# the longest parameter list written to a slow query line
+MAX_PARAMETERS_LENGTH = 1000
+
+
+class QueryStats:
+    """The statements counted for a request or an assertion"""
+
+    def __init__(self, route=None, keep_statements=False):
+        self.route = route
+        self.count = 0
+        self.duration = 0.0
+        # the statements themselves, only kept for assertions
+        self.statements = [] if keep_statements else None
+        self.token = None
+
+    def add(self, statement, elapsed):
+        """Counts one statement that took ``elapsed`` seconds"""
+        self.count += 1
+        self.duration += elapsed
+        if self.statements is not None:
+            self.statements.append(statement)
+
+
+# the QueryStats counting the current statements, innermost last
+_active = contextvars.ContextVar("query_stats", default=())
+
+
+class QueryLog:
+    """Logs slow statements and flags requests issuing too many statements"""
+
+    def __init__(self, slow_ms=200.0, max_queries=10):
+        """
+        Args:
+            slow_ms (float): statements taking this long are logged, 0 for none
+            max_queries (int): requests issuing more statements are flagged, 0 for none
+        """
+        self.slow_ms = slow_ms
+        self.max_queries = max_queries
+        self._apps = set()
+        # called with each statement and the seconds it took
+        self._observers = []
+
+    def configure(self, slow_ms, max_queries):
+        """Changes the thresholds"""
+        self.slow_ms = slow_ms
+        self.max_queries = max_queries
+
+    def add_observer(self, observer):
+        """Has ``observer(statement, elapsed)`` called for every statement timed, once"""
+        if observer not in self._observers:
+            self._observers.append(observer)
+
+    def instrument(self, engine):
+        """Times the statements of ``engine``, once"""
+        if not event.contains(engine, "after_cursor_execute", _after_cursor_execute):
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    def init_app(self, app, engine):
+        """Counts the statements of ``engine`` and the requests of ``app``, once each"""
+        self.instrument(engine)
+        if id(app) not in self._apps:
+            self._apps.add(id(app))
+            app.before_request(self.start_request)
+            app.teardown_request(self.end_request)
+
+    def start_request(self):
+        """Starts counting the statements of the current request"""
+        stats = QueryStats(f"{request.method} {request.url_rule or request.path}")
+        stats.token = _active.set(_active.get() + (stats,))
+
+    def end_request(self, _error=None):
+        """Flags the current request if it issued too many statements"""
+        stats = next((stats for stats in reversed(_active.get()) if stats.route is not None), None)
+        if stats is None:
+            return
+        _active.reset(stats.token)
+        if self.max_queries and stats.count > self.max_queries:
+            logger.warning(
+                "%s issued %d queries in %.1f ms, more than %d: N+1 query pattern?",
+                stats.route, stats.count, stats.duration * 1000, self.max_queries,
+                extra={"route": stats.route, "queries": stats.count, "duration_ms": stats.duration * 1000},
+            )
+
+    def record(self, statement, parameters, elapsed):
+        """Counts a statement for the observers, active requests and assertions, and logs it if slow"""
+        for observer in self._observers:
+            observer(statement, elapsed)
+        active = _active.get()
+        for stats in active:
+            stats.add(statement, elapsed)
+        if self.slow_ms and elapsed * 1000 >= self.slow_ms:
+            route = next((stats.route for stats in reversed(active) if stats.route is not None), None)
+            shown = repr(parameters)
+            if len(shown) > MAX_PARAMETERS_LENGTH:
+                shown = shown[:MAX_PARAMETERS_LENGTH] + "..."
+            logger.warning(
+                "Slow query (%.1f ms) from %s: %s parameters %s",
+                elapsed * 1000, route or "outside a request", " ".join(statement.split()), shown,
+                extra={"route": route, "duration_ms": elapsed * 1000},
+            )
+
+
+# The query log of the service, configured in Recommendation.init_db()
+query_log = QueryLog()
+
+
+@contextlib.contextmanager
+def count_queries():
+    """Counts the statements executed in the block, yielding their QueryStats"""
+    stats = QueryStats(keep_statements=True)
+    token = _active.set(_active.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _active.reset(token)
+
+
+@contextlib.contextmanager
+def assert_max_queries(limit):
+    """Fails with the statements if the block executes more than ``limit`` of them"""
+    with count_queries() as stats:
+        yield stats
+    if stats.count > limit:
+        listing = "\n".join(f"  {statement}" for statement in stats.statements)
+        raise AssertionError(f"{stats.count} queries executed, expected at most {limit}:\n{listing}")
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Notes when a statement started on its execution context"""
+    if context is not None:
+        context.query_log_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Hands a finished statement to the query log"""
+    start = getattr(context, "query_log_start", None)
+    if start is not None:
+        query_log.record(statement, parameters, time.perf_counter() - start)
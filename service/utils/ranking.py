@@ -0,0 +1,84 @@
+"""
+Ranking
+
+This module contains the precomputed top-K list of one product: its
+recommendations ordered by like_num (highest first, ties by id), bounded
+to ``depth`` rows. A ranking is loaded once from the database and then
+maintained in place as rows are liked, unliked and deleted, so reading
+the top K is a slice instead of an ORDER BY.
+
+When a product has more than ``depth`` recommendations only the best
+rows are held. Those always stay the exact top of the product: a row
+that drops below the last held row simply leaves the ranking, which then
+holds fewer rows. Once it can no longer answer a request for K rows,
+``top`` returns None and the caller reloads it.
+"""
+import bisect
+import threading
+
+
+def rank_key(row):
+    """Returns the sort key of a serialized recommendation, best first"""
+    return (-row["like_num"], row["id"])
+
+
+class Ranking:
+    """The best recommendations of one product, kept in rank order"""
+
+    def __init__(self, rows, depth):
+        """
+        Args:
+            rows (list): serialized rows in rank order; loading one more
+                than ``depth`` tells whether the product has more rows
+            depth (int): the number of rows held
+        """
+        self.depth = depth
+        # True when every recommendation of the product is held
+        self.complete = len(rows) <= depth
+        self._rows = list(rows[:depth])
+        self._keys = [rank_key(row) for row in self._rows]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def top(self, k):
+        """Returns the best ``k`` rows, or None if they are not all held"""
+        with self._lock:
+            if k > len(self._rows) and not self.complete:
+                return None
+            return self._rows[:k]
+
+    def update(self, row):
+        """Moves a created or re-counted row to its place in the ranking"""
+        key = rank_key(row)
+        with self._lock:
+            rows = self._rows[:]
+            keys = self._keys[:]
+            _discard(rows, keys, row["id"])
+            if self.complete or (keys and key < keys[-1]):
+                # rows that are not held all rank below the last held row
+                index = bisect.bisect_left(keys, key)
+                keys.insert(index, key)
+                rows.insert(index, row)
+                if len(rows) > self.depth:
+                    del rows[self.depth:], keys[self.depth:]
+                    self.complete = False
+            # readers hold the previous list, so it is replaced, not mutated
+            self._rows, self._keys = rows, keys
+
+    def remove(self, rec_id):
+        """Removes a deleted row from the ranking"""
+        with self._lock:
+            rows = self._rows[:]
+            keys = self._keys[:]
+            _discard(rows, keys, rec_id)
+            self._rows, self._keys = rows, keys
+
+
+def _discard(rows, keys, rec_id):
+    """Removes the row with ``rec_id`` from aligned rows and keys lists"""
+    for index, row in enumerate(rows):
+        if row["id"] == rec_id:
+            del rows[index], keys[index]
+            return
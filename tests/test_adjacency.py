@@ -0,0 +1,146 @@
+"""
+Test cases for the Adjacency Index
+
+"""
+import threading
+import time
+import unittest
+
+from service.utils.adjacency import AdjacencyIndex
+
+
+def edge(edge_id, product_id, rec_id, likes=0, rec_type="BUY_WITH"):
+    """Returns a row as read by the index"""
+    return (edge_id, product_id, rec_id, rec_type, likes, f"product {product_id}", f"product {rec_id}")
+
+
+# 1 -> 2 -> 4, 1 -> 3 -> 4, 3 -> 1, 4 -> 5
+ROWS = [
+    edge(1, 1, 2, likes=2),
+    edge(2, 1, 3, likes=0, rec_type="UP_SELL"),
+    edge(3, 2, 4),
+    edge(4, 3, 4),
+    edge(5, 3, 1),
+    edge(6, 4, 5),
+]
+
+
+######################################################################
+#  A D J A C E N C Y   I N D E X   T E S T   C A S E S
+######################################################################
+class TestAdjacencyIndex(unittest.TestCase):
+    """Test Cases for AdjacencyIndex"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.index = AdjacencyIndex()
+        self.index.load(ROWS)
+
+    def products(self, result):
+        """Returns the (product_id, depth) of a traversal result"""
+        return [(product["product_id"], product["depth"]) for product in result]
+
+    def test_load(self):
+        """It should load the rows into CSR arrays"""
+        self.assertTrue(self.index.loaded)
+        self.assertEqual(self.index.stats(), {"products": 4, "edges": 6, "overlay": 0, "dirty": 0})
+        self.assertEqual(self.index.neighbors(1), [(1, 2, "BUY_WITH", 2), (2, 3, "UP_SELL", 0)])
+        self.assertEqual(self.index.neighbors(5), [])
+        self.assertEqual(self.index.name(5), "product 5")
+
+    def test_traverse(self):
+        """It should rank reachable products by the likes flowing to them"""
+        result = self.index.traverse(1, depth=2)
+        self.assertEqual(self.products(result), [(4, 2), (2, 1), (3, 1)])
+        self.assertAlmostEqual(result[0]["score"], 3 / 4 + 1 / 4 * 1 / 2)
+        self.assertAlmostEqual(result[1]["score"], 3 / 4)
+        self.assertEqual(result[0]["via"], 2)
+        # the source is never listed, even though 3 recommends it
+        self.assertNotIn(1, [product["product_id"] for product in result])
+
+    def test_traverse_options(self):
+        """It should honour depth, min_depth, rec_type and limit"""
+        self.assertEqual(self.products(self.index.traverse(1, depth=3, min_depth=2)), [(4, 2), (5, 3)])
+        self.assertEqual(self.products(self.index.traverse(1, depth=3, rec_type="UP_SELL")), [(3, 1)])
+        self.assertEqual(len(self.index.traverse(1, depth=3, limit=2)), 2)
+        self.assertEqual(self.index.traverse(5), [])
+
+    def test_traverse_negative_likes(self):
+        """It should weigh edges with negative likes as unliked ones"""
+        self.index.load([edge(1, 1, 2, likes=-1), edge(2, 1, 3, likes=-5), edge(3, 1, 4, likes=1)])
+        scores = {product["product_id"]: product["score"] for product in self.index.traverse(1, depth=1)}
+        self.assertEqual(scores, {2: 0.25, 3: 0.25, 4: 0.5})
+
+    def test_incremental_updates(self):
+        """It should apply likes and deletes through the overlay"""
+        self.index.update_weight(1, 2, 10)
+        self.assertEqual(self.index.traverse(1, depth=1)[0]["product_id"], 3)
+        self.index.remove(1, 2)
+        self.assertEqual(self.products(self.index.traverse(1, depth=1)), [(2, 1)])
+        self.assertEqual(self.index.stats()["overlay"], 1)
+        # an edge the index does not hold is re-read instead
+        self.index.update_weight(4, 99, 1)
+        self.assertEqual(self.index.dirty([4]), [4])
+
+    def test_dirty_products_are_read(self):
+        """It should re-read dirty products in one call per hop"""
+        self.index.invalidate(2)
+        self.index.invalidate(3)
+        reads = []
+
+        def read(product_ids):
+            reads.append(sorted(product_ids))
+            return {2: [edge(7, 2, 6, likes=5)]}
+
+        result = self.index.traverse(1, depth=2, read=read)
+        self.assertEqual(reads, [[2, 3]])
+        self.assertEqual(self.products(result), [(2, 1), (6, 2), (3, 1)])
+        self.assertEqual(self.index.neighbors(3), [])
+        self.assertEqual(self.index.dirty([2, 3]), [])
+
+    def test_compaction(self):
+        """It should merge a large overlay back into the arrays"""
+        index = AdjacencyIndex(compact_ratio=0.1)
+        index.load([edge(n, n, n + 1) for n in range(1000)])
+        for n in range(101):
+            index.update_weight(n, n, 7)
+        self.assertLess(index.stats()["overlay"], 101)
+        self.assertEqual(index.neighbors(0), [(0, 1, "BUY_WITH", 7)])
+        self.assertEqual(index.neighbors(500), [(500, 501, "BUY_WITH", 0)])
+        index.remove(999, 999)
+        for n in range(200, 320):
+            index.update_weight(n, n, 1)
+        self.assertEqual(index.neighbors(999), [])
+        self.assertEqual(index.stats()["edges"], 999)
+
+    def test_unloaded_index(self):
+        """It should ignore writes until it is loaded"""
+        index = AdjacencyIndex()
+        index.invalidate(1)
+        index.update_weight(1, 1, 1)
+        self.assertEqual(index.stats()["dirty"], 0)
+        self.index.clear()
+        self.assertFalse(self.index.loaded)
+
+    def test_ensure_loaded_once(self):
+        """It should load an unloaded index once for concurrent callers"""
+        index = AdjacencyIndex()
+        loads = []
+
+        def load():
+            loads.append(1)
+            time.sleep(0.05)
+            index.load(ROWS)
+
+        threads = [threading.Thread(target=index.ensure_loaded, args=(load,)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(loads), 1)
+        self.assertTrue(index.loaded)
+        index.ensure_loaded(load)
+        self.assertEqual(len(loads), 1)
+        index.clear()
+        index.ensure_loaded(load)
+        self.assertEqual(len(loads), 2)
@@ -0,0 +1,118 @@
+"""
+Test cases for the LRU Cache
+
+"""
+import threading
+import time
+import unittest
+
+from service.utils.cache import LRUCache
+
+
+######################################################################
+#  L R U   C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """Test Cases for LRUCache"""
+
+    def test_get_and_put(self):
+        """It should return stored values and count hits and misses"""
+        cache = LRUCache()
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", [1])
+        self.assertEqual(cache.get("a"), [1])
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 1, 1))
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_lru_eviction(self):
+        """It should evict the least recently used entry when full"""
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        """It should expire entries after the ttl"""
+        cache = LRUCache(ttl=0.01)
+        cache.put("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_invalidate_tag(self):
+        """It should remove every entry with a tag"""
+        cache = LRUCache()
+        cache.put((1, None), "all", tag=1)
+        cache.put((1, "UP_SELL"), "up", tag=1)
+        cache.put((2, None), "other", tag=2)
+        cache.invalidate(1)
+        self.assertIsNone(cache.get((1, None)))
+        self.assertIsNone(cache.get((1, "UP_SELL")))
+        self.assertEqual(cache.get((2, None)), "other")
+
+    def test_stale_put_is_dropped(self):
+        """It should not store a value loaded before an invalidation"""
+        cache = LRUCache()
+        generation = cache.generation(1)
+        cache.invalidate(1)  # a write lands while the value is loading
+        cache.put((1, None), "stale", tag=1, generation=generation)
+        self.assertIsNone(cache.get((1, None)))
+        generation = cache.generation(1)
+        cache.clear()
+        cache.put((1, None), "stale", tag=1, generation=generation)
+        self.assertIsNone(cache.get((1, None)))
+        cache.put((1, None), "fresh", tag=1, generation=cache.generation(1))
+        self.assertEqual(cache.get((1, None)), "fresh")
+
+    def test_advance_keeps_entries(self):
+        """It should drop stale puts but keep entries when a tag is advanced"""
+        cache = LRUCache()
+        cache.put((1, None), "updated in place", tag=1)
+        generation = cache.generation(1)
+        self.assertTrue(cache.advance(1))
+        self.assertEqual(cache.peek((1, None)), "updated in place")
+        cache.put((1, None), "stale", tag=1, generation=generation)
+        self.assertEqual(cache.peek((1, None)), "updated in place")
+
+    def test_peek_is_not_counted(self):
+        """It should not count peeks as hits or misses"""
+        cache = LRUCache()
+        cache.put("a", 1)
+        self.assertEqual(cache.peek("a"), 1)
+        self.assertIsNone(cache.peek("b"))
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    def test_disabled(self):
+        """It should not store anything when disabled"""
+        cache = LRUCache(enabled=False)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+        cache.configure(max_size=10, ttl=10, enabled=True)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+
+    def test_threads(self):
+        """It should stay consistent when used from many threads"""
+        cache = LRUCache(max_size=50)
+
+        def worker(offset):
+            for i in range(1000):
+                key = (offset + i) % 100
+                cache.put(key, key, tag=key % 10)
+                cache.get(key)
+                if i % 50 == 0:
+                    cache.invalidate(key % 10)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(cache.stats()["size"], 50)
+        for key in range(100):
+            self.assertIn(cache.get(key), (None, key))
@@ -0,0 +1,191 @@
+"""
+Test cases for the cross-worker Cache Listener
+
+"""
+import os
+import threading
+import time
+import unittest
+
+from sqlalchemy import text
+
+from service.models import Recommendation, Type, adjacency, db, list_cache, top_cache
+from service.routes import app, clear_caches, init_db, listen_connection
+from service.utils.cache_listener import CacheListener
+
+# the database of the tests needing PostgreSQL, which are skipped on any other
+DATABASE_URI = os.getenv("DATABASE_URI", "")
+
+
+class FakeNotify:  # pylint: disable=too-few-public-methods
+    """A psycopg2 Notify with just a payload"""
+
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class FakeConnection:
+    """A psycopg2 connection that receives notifications through a pipe"""
+
+    def __init__(self):
+        self._read, self._write = os.pipe()
+        self.statements = []
+        self.notifies = []
+        self.closed = False
+
+    def fileno(self):
+        """Lets select() wait on the connection"""
+        return self._read
+
+    def cursor(self):
+        """Returns a cursor recording the statements executed"""
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, statement):
+        """Records a statement"""
+        self.statements.append(statement)
+
+    def notify(self, payload):
+        """Simulates a NOTIFY from another session"""
+        self.notifies.append(FakeNotify(payload))
+        os.write(self._write, b"x")
+
+    def poll(self):
+        """Consumes the pending wakeups"""
+        os.read(self._read, 1024)
+
+    def close(self):
+        """Closes the pipe"""
+        self.closed = True
+        os.close(self._read)
+        os.close(self._write)
+
+
+######################################################################
+#  C A C H E   L I S T E N E R   T E S T   C A S E S
+######################################################################
+class TestCacheListener(unittest.TestCase):
+    """Test Cases for CacheListener"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.invalidated = []
+        self.clears = 0
+        self.connections = []
+
+    def connect(self):
+        """Returns a new fake connection"""
+        connection = FakeConnection()
+        self.connections.append(connection)
+        return connection
+
+    def clear(self):
+        """Counts cache clears"""
+        self.clears += 1
+
+    def invalidate(self, payload):
+        """Records invalidated products"""
+        self.invalidated.append(int(payload))
+
+    def wait_for(self, condition):
+        """Waits up to two seconds for a condition"""
+        deadline = time.time() + 2
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_dispatch_skips_bad_payloads(self):
+        """It should invalidate every valid payload and skip bad ones"""
+        listener = CacheListener(self.connect, "changes", self.invalidate, self.clear)
+        listener.dispatch(["1", "abc", "2"])
+        self.assertEqual(self.invalidated, [1, 2])
+
+    def test_listen_and_invalidate(self):
+        """It should LISTEN, clear the cache and invalidate notified products"""
+        listener = CacheListener(
+            self.connect, "changes", self.invalidate, self.clear, poll_seconds=0.01
+        )
+        listener.start()
+        self.wait_for(lambda: self.clears)
+        connection = self.connections[0]
+        self.assertEqual(connection.statements, ['LISTEN "changes"'])
+        self.assertEqual(self.clears, 1)
+        connection.notify("5")
+        connection.notify("6")
+        self.wait_for(lambda: len(self.invalidated) == 2)
+        listener.stop()
+        self.assertEqual(self.invalidated, [5, 6])
+        self.assertTrue(connection.closed)
+
+    def test_reconnect_after_failure(self):
+        """It should reconnect after a failure and clear the cache again"""
+        attempts = []
+
+        def flaky_connect():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise OSError("database is down")
+            return self.connect()
+
+        listener = CacheListener(
+            flaky_connect, "changes", self.invalidate, self.clear, poll_seconds=0.01
+        )
+        listener.start()
+        self.wait_for(lambda: self.clears)
+        listener.stop()
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.clears, 1)
+
+    def test_connect_clears_every_cache(self):
+        """It should drop the lists, rankings and adjacency index of the service on connect"""
+        list_cache.put((1, None), [], tag=1)
+        top_cache.put((1, None), [], tag=1)
+        adjacency.load([(1, 1, 2, Type.UP_SELL, 3, "Phone", "Case")])
+        self.assertEqual(top_cache.stats()["size"], 1)
+        self.assertTrue(adjacency.loaded)
+        listener = CacheListener(self.connect, "changes", self.invalidate, clear_caches, poll_seconds=0.01)
+        listener.start()
+        self.wait_for(lambda: not adjacency.loaded)
+        listener.stop()
+        self.assertEqual(list_cache.stats()["size"], 0)
+        self.assertEqual(top_cache.stats()["size"], 0)
+        self.assertFalse(adjacency.loaded)
+
+
+######################################################################
+#  P O S T G R E S Q L   T E S T   C A S E S
+######################################################################
+@unittest.skipUnless(DATABASE_URI.startswith("postgresql"), "needs a PostgreSQL DATABASE_URI")
+class TestListenConnection(unittest.TestCase):
+    """Test Cases for CacheListener on the connections of the service"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        init_db()
+
+    def test_listen_from_a_thread(self):
+        """It should LISTEN from its thread and invalidate the products notified by the database"""
+        listening = threading.Event()
+        invalidated = []
+        listener = CacheListener(
+            listen_connection, Recommendation.notify_channel, invalidated.append, listening.set, poll_seconds=0.01
+        )
+        listener.start()
+        try:
+            self.assertTrue(listening.wait(5))
+            db.session.execute(text("SELECT pg_notify(:channel, '42')"), {"channel": Recommendation.notify_channel})
+            db.session.commit()
+            deadline = time.time() + 5
+            while not invalidated and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            listener.stop()
+            db.session.remove()
+        self.assertEqual(invalidated, ["42"])
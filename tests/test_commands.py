@@ -0,0 +1,178 @@
+"""
+Flask CLI Command Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+"""
+import csv
+import io
+import json
+import logging
+import os
+import tempfile
+from unittest import TestCase
+
+from flask.logging import create_logger
+
+from service import app
+from service.commands import NdjsonCsvStream, read_csv_header
+from service.models import DATA_COLUMNS, DataValidationError, Recommendation, Tombstone, Type, db
+from service.routes import init_db
+
+from tests.factories import RecommendationFactory
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCommands(TestCase):
+    """Flask CLI Command Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        basedir = os.path.abspath(os.path.dirname(__file__))
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
+            basedir, "database.db"
+        )
+        create_logger(app).setLevel(logging.CRITICAL)
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        basedir = os.path.abspath(os.path.dirname(__file__))
+        db.session.close()
+        if os.path.exists(os.path.join(basedir, "database.db")):
+            os.remove(os.path.join(basedir, "database.db"))
+
+    def setUp(self):
+        """This runs before each test"""
+        self.runner = app.test_cli_runner()
+        db.session.query(Recommendation).delete()
+        db.session.query(Tombstone).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_create_columns(self):
+        """It should report that the model columns are in place"""
+        result = self.runner.invoke(args=["create-columns"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("All columns are in place", result.output)
+
+    def test_create_indexes(self):
+        """It should create the model indexes from the command line"""
+        result = self.runner.invoke(args=["create-indexes"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("ix_recommendation_product_id_rec_type", result.output)
+
+    def test_dedupe_recommendations(self):
+        """It should report how many duplicates were merged"""
+        result = self.runner.invoke(args=["dedupe-recommendations"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Merged 0 duplicated edges, deleted 0 rows", result.output)
+
+    def test_purge_tombstones(self):
+        """It should purge the tombstones older than the retention period"""
+        rec = RecommendationFactory()
+        rec.create()
+        rec.delete()
+        result = self.runner.invoke(args=["purge-tombstones"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Purged 0 tombstones older than 30 days", result.output)
+        result = self.runner.invoke(args=["purge-tombstones", "--days", "0"])
+        self.assertIn("Purged 1 tombstones older than 0 days", result.output)
+
+    def test_import_needs_postgres(self):
+        """It should refuse to import into a database without COPY"""
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as file:
+            file.write(",".join(DATA_COLUMNS) + "\n")
+        try:
+            result = self.runner.invoke(args=["import-recommendations", file.name])
+        finally:
+            os.remove(file.name)
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("PostgreSQL", result.output)
+
+    def mine(self, content, *options):
+        """Runs mine-buy-with on an order-line file with the given content"""
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as file:
+            file.write(content)
+        try:
+            return self.runner.invoke(args=["mine-buy-with", file.name, "--workers", "1", *options])
+        finally:
+            os.remove(file.name)
+
+    def test_mine_buy_with(self):
+        """It should create BUY_WITH recommendations from order lines"""
+        existing = RecommendationFactory(product_id=1, rec_id=2, rec_type=Type.BUY_WITH, like_num=5)
+        existing.create()
+        existing_id = existing.id
+        RecommendationFactory(product_id=3, product_name="Kettle", rec_id=99, rec_type=Type.UP_SELL).create()
+        result = self.mine(
+            "order_id,product_id,product_name\n"
+            "a,1,Tea\na,2,Cups\na,3,\n"
+            "b,1,Tea\nb,2,Cups\nb,3,\n"
+            "c,1,Tea\nc,2,Cups\n",
+            "--top-n", "1",
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Mined 3 BUY_WITH pairs", result.output)
+        self.assertIn("2 created, 1 already existed", result.output)
+        self.assertEqual(Recommendation.find(existing_id).like_num, 5)
+        mined = Recommendation.find_by_params(2, Type.BUY_WITH)
+        self.assertEqual([(rec.rec_id, rec.rec_name, rec.product_name) for rec in mined], [(1, "Tea", "Cups")])
+        mined = Recommendation.find_by_params(3, Type.BUY_WITH)
+        self.assertEqual(mined[0].product_name, "Kettle")
+
+    def test_mine_buy_with_dry_run(self):
+        """It should print the mined pairs without writing them"""
+        result = self.mine("order_id,product_id\n1,10\n1,20\n2,10\n2,20\n", "--dry-run")
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("10,20,1,2", result.output)
+        self.assertIn("20,10,1,2", result.output)
+        self.assertEqual(Recommendation.all(), [])
+
+    def test_mine_buy_with_bad_file(self):
+        """It should reject files without the required columns or with bad lines"""
+        result = self.mine("order,product\n1,10\n")
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("order_id and product_id", result.output)
+        result = self.mine("order_id,product_id\n1,10\n1,abc\n")
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("Invalid order line 3", result.output)
+
+    def test_read_csv_header(self):
+        """It should read the column names from a CSV header"""
+        file = io.StringIO("rec_id, product_id,like_num\n1,2,3\n")
+        self.assertEqual(read_csv_header(file), ("rec_id", "product_id", "like_num"))
+        self.assertEqual(file.read(), "1,2,3\n")
+
+    def test_ndjson_csv_stream(self):
+        """It should convert NDJSON lines to CSV rows as they are read"""
+        recs = [RecommendationFactory().serialize() for _ in range(20)]
+        lines = [json.dumps(rec) + "\n" for rec in recs]
+        lines.insert(3, "\n")
+        stream = NdjsonCsvStream(lines)
+        chunks = []
+        while True:
+            chunk = stream.read(100)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 100)
+            chunks.append(chunk)
+        rows = list(csv.reader(io.StringIO("".join(chunks))))
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(rows[0], [str(recs[0][column]) for column in DATA_COLUMNS])
+
+    def test_ndjson_csv_stream_bad_line(self):
+        """It should report the line number of invalid NDJSON"""
+        stream = NdjsonCsvStream(['{"product_id": 1}\n'])
+        with self.assertRaises(DataValidationError) as context:
+            stream.read()
+        self.assertIn("line 1", str(context.exception))
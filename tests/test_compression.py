@@ -0,0 +1,182 @@
+"""
+Test cases for response compression and static files
+
+"""
+import gzip
+import os
+import tempfile
+import unittest
+
+from flask import Flask, Response, request
+from werkzeug.datastructures import Accept
+from werkzeug.exceptions import NotFound
+from werkzeug.http import parse_accept_header, parse_etags
+
+from service.utils.compression import (
+    ENCODINGS,
+    StaticFiles,
+    compress,
+    compress_response,
+    matching_etag,
+    negotiate,
+    strip_encoding,
+)
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+BODY = b'{"rec_name": "product"}' * 100
+
+
+def accept(header):
+    """Parses an Accept-Encoding header"""
+    return parse_accept_header(header, Accept)
+
+
+######################################################################
+#  C O M P R E S S I O N   T E S T   C A S E S
+######################################################################
+class TestCompression(unittest.TestCase):
+    """Test Cases for compress_response"""
+
+    def test_negotiate(self):
+        """It should pick the encoding the client prefers among those supported"""
+        self.assertEqual(negotiate(accept("gzip")), "gzip")
+        self.assertEqual(negotiate(accept("deflate, gzip;q=0.5")), "gzip")
+        self.assertIsNone(negotiate(accept("identity")))
+        self.assertIsNone(negotiate(accept("gzip;q=0")))
+        self.assertIsNone(negotiate(accept("")))
+        self.assertEqual(negotiate(accept("*")), ENCODINGS[0])
+
+    def test_compress_buffered(self):
+        """It should gzip a large JSON response and mark it as varying on Accept-Encoding"""
+        response = Response(BODY, mimetype="application/json")
+        response.set_etag("abc")
+        compress_response(response, accept("gzip"), min_size=1024)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.vary)
+        self.assertEqual(gzip.decompress(response.get_data()), BODY)
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.get_data()))
+        self.assertEqual(response.get_etag(), ("abc-gzip", False))
+        # weak ETags already allow other encodings
+        response = Response(BODY, mimetype="application/json")
+        response.set_etag("abc", weak=True)
+        compress_response(response, accept("gzip"), min_size=1024)
+        self.assertEqual(response.get_etag(), ("abc", True))
+
+    def test_matching_etag(self):
+        """It should match the ETags of every encoding of a representation"""
+        self.assertEqual(strip_encoding("5-3-gzip"), "5-3")
+        self.assertEqual(strip_encoding("5-3-br"), "5-3")
+        self.assertEqual(strip_encoding("5-3"), "5-3")
+        self.assertEqual(matching_etag(parse_etags('"5-3-gzip", "7-1"'), "5-3"), "5-3-gzip")
+        self.assertEqual(matching_etag(parse_etags('W/"5-3"'), "5-3"), "5-3")
+        self.assertEqual(matching_etag(parse_etags("*"), "5-3"), "5-3")
+        self.assertIsNone(matching_etag(parse_etags('"5-4-gzip"'), "5-3"))
+        self.assertIsNone(matching_etag(parse_etags(None), "5-3"))
+
+    def test_compress_skipped(self):
+        """It should leave small, incompressible and bodiless responses alone"""
+        cases = [
+            (Response(b"[]", mimetype="application/json"), "gzip"),
+            (Response(BODY, mimetype="image/png"), "gzip"),
+            (Response(status=304), "gzip"),
+            (Response(BODY, mimetype="application/json"), "identity"),
+        ]
+        for response, encoding in cases:
+            compress_response(response, accept(encoding), min_size=1024)
+            self.assertNotIn("Content-Encoding", response.headers)
+        self.assertIn("Accept-Encoding", cases[0][0].vary)
+        self.assertNotIn("Accept-Encoding", cases[1][0].vary)
+
+    def test_compress_streamed(self):
+        """It should compress a streamed response chunk by chunk, whatever its size"""
+        response = Response(iter([b"a\n", b"b\n"]), mimetype="application/x-ndjson")
+        compress_response(response, accept("gzip"), min_size=1024)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(b"".join(response.response)), b"a\nb\n")
+
+    @unittest.skipIf(brotli is None, "brotli is not installed")
+    def test_compress_brotli(self):
+        """It should prefer brotli when the client accepts it"""
+        response = Response(BODY, mimetype="application/json")
+        compress_response(response, accept("gzip, deflate, br"), min_size=1024)
+        self.assertEqual(response.headers["Content-Encoding"], "br")
+        self.assertEqual(brotli.decompress(response.get_data()), BODY)
+        self.assertEqual(brotli.decompress(compress(BODY, "br", 11)), BODY)
+
+
+######################################################################
+#  S T A T I C   F I L E S   T E S T   C A S E S
+######################################################################
+class TestStaticFiles(unittest.TestCase):
+    """Test Cases for StaticFiles"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.write("app.js", b"console.log('recommendations');\n" * 100)
+        self.write("logo.png", b"\x89PNG")
+        self.write("index.html", b'<link href="static/app.js"><img src = "static/logo.png"><script src="static/gone.js">')
+        self.static = StaticFiles(self.folder, max_age=600)
+        self.app = Flask(__name__)
+
+    def write(self, name, content):
+        """Writes a file of the static folder"""
+        with open(os.path.join(self.folder, name), "wb") as static:
+            static.write(content)
+
+    def send(self, path, **headers):
+        """Serves a static file for a request"""
+        with self.app.test_request_context(path, headers=headers):
+            response = self.static.send(request.path[len("/static/"):], request)
+            response.direct_passthrough = False
+            return response
+
+    def test_versioned_page(self):
+        """It should add fingerprints to the static references of a page"""
+        with self.app.test_request_context("/"):
+            response = self.static.page("index.html", request)
+        page = response.get_data(as_text=True)
+        self.assertIn(f'href="static/app.js?v={self.static.fingerprint("app.js")}"', page)
+        self.assertIn(f'src = "static/logo.png?v={self.static.fingerprint("logo.png")}"', page)
+        self.assertIn('src="static/gone.js"', page)
+        self.assertTrue(response.cache_control.no_cache)
+
+    def test_send_compressed(self):
+        """It should serve the compressed copy of a file the client accepts"""
+        response = self.send("/static/app.js", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.get_data()), b"console.log('recommendations');\n" * 100)
+        self.assertTrue(response.cache_control.no_cache)
+        etag = response.get_etag()[0]
+        self.assertEqual(etag, f"{self.static.fingerprint('app.js')}-gzip")
+        response = self.send("/static/app.js", **{"Accept-Encoding": "gzip", "If-None-Match": f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+        # the uncompressed file is another representation
+        response = self.send("/static/app.js", **{"If-None-Match": f'"{etag}"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.get_etag()[0], etag)
+        response = self.send("/static/logo.png", **{"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.get_data(), b"\x89PNG")
+
+    def test_send_fingerprinted(self):
+        """It should cache fingerprinted URLs as immutable until the file changes"""
+        version = self.static.fingerprint("app.js")
+        response = self.send(f"/static/app.js?v={version}")
+        self.assertEqual(response.cache_control.max_age, 600)
+        self.assertTrue(response.cache_control.immutable)
+        self.write("app.js", b"console.log('changed');")
+        os.utime(os.path.join(self.folder, "app.js"), ns=(0, 0))
+        self.assertNotEqual(self.static.fingerprint("app.js"), version)
+        response = self.send(f"/static/app.js?v={version}", **{"Accept-Encoding": "gzip"})
+        self.assertTrue(response.cache_control.no_cache)
+        self.assertEqual(gzip.decompress(response.get_data()), b"console.log('changed');")
+
+    def test_send_not_found(self):
+        """It should not serve missing files or files outside the folder"""
+        for path in ("/static/missing.js", "/static/../secret"):
+            self.assertRaises(NotFound, self.send, path)
+        self.assertIsNone(self.static.fingerprint("../secret"))
@@ -0,0 +1,78 @@
+"""
+Test cases for the write-behind Like Buffer
+
+"""
+import time
+import unittest
+
+from service.utils.like_buffer import LikeBuffer
+
+
+######################################################################
+#  L I K E   B U F F E R   T E S T   C A S E S
+######################################################################
+class TestLikeBuffer(unittest.TestCase):
+    """Test Cases for LikeBuffer"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.batches = []
+        self.buffer = LikeBuffer(self.batches.append, interval_ms=10, max_events=5)
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.buffer.stop()
+
+    def test_add_accumulates_per_id(self):
+        """It should accumulate deltas per recommendation id"""
+        self.buffer.add(1, 1)
+        self.buffer.add(1, 1)
+        self.buffer.add(2, -1)
+        self.assertEqual(self.buffer.pending(), 2)
+        self.assertEqual(self.buffer.pending_delta(1), 2)
+        self.assertEqual(self.buffer.pending_delta(2), -1)
+        self.assertEqual(self.buffer.pending_delta(3), 0)
+
+    def test_flush_sends_one_batch(self):
+        """It should flush all deltas as a single batch"""
+        self.buffer.add(1, 1)
+        self.buffer.add(2, 1)
+        self.buffer.add(2, 1)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.batches, [{1: 1, 2: 2}])
+        self.assertEqual(self.buffer.pending(), 0)
+
+    def test_flush_skips_cancelled_deltas(self):
+        """It should not flush ids whose likes and unlikes cancel out"""
+        self.buffer.add(1, 1)
+        self.buffer.add(1, -1)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(self.batches, [])
+
+    def test_failed_flush_keeps_deltas(self):
+        """It should keep the deltas when the flush fails"""
+        def broken(deltas):
+            raise RuntimeError("database is down")
+
+        buffer = LikeBuffer(broken)
+        buffer.add(1, 1)
+        self.assertRaises(RuntimeError, buffer.flush)
+        buffer.add(1, 1)
+        self.assertEqual(buffer.pending_delta(1), 2)
+
+    def test_background_flush(self):
+        """It should flush periodically from the background thread"""
+        self.buffer.start()
+        self.buffer.add(7, 1)
+        deadline = time.time() + 2
+        while not self.batches and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.batches, [{7: 1}])
+
+    def test_stop_flushes(self):
+        """It should flush pending deltas when stopped"""
+        buffer = LikeBuffer(self.batches.append, interval_ms=60000)
+        buffer.start()
+        buffer.add(3, -1)
+        buffer.stop()
+        self.assertEqual(self.batches, [{3: -1}])
@@ -0,0 +1,115 @@
+"""
+Test cases for the log handlers
+
+"""
+import io
+import json
+import logging
+import sys
+import unittest
+
+from flask import Flask
+
+from service.utils.log_handlers import (
+    LOGGER_NAMES,
+    AsyncQueueHandler,
+    JsonFormatter,
+    SamplingFilter,
+    init_logging,
+)
+
+GUNICORN_LOGGER = "tests.gunicorn"
+
+
+def record(message, *args, level=logging.INFO, **extra):
+    """Returns a log record of the flask.app logger"""
+    return logging.getLogger("flask.app").makeRecord(
+        "flask.app", level, __file__, 1, message, args, None, extra=extra
+    )
+
+
+######################################################################
+#  L O G   H A N D L E R S   T E S T   C A S E S
+######################################################################
+class TestLogHandlers(unittest.TestCase):
+    """Test Cases for the log formatter, filter and queue"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.add_url_rule("/like", "like_resource", lambda: "")
+        self.app.add_url_rule("/list", "recommendations_collection", lambda: "")
+        # init_logging replaces the handlers of these loggers
+        self.saved = {
+            logger: (logger.handlers, logger.propagate, logger.level)
+            for logger in (self.app.logger, *(logging.getLogger(name) for name in LOGGER_NAMES))
+        }
+
+    def tearDown(self):
+        for logger, (handlers, propagate, level) in self.saved.items():
+            logger.handlers, logger.propagate = handlers, propagate
+            logger.setLevel(level)
+
+    def test_json_formatter(self):
+        """It should format a record as one JSON line with its extra fields"""
+        line = JsonFormatter().format(record("Liked %s", 7, rec_id=7))
+        self.assertNotIn("\n", line)
+        entry = json.loads(line)
+        self.assertEqual(entry["message"], "Liked 7")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["logger"], "flask.app")
+        self.assertEqual(entry["rec_id"], 7)
+        self.assertIn("time", entry)
+
+    def test_queue_handler_prepare(self):
+        """It should merge the arguments and render the traceback before queueing"""
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger = logging.getLogger("flask.app")
+            failed = logger.makeRecord("flask.app", logging.ERROR, __file__, 1, "Failed %s", ([1],), sys.exc_info())
+        prepared = AsyncQueueHandler(None).prepare(failed)
+        self.assertEqual((prepared.msg, prepared.args, prepared.exc_info), ("Failed [1]", None, None))
+        entry = json.loads(JsonFormatter().format(prepared))
+        self.assertIn("ValueError: boom", entry["exception"])
+
+    def test_sampling_filter(self):
+        """It should keep or drop all the INFO lines of a sampled request"""
+        draws = iter([0.5, 0.01])
+        sampling = SamplingFilter({"like_resource": 0.1}, rand=lambda: next(draws))
+        with self.app.test_request_context("/like"):
+            sampling.start_request()
+            self.assertFalse(sampling.filter(record("Liked")))
+            self.assertFalse(sampling.filter(record("Liked again")))
+            self.assertTrue(sampling.filter(record("Failed", level=logging.WARNING)))
+        sampling.end_request()
+        self.assertTrue(sampling.filter(record("Outside a request")))
+        with self.app.test_request_context("/like"):
+            sampling.start_request()
+            self.assertTrue(sampling.filter(record("Liked")))
+        with self.app.test_request_context("/list"):
+            sampling.start_request()
+            self.assertTrue(sampling.filter(record("Listed")))
+
+    def test_init_logging(self):
+        """It should write the service's records as JSON from a listener thread"""
+        stream = io.StringIO()
+        gunicorn = logging.getLogger(GUNICORN_LOGGER)
+        gunicorn.handlers = [logging.StreamHandler(stream)]
+        gunicorn.setLevel(logging.INFO)
+        self.app.config["LOG_SAMPLE_RATES"] = {"like_resource": 0.0}
+        listener = init_logging(self.app, GUNICORN_LOGGER)
+        try:
+            with self.app.test_request_context("/like"):
+                self.app.preprocess_request()
+                logging.getLogger("flask.app").info("Sampled out")
+                logging.getLogger("flask.app").warning("Kept")
+            self.app.logger.info("Outside a request")
+        finally:
+            listener.stop()
+        messages = [json.loads(line)["message"] for line in stream.getvalue().splitlines()]
+        self.assertEqual(messages, ["Logging handler established", "Kept", "Outside a request"])
+
+    def test_init_logging_without_handlers(self):
+        """It should leave logging alone when there are no gunicorn handlers"""
+        logging.getLogger(GUNICORN_LOGGER).handlers = []
+        self.assertIsNone(init_logging(self.app, GUNICORN_LOGGER))
@@ -0,0 +1,140 @@
+"""
+Test cases for the Prometheus metrics
+
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from flask import Flask
+from flask_restx import Api, Resource
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+
+from service.utils.cache import LRUCache
+from service.utils.metrics import CacheMetrics, RequestMetrics, instrument_engine, render
+from service.utils.query_log import query_log
+
+
+# the gunicorn configuration, at the root of the repository
+GUNICORN_CONF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gunicorn.conf.py")
+
+
+def sample(name, **labels):
+    """Returns the current value of a sample, 0 if it was never recorded"""
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+######################################################################
+#  M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """Test Cases for the request, query and cache metrics"""
+
+    def test_request_metrics(self):
+        """It should count and time requests per flask-restx Resource"""
+        app = Flask(__name__)
+        api = Api(app)
+
+        @api.route("/widgets/<int:widget_id>")
+        class WidgetResource(Resource):  # pylint: disable=unused-variable
+            """A resource to request"""
+
+            def get(self, widget_id):
+                """Returns a widget"""
+                if widget_id == 0:
+                    api.abort(404)
+                return {"id": widget_id}
+
+        RequestMetrics(app).start()
+        client = app.test_client()
+        labels = {"resource": "WidgetResource", "method": "GET"}
+        ok = sample("http_requests_total", status="200", **labels)
+        missing = sample("http_requests_total", status="404", **labels)
+        timed = sample("http_request_duration_seconds_count", **labels)
+        client.get("/widgets/1")
+        client.get("/widgets/2")
+        client.get("/widgets/0")
+        client.get("/nowhere")
+        self.assertEqual(sample("http_requests_total", status="200", **labels), ok + 2)
+        self.assertEqual(sample("http_requests_total", status="404", **labels), missing + 1)
+        self.assertEqual(sample("http_request_duration_seconds_count", **labels), timed + 3)
+        self.assertGreater(sample("http_requests_total", resource="unmatched", method="GET", status="404"), 0)
+
+    def test_query_metrics(self):
+        """It should time SQL statements by operation and the wait for connections"""
+        engine = create_engine("sqlite://")
+        instrument_engine(engine)
+        # the statements are timed once, shared with the query log
+        query_log.instrument(engine)
+        self.assertEqual(len(engine.dispatch.after_cursor_execute), 1)
+        selects = sample("db_query_duration_seconds_count", operation="SELECT")
+        others = sample("db_query_duration_seconds_count", operation="OTHER")
+        checkouts = sample("db_pool_checkout_duration_seconds_count")
+        in_use = sample("db_pool_connections_in_use")
+        with engine.connect() as conn:
+            conn.execute(text("CREATE TABLE widget (id integer)"))
+            conn.execute(text("SELECT 1"))
+            self.assertEqual(sample("db_pool_connections_in_use"), in_use + 1)
+        self.assertEqual(sample("db_pool_connections_in_use"), in_use)
+        self.assertEqual(sample("db_query_duration_seconds_count", operation="SELECT"), selects + 1)
+        self.assertEqual(sample("db_query_duration_seconds_count", operation="OTHER"), others + 1)
+        self.assertEqual(sample("db_pool_checkout_duration_seconds_count"), checkouts + 1)
+        # a disposed engine gets a new pool, which is timed too
+        engine.dispose()
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        self.assertEqual(sample("db_pool_checkout_duration_seconds_count"), checkouts + 2)
+
+    def test_cache_metrics(self):
+        """It should report the lookups counted by a cache since the last sync"""
+        cache = LRUCache()
+        metrics = CacheMetrics({"widgets": cache})
+        hits = sample("cache_hits_total", cache="widgets")
+        misses = sample("cache_misses_total", cache="widgets")
+        cache.get("a")
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("a")
+        metrics.sync()
+        metrics.sync()
+        self.assertEqual(sample("cache_hits_total", cache="widgets"), hits + 2)
+        self.assertEqual(sample("cache_misses_total", cache="widgets"), misses + 1)
+        # counters that were reset start over
+        cache.hits = 1
+        metrics.sync()
+        self.assertEqual(sample("cache_hits_total", cache="widgets"), hits + 3)
+
+    def test_render(self):
+        """It should render the samples in the Prometheus text format"""
+        body = render().decode()
+        self.assertIn("# TYPE http_request_duration_seconds histogram", body)
+        self.assertIn("# TYPE db_query_duration_seconds histogram", body)
+
+    def test_gunicorn_workers_share_samples(self):
+        """It should have gunicorn workers write their samples to the shared directory"""
+        # a fresh interpreter plays the gunicorn master: it loads the config,
+        # forks a worker, and the worker counts something
+        master = textwrap.dedent(f"""
+            import os, runpy, sys
+            conf = runpy.run_path({GUNICORN_CONF!r})
+            conf["on_starting"](None)
+            assert "prometheus_client" not in sys.modules, "the master imported prometheus_client"
+            pid = os.fork()
+            if pid == 0:
+                from prometheus_client import Counter
+                Counter("worker_requests", "Requests of a worker").inc()
+                os._exit(0)
+            os.waitpid(pid, 0)
+            print("\\n".join(os.listdir(conf["METRICS_DIR"])))
+        """)
+        with tempfile.TemporaryDirectory() as folder:
+            env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": os.path.join(folder, "metrics")}
+            result = subprocess.run(
+                [sys.executable, "-c", master], env=env, capture_output=True, text=True, check=False
+            )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue(any(name.startswith("counter_") for name in result.stdout.split()), result.stdout)
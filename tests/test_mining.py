@@ -0,0 +1,68 @@
+"""
+Test cases for Co-purchase Mining
+
+"""
+import unittest
+
+from service.mining import mine_pairs, read_baskets
+
+ORDER_LINES = [
+    ("o1", 1), ("o1", 2), ("o1", 3),
+    ("o2", 1), ("o2", 2),
+    ("o3", 1), ("o3", 2), ("o3", 2),
+    ("o4", 3), ("o4", 4),
+    ("o5", 5),
+]
+
+
+######################################################################
+#  M I N I N G   T E S T   C A S E S
+######################################################################
+class TestMining(unittest.TestCase):
+    """Test Cases for co-purchase mining"""
+
+    def test_read_baskets(self):
+        """It should build a 0/1 orders x products matrix across chunks"""
+        baskets = read_baskets(ORDER_LINES, chunk_size=3)
+        self.assertEqual(baskets.lines, 11)
+        self.assertEqual(baskets.orders, 5)
+        self.assertEqual(baskets.product_ids.tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(baskets.matrix.toarray()[2].tolist(), [1, 1, 0, 0, 0])
+
+    def test_read_baskets_max_basket(self):
+        """It should drop orders with too many products"""
+        baskets = read_baskets(ORDER_LINES, max_basket=2)
+        self.assertEqual(baskets.orders, 4)
+
+    def test_read_baskets_empty(self):
+        """It should read an empty order log"""
+        baskets = read_baskets([])
+        self.assertEqual((baskets.lines, baskets.orders), (0, 0))
+        self.assertEqual(list(mine_pairs(baskets, workers=1)), [])
+
+    def test_lift(self):
+        """It should score pairs by lift and keep the best top_n per product"""
+        baskets = read_baskets(ORDER_LINES)
+        pairs = list(mine_pairs(baskets, top_n=2, min_count=1, workers=1))
+        self.assertEqual([(a, b, count) for a, b, _, count in pairs if a == 1], [(1, 2, 3), (1, 3, 1)])
+        scores = {(a, b): score for a, b, score, _ in pairs}
+        self.assertAlmostEqual(scores[(1, 2)], 3 * 5 / (3 * 3))
+        self.assertAlmostEqual(scores[(3, 4)], 1 * 5 / (2 * 1))
+        self.assertNotIn(5, {a for a, *_ in pairs})
+
+    def test_jaccard_min_count(self):
+        """It should score pairs by Jaccard and skip rare pairs"""
+        baskets = read_baskets(ORDER_LINES)
+        pairs = list(mine_pairs(baskets, score="jaccard", min_count=2, workers=1))
+        self.assertEqual(pairs, [(1, 2, 1.0, 3), (2, 1, 1.0, 3)])
+
+    def test_process_pool(self):
+        """It should give the same pairs from a process pool"""
+        baskets = read_baskets(ORDER_LINES)
+        expected = list(mine_pairs(baskets, min_count=1, workers=1))
+        self.assertEqual(list(mine_pairs(baskets, min_count=1, workers=2, block_size=2)), expected)
+
+    def test_unknown_score(self):
+        """It should reject unknown scores"""
+        baskets = read_baskets(ORDER_LINES)
+        self.assertRaises(ValueError, list, mine_pairs(baskets, score="cosine"))
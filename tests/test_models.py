@@ -2,13 +2,24 @@
 Test cases for YourResourceModel Model
 
 """
+import io
 import logging
 import os
+import threading
 import unittest
+from datetime import datetime, timedelta, timezone
 
 from flask import Flask
+from sqlalchemy import create_engine, exc, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import QueuePool
 
 from service.models import (
+    ALL_PRODUCTS,
+    CHANGED_PRODUCTS,
+    WORKER_ID,
+    clock_timestamp,
+    DATA_COLUMNS,
     ID,
     PRODUCT_ID,
     PRODUCT_NAME,
@@ -16,16 +27,32 @@ from service.models import (
     REC_NAME,
     REC_TYPE,
     LIKE_NUM,
+    VERSION,
+    UPDATED_AT,
+    DELETED,
+    DataConflictError,
     DataValidationError,
     Recommendation,
+    StaleVersionError,
+    Tombstone,
     Type,
+    adjacency,
     db,
+    engine_options,
+    handle_notification,
+    invalidate_product,
+    list_cache,
+    pool_stats,
+    top_cache,
 )
 
 from werkzeug.exceptions import NotFound
 
 from tests.factories import RecommendationFactory
 
+# the database of the tests needing PostgreSQL, which are skipped on any other
+DATABASE_URI = os.getenv("DATABASE_URI", "")
+
 
 ######################################################################
 #  <your resource name>   M O D E L   T E S T   C A S E S
@@ -58,7 +85,11 @@ class TestRecommendationModel(unittest.TestCase):
     def setUp(self):
         """This runs before each test"""
         db.session.query(Recommendation).delete()
+        db.session.query(Tombstone).delete()
         db.session.commit()
+        list_cache.clear()
+        top_cache.clear()
+        adjacency.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -224,6 +255,116 @@ class TestRecommendationModel(unittest.TestCase):
         self.assertEqual(recs[0].id, original_id)
         self.assertEqual(recs[0].product_name, "foo")
 
+    def test_like_by_id(self):
+        """It should atomically Like a Rec by its id"""
+        rec = RecommendationFactory(like_num=3)
+        rec.create()
+        liked = Recommendation.like_by_id(rec.id)
+        self.assertEqual(liked.id, rec.id)
+        self.assertEqual(liked.like_num, 4)
+        self.assertEqual(Recommendation.find(rec.id).like_num, 4)
+        self.assertIsNone(Recommendation.like_by_id(0))
+
+    def test_unlike_by_id_stops_at_zero(self):
+        """It should not Unlike a Rec below zero likes"""
+        rec = RecommendationFactory(like_num=1)
+        rec.create()
+        self.assertEqual(Recommendation.unlike_by_id(rec.id).like_num, 0)
+        self.assertEqual(Recommendation.unlike_by_id(rec.id).like_num, 0)
+        self.assertEqual(Recommendation.find(rec.id).like_num, 0)
+        self.assertIsNone(Recommendation.unlike_by_id(0))
+
+    def test_concurrent_likes(self):
+        """It should not lose Likes sent from many threads at once"""
+        rec = RecommendationFactory(like_num=0)
+        rec.create()
+        rec_id = rec.id
+        threads_count, likes_per_thread = 8, 25
+
+        def hammer():
+            with self.app.app_context():
+                for _ in range(likes_per_thread):
+                    Recommendation.like_by_id(rec_id)
+                db.session.remove()
+
+        threads = [threading.Thread(target=hammer) for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.session.expire_all()
+        self.assertEqual(
+            Recommendation.find(rec_id).like_num, threads_count * likes_per_thread
+        )
+
+    def test_apply_like_deltas(self):
+        """It should apply a batch of like deltas in one call"""
+        recs = [RecommendationFactory(like_num=2) for _ in range(3)]
+        for rec in recs:
+            rec.create()
+        ids = [rec.id for rec in recs]
+        Recommendation.apply_like_deltas({ids[0]: 5, ids[1]: -1, ids[2]: -10})
+        db.session.expire_all()
+        self.assertEqual(Recommendation.find(ids[0]).like_num, 7)
+        self.assertEqual(Recommendation.find(ids[1]).like_num, 1)
+        self.assertEqual(Recommendation.find(ids[2]).like_num, 0)
+
+    def test_version_increases_on_writes(self):
+        """It should increase the version of a Rec on every kind of write"""
+        rec = RecommendationFactory(like_num=1)
+        rec.create()
+        self.assertEqual(rec.version, 1)
+        rec.product_name = "foo"
+        rec.update()
+        self.assertEqual(rec.version, 2)
+        rec.like()
+        self.assertEqual(rec.version, 3)
+        self.assertEqual(Recommendation.unlike_by_id(rec.id).version, 4)
+        Recommendation.apply_like_deltas({rec.id: 2})
+        again = Recommendation(**{name: getattr(rec, name) for name in DATA_COLUMNS})
+        again.upsert()
+        self.assertEqual(Recommendation.find_row(rec.id)[VERSION], 6)
+        ids = Recommendation.bulk_create([{name: getattr(RecommendationFactory(), name) for name in DATA_COLUMNS}])
+        self.assertEqual(Recommendation.find_row(ids[0])[VERSION], 1)
+
+    def test_stale_update(self):
+        """It should not Update a Rec changed since it was read"""
+        rec = RecommendationFactory()
+        rec.create()
+        rec_id = rec.id
+        self.assertEqual(rec.version, 1)
+
+        def concurrent_like():
+            # a write the session does not know about, as from another worker
+            db.session.execute(
+                text("UPDATE recommendation SET like_num = like_num + 1, version = version + 1 WHERE id = :id"),
+                {"id": rec_id},
+            )
+
+        concurrent_like()
+        rec.product_name = "foo"
+        self.assertRaises(StaleVersionError, rec.update)
+        rec = Recommendation.find(rec_id)
+        self.assertEqual(rec.version, 1)
+        self.assertRaises(DataConflictError, rec.deserialize, dict(rec.serialize(), version=0))
+        rec.deserialize(dict(rec.serialize(), product_name="foo"))
+        rec.update()
+        self.assertEqual((rec.product_name, rec.version), ("foo", 2))
+        # a delete does not care about the version
+        concurrent_like()
+        rec.delete()
+        self.assertIsNone(Recommendation.find(rec_id))
+
+    def test_like_by_id_version(self):
+        """It should only Like a Rec at the version given"""
+        rec = RecommendationFactory(like_num=0)
+        rec.create()
+        self.assertEqual(Recommendation.like_by_id(rec.id, 1).like_num, 1)
+        self.assertRaises(StaleVersionError, Recommendation.like_by_id, rec.id, 1)
+        self.assertRaises(StaleVersionError, Recommendation.unlike_by_id, rec.id, 1)
+        self.assertEqual(Recommendation.unlike_by_id(rec.id, 2).like_num, 0)
+        self.assertIsNone(Recommendation.like_by_id(0, 1))
+
     def test_unlike_no_id(self):
         """It should not Unlike a Rec with no id"""
         rec = RecommendationFactory()
@@ -386,6 +527,427 @@ class TestRecommendationModel(unittest.TestCase):
         """It should return 404 not found"""
         self.assertRaises(NotFound, Recommendation.find_or_404, 0)
 
+    def test_indexes_declared(self):
+        """It should index the columns used by the find_by_* queries"""
+        indexes = {
+            index["name"]: index["column_names"]
+            for index in inspect(db.engine).get_indexes("recommendation")
+        }
+        self.assertEqual(
+            indexes["ix_recommendation_product_id_rec_type"], ["product_id", "rec_type"]
+        )
+        self.assertEqual(indexes["ix_recommendation_rec_id"], ["rec_id"])
+        self.assertEqual(indexes["ix_recommendation_product_name"], ["product_name"])
+        self.assertEqual(indexes["ix_recommendation_rec_name"], ["rec_name"])
+        self.assertEqual(indexes["uq_recommendation_edge"], ["product_id", "rec_id", "rec_type"])
+
+    def test_create_missing_indexes(self):
+        """It should create indexes that are missing on an existing table"""
+        db.session.execute(text("DROP INDEX ix_recommendation_rec_id"))
+        db.session.commit()
+        names = [index["name"] for index in inspect(db.engine).get_indexes("recommendation")]
+        self.assertNotIn("ix_recommendation_rec_id", names)
+        created = Recommendation.create_indexes()
+        self.assertIn("ix_recommendation_rec_id", created)
+        names = [index["name"] for index in inspect(db.engine).get_indexes("recommendation")]
+        self.assertIn("ix_recommendation_rec_id", names)
+        # running it again is harmless
+        Recommendation.create_indexes()
+
+    def test_create_missing_columns(self):
+        """It should add columns that are missing on an existing table"""
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE recommendation DROP COLUMN version"))
+            conn.execute(Recommendation.__table__.insert(), {
+                name: getattr(RecommendationFactory(), name) for name in DATA_COLUMNS
+            })
+        self.assertEqual(Recommendation.create_columns(), [VERSION])
+        with db.engine.connect() as conn:
+            self.assertEqual(conn.execute(text("SELECT version FROM recommendation")).scalars().all(), [1])
+        # running it again is harmless
+        self.assertEqual(Recommendation.create_columns(), [])
+
+    def test_find_rows_columns(self):
+        """It should select only the requested columns"""
+        rec = RecommendationFactory(rec_type=Type.ACCESSORY)
+        rec.create()
+        self.assertEqual(Recommendation.find_rows(), [rec.serialize()])
+        self.assertEqual(
+            Recommendation.find_rows(columns=(REC_ID, REC_TYPE)),
+            [{REC_ID: rec.rec_id, REC_TYPE: "ACCESSORY"}],
+        )
+        self.assertEqual(Recommendation.find_row(rec.id, (LIKE_NUM,)), {LIKE_NUM: rec.like_num})
+        self.assertEqual(Recommendation.find_row(rec.id), rec.serialize())
+        self.assertIsNone(Recommendation.find_row(rec.id + 1))
+        self.assertIsNone(Recommendation.find_row("abc"))
+
+    def test_find_page(self):
+        """It should return Recommendations one page at a time"""
+        recs = RecommendationFactory.create_batch(5)
+        for rec in recs:
+            rec.create()
+        ids = sorted(rec.id for rec in recs)
+        page = Recommendation.find_page(limit=2)
+        self.assertEqual([rec.id for rec in page], ids[:2])
+        page = Recommendation.find_page(after_id=ids[1], limit=2)
+        self.assertEqual([rec.id for rec in page], ids[2:4])
+        page = Recommendation.find_page(product_id=recs[4].product_id, after_id=0)
+        self.assertEqual([rec.id for rec in page], [recs[4].id])
+
+    def test_create_duplicate_edge(self):
+        """It should not Create two Recs for the same edge"""
+        rec = RecommendationFactory()
+        rec.create()
+        duplicate = Recommendation(
+            product_id=rec.product_id,
+            product_name="other",
+            rec_id=rec.rec_id,
+            rec_name="other",
+            rec_type=rec.rec_type,
+            like_num=0,
+        )
+        self.assertRaises(DataConflictError, duplicate.create)
+        self.assertEqual(len(Recommendation.all()), 1)
+
+    def test_create_missing_field(self):
+        """It should report a missing field as invalid data, not as a duplicate"""
+        rec = RecommendationFactory(rec_name=None)
+        self.assertRaises(DataValidationError, rec.create)
+        rec = RecommendationFactory(product_name=None)
+        self.assertRaises(DataValidationError, rec.upsert)
+        self.assertEqual(Recommendation.all(), [])
+
+    def test_upsert(self):
+        """It should Create a Rec once and then Update it by its edge"""
+        rec = RecommendationFactory(like_num=1)
+        self.assertTrue(rec.upsert())
+        original_id = rec.id
+        again = Recommendation(
+            product_id=rec.product_id,
+            product_name="renamed",
+            rec_id=rec.rec_id,
+            rec_name=rec.rec_name,
+            rec_type=rec.rec_type,
+            like_num=5,
+        )
+        self.assertFalse(again.upsert())
+        self.assertEqual(again.id, original_id)
+        recs = Recommendation.all()
+        self.assertEqual(len(recs), 1)
+        self.assertEqual(recs[0].product_name, "renamed")
+        self.assertEqual(recs[0].like_num, 5)
+
+    def test_bulk_create_skips_duplicates(self):
+        """It should skip duplicate edges in a bulk Create"""
+        existing = RecommendationFactory()
+        existing.create()
+        rows = [
+            {name: getattr(rec, name) for name in DATA_COLUMNS}
+            for rec in (RecommendationFactory(), existing, RecommendationFactory())
+        ]
+        rows.append(dict(rows[0]))
+        ids = Recommendation.bulk_create(rows, chunk_size=2)
+        self.assertIsNotNone(ids[0])
+        self.assertIsNone(ids[1])
+        self.assertIsNotNone(ids[2])
+        self.assertIsNone(ids[3])
+        self.assertEqual(len(Recommendation.all()), 3)
+
+    def test_dedupe(self):
+        """It should merge duplicate edges and sum their likes"""
+        db.session.execute(text("DROP INDEX uq_recommendation_edge"))
+        db.session.commit()
+        try:
+            rec = RecommendationFactory(like_num=2)
+            rec.create()
+            for likes in (3, 4):
+                Recommendation(
+                    product_id=rec.product_id,
+                    product_name=rec.product_name,
+                    rec_id=rec.rec_id,
+                    rec_name=rec.rec_name,
+                    rec_type=rec.rec_type,
+                    like_num=likes,
+                ).create()
+            other = RecommendationFactory(like_num=1)
+            other.create()
+            rec_id, other_id = rec.id, other.id
+            self.assertEqual(Recommendation.dedupe(), (1, 2))
+            db.session.expire_all()
+            recs = Recommendation.all()
+            self.assertEqual(sorted(rec.id for rec in recs), [rec_id, other_id])
+            self.assertEqual(Recommendation.find(rec_id).like_num, 9)
+            self.assertEqual(Recommendation.find(other_id).like_num, 1)
+            self.assertEqual(db.session.query(Tombstone).count(), 2)
+        finally:
+            Recommendation.create_indexes()
+
+    def test_timestamps_follow_writes(self):
+        """It should set created_at once and move updated_at on every write"""
+        rec = RecommendationFactory()
+        rec.create()
+        created_at = rec.created_at
+        self.assertEqual(rec.updated_at, created_at)
+        stamps = [created_at]
+        rec.product_name = "renamed"
+        rec.update()
+        stamps.append(rec.updated_at)
+        stamps.append(Recommendation.like_by_id(rec.id).updated_at)
+        Recommendation.apply_like_deltas({rec.id: 2})
+        db.session.expire_all()
+        stamps.append(Recommendation.find(rec.id).updated_at)
+        again = Recommendation(**{name: getattr(rec, name) for name in DATA_COLUMNS})
+        again.upsert()
+        db.session.expire_all()
+        rec = Recommendation.find(rec.id)
+        stamps.append(rec.updated_at)
+        self.assertEqual(rec.created_at, created_at)
+        self.assertEqual(stamps, sorted(stamps))
+        self.assertEqual(len(set(stamps)), len(stamps))
+
+    def test_find_changes(self):
+        """It should return the changes after a watermark, deletes included, page by page"""
+        recs = RecommendationFactory.create_batch(3)
+        for rec in recs:
+            rec.create()
+        first, second, third = (rec.id for rec in recs)
+        changes, watermark = Recommendation.find_changes(limit=2)
+        self.assertEqual([change[ID] for change in changes], [first, second])
+        self.assertEqual(changes[0], dict(recs[0].serialize(), updated_at=changes[0][UPDATED_AT], deleted=False))
+        recs[0].like()
+        recs[1].delete()
+        changes, watermark = Recommendation.find_changes(watermark, limit=2)
+        self.assertEqual([(change[ID], change[DELETED]) for change in changes], [(third, False), (first, False)])
+        self.assertEqual(changes[1][LIKE_NUM], recs[0].like_num)
+        changes, watermark = Recommendation.find_changes(watermark, limit=2)
+        self.assertEqual(changes, [
+            {ID: second, PRODUCT_ID: recs[1].product_id, UPDATED_AT: changes[0][UPDATED_AT], DELETED: True}
+        ])
+        # caught up: the watermark moves on to now without repeating anything
+        changes, watermark = Recommendation.find_changes(watermark, limit=2)
+        self.assertEqual(changes, [])
+        self.assertLessEqual(watermark[0], datetime.now(timezone.utc))
+        self.assertEqual(Recommendation.find_changes(watermark)[0], [])
+
+    def test_clock_timestamp(self):
+        """It should stamp rows with the time they are written, not when their transaction began"""
+        self.assertEqual(str(clock_timestamp().compile(dialect=postgresql.dialect())), "clock_timestamp()")
+        self.assertEqual(str(clock_timestamp().compile(dialect=sqlite.dialect())), "CURRENT_TIMESTAMP")
+
+    def test_find_changes_settle(self):
+        """It should hold back changes younger than the settle time"""
+        rec = RecommendationFactory()
+        rec.create()
+        changes, watermark = Recommendation.find_changes(settle=60)
+        self.assertEqual(changes, [])
+        self.assertLess(watermark[0], rec.updated_at.replace(tzinfo=timezone.utc))
+        changes, _ = Recommendation.find_changes(watermark)
+        self.assertEqual([change[ID] for change in changes], [rec.id])
+
+    def test_purge_tombstones(self):
+        """It should purge only the tombstones older than a time"""
+        recs = RecommendationFactory.create_batch(2)
+        for rec in recs:
+            rec.create()
+        for rec in recs:
+            rec.delete()
+        self.assertEqual(Tombstone.purge(datetime.now(timezone.utc) - timedelta(days=1)), 0)
+        self.assertEqual(Tombstone.purge(datetime.now(timezone.utc) + timedelta(seconds=1)), 2)
+        self.assertEqual(Recommendation.find_changes()[0], [])
+
+    def test_find_serialized_reads_through_cache(self):
+        """It should serve repeated product lists from the cache"""
+        rec = RecommendationFactory()
+        rec.create()
+        product_id = rec.product_id
+        hits = list_cache.hits
+        first = Recommendation.find_serialized(product_id)
+        self.assertEqual([row[ID] for row in first], [rec.id])
+        # a change behind the model's back is not seen until invalidated
+        db.session.execute(text("UPDATE recommendation SET product_name = 'sneaky'"))
+        db.session.commit()
+        self.assertIs(Recommendation.find_serialized(str(product_id)), first)
+        self.assertEqual(list_cache.hits - hits, 1)
+        self.assertRaises(DataValidationError, Recommendation.find_serialized, "abc")
+
+    def test_find_serialized_many(self):
+        """It should look up many products with one query, sharing the cache"""
+        for product_id in (1, 1, 2):
+            RecommendationFactory(product_id=product_id, rec_type=Type.UP_SELL).create()
+        RecommendationFactory(product_id=2, rec_type=Type.ACCESSORY).create()
+        cached = Recommendation.find_serialized(2)
+        results = Recommendation.find_serialized_many([1, "2", 3, 1])
+        self.assertEqual(list(results), [1, 2, 3])
+        self.assertEqual(len(results[1]), 2)
+        self.assertIs(results[2], cached)
+        self.assertEqual(results[3], [])
+        # the products read by the batch are now cached for single lookups
+        self.assertIs(Recommendation.find_serialized(1), results[1])
+        results = Recommendation.find_serialized_many([2], Type.ACCESSORY)
+        self.assertEqual([row[REC_TYPE] for row in results[2]], ["ACCESSORY"])
+        self.assertRaises(DataValidationError, Recommendation.find_serialized_many, ["abc"])
+
+    def test_product_rows_digest(self):
+        """It should change a product list's digest when the list changes"""
+        rec = RecommendationFactory(like_num=0)
+        rec.create()
+        rows = Recommendation.find_serialized(rec.product_id)
+        self.assertEqual(rows.digest, Recommendation.find_serialized(rec.product_id).digest)
+        rec.like()
+        self.assertNotEqual(Recommendation.find_serialized(rec.product_id).digest, rows.digest)
+        self.assertNotEqual(Recommendation.find_serialized(0).digest, rows.digest)
+
+    def test_writes_invalidate_cache(self):
+        """It should invalidate cached lists on every kind of write"""
+        rec = RecommendationFactory(like_num=0)
+        rec.create()
+        product_id = rec.product_id
+
+        def cached_likes():
+            return [row[LIKE_NUM] for row in Recommendation.find_serialized(product_id)]
+
+        self.assertEqual(cached_likes(), [0])
+        Recommendation.like_by_id(rec.id)
+        self.assertEqual(cached_likes(), [1])
+        Recommendation.unlike_by_id(rec.id)
+        self.assertEqual(cached_likes(), [0])
+        Recommendation.apply_like_deltas({rec.id: 3})
+        self.assertEqual(cached_likes(), [3])
+        other = RecommendationFactory(product_id=product_id, like_num=7)
+        other.create()
+        self.assertEqual(cached_likes(), [3, 7])
+        other = Recommendation.find(other.id)
+        other.like_num = 8
+        other.update()
+        self.assertEqual(cached_likes(), [3, 8])
+        # moving a row to another product invalidates both products
+        self.assertEqual(len(Recommendation.find_serialized(product_id + 1000)), 0)
+        other.product_id = product_id + 1000
+        other.update()
+        self.assertEqual(cached_likes(), [3])
+        self.assertEqual(len(Recommendation.find_serialized(product_id + 1000)), 1)
+        Recommendation.find(rec.id).delete()
+        self.assertEqual(cached_likes(), [])
+
+    def test_cache_invalidated_only_on_commit(self):
+        """It should invalidate cached lists when the write commits, not on rollback"""
+        rec = RecommendationFactory()
+        rec.create()
+        Recommendation.find_serialized(rec.product_id)
+        duplicate = RecommendationFactory(
+            product_id=rec.product_id, rec_id=rec.rec_id, rec_type=rec.rec_type
+        )
+        generation = list_cache.generation(rec.product_id)
+        self.assertRaises(DataConflictError, duplicate.create)
+        self.assertEqual(list_cache.generation(rec.product_id), generation)
+        self.assertNotIn(CHANGED_PRODUCTS, db.session.info)
+        Recommendation.like_by_id(rec.id)
+        self.assertNotEqual(list_cache.generation(rec.product_id), generation)
+        self.assertNotIn(CHANGED_PRODUCTS, db.session.info)
+
+    def test_find_top(self):
+        """It should rank a product's recommendations by likes"""
+        recs = []
+        for likes in (5, 9, 1, 9):
+            rec = RecommendationFactory(product_id=1, rec_type=Type.UP_SELL, like_num=likes)
+            rec.create()
+            recs.append(rec)
+        RecommendationFactory(product_id=2, like_num=100).create()
+        top = Recommendation.find_top(1, k=3)
+        self.assertEqual([row[ID] for row in top], [recs[1].id, recs[3].id, recs[0].id])
+        self.assertEqual(len(Recommendation.find_top(1, k=10)), 4)
+        self.assertEqual(len(Recommendation.find_top(1, Type.UP_SELL, k=10)), 4)
+        self.assertEqual(Recommendation.find_top(1, Type.BUY_WITH, k=10), [])
+        self.assertEqual(Recommendation.find_top(3), [])
+        self.assertRaises(DataValidationError, Recommendation.find_top, "abc")
+
+    def test_find_top_is_maintained_in_place(self):
+        """It should update a loaded ranking on like, unlike and delete without reloading it"""
+        recs = []
+        for likes in (3, 2, 1):
+            rec = RecommendationFactory(product_id=1, rec_type=Type.UP_SELL, like_num=likes)
+            rec.create()
+            recs.append(rec)
+        Recommendation.find_top(1)
+        Recommendation.find_top(1, Type.UP_SELL)
+        ranking = top_cache.peek((1, None))
+        Recommendation.like_by_id(recs[2].id)
+        Recommendation.like_by_id(recs[2].id)
+        Recommendation.like_by_id(recs[2].id)
+        Recommendation.unlike_by_id(recs[0].id)
+        expected = [(recs[2].id, 4), (recs[0].id, 2), (recs[1].id, 2)]
+        for rec_type in (None, Type.UP_SELL):
+            top = Recommendation.find_top(1, rec_type)
+            self.assertEqual([(row[ID], row[LIKE_NUM]) for row in top], expected)
+        Recommendation.find(recs[0].id).delete()
+        self.assertEqual([row[ID] for row in Recommendation.find_top(1)], [recs[2].id, recs[1].id])
+        self.assertIs(top_cache.peek((1, None)), ranking)
+        # other writes drop the ranking, which is reloaded on the next read
+        RecommendationFactory(product_id=1, like_num=10).create()
+        self.assertIsNone(top_cache.peek((1, None)))
+        self.assertEqual(len(Recommendation.find_top(1)), 3)
+
+    def test_find_top_reloads_when_too_shallow(self):
+        """It should reload a truncated ranking that cannot serve k rows"""
+        depth = Recommendation.top_depth
+        Recommendation.top_depth = 2
+        try:
+            recs = []
+            for likes in (3, 2, 1):
+                rec = RecommendationFactory(product_id=1, like_num=likes)
+                rec.create()
+                recs.append(rec)
+            self.assertEqual(len(Recommendation.find_top(1, k=2)), 2)
+            Recommendation.unlike_by_id(recs[0].id)
+            Recommendation.unlike_by_id(recs[0].id)
+            Recommendation.unlike_by_id(recs[0].id)
+            # the row left the held top 2, so the ranking is reloaded
+            top = Recommendation.find_top(1, k=2)
+            self.assertEqual([row[ID] for row in top], [recs[1].id, recs[2].id])
+        finally:
+            Recommendation.top_depth = depth
+
+    def test_traverse(self):
+        """It should follow recommendations of recommendations kept current by writes"""
+        first = RecommendationFactory(product_id=1, rec_id=2, like_num=0)
+        first.create()
+        RecommendationFactory(product_id=2, rec_id=3, like_num=0).create()
+        RecommendationFactory(product_id=3, rec_id=1, like_num=0).create()
+        result = Recommendation.traverse(1, depth=3)
+        self.assertEqual([(rec["product_id"], rec["depth"]) for rec in result], [(2, 1), (3, 2)])
+        self.assertTrue(adjacency.loaded)
+        # a new edge is read back, likes and deletes are applied in place
+        second = RecommendationFactory(product_id=1, rec_id=4, like_num=0)
+        second.create()
+        Recommendation.like_by_id(second.id)
+        result = Recommendation.traverse(1, depth=1)
+        self.assertEqual([rec["product_id"] for rec in result], [4, 2])
+        self.assertAlmostEqual(result[0]["score"], 2 / 3)
+        Recommendation.find(second.id).delete()
+        result = Recommendation.traverse(1, depth=1, min_depth=1)
+        self.assertEqual([rec["product_id"] for rec in result], [2])
+        self.assertEqual(adjacency.stats()["dirty"], 0)
+        self.assertRaises(DataValidationError, Recommendation.traverse, "abc")
+
+    def test_notifications_from_this_worker_are_skipped(self):
+        """It should only invalidate on notifications from other workers"""
+        list_cache.put((1, None), [], tag=1)
+        handle_notification(f"{WORKER_ID}:1")
+        self.assertEqual(list_cache.get((1, None)), [])
+        handle_notification("another-worker:1")
+        self.assertIsNone(list_cache.get((1, None)))
+
+    def test_invalidate_product(self):
+        """It should invalidate one product, or every product for ALL_PRODUCTS"""
+        list_cache.put((1, None), [], tag=1)
+        list_cache.put((2, None), [], tag=2)
+        invalidate_product("1")
+        self.assertIsNone(list_cache.get((1, None)))
+        self.assertEqual(list_cache.get((2, None)), [])
+        invalidate_product(ALL_PRODUCTS)
+        self.assertIsNone(list_cache.get((2, None)))
+        self.assertRaises(ValueError, invalidate_product, "abc")
+
     def test_find_by_params(self):
         """It should find recommendation by Product id and recommendation type"""
         rec = Recommendation(
@@ -408,3 +970,148 @@ class TestRecommendationModel(unittest.TestCase):
         self.assertEqual(rec.rec_id, result[0].rec_id)
         self.assertEqual(rec.rec_name, result[0].rec_name)
         self.assertEqual(rec.rec_type, result[0].rec_type)
+
+    def test_engine_options(self):
+        """It should size and configure the pool of server databases"""
+        config = {
+            "DB_POOL_SIZE": 3,
+            "DB_MAX_OVERFLOW": 2,
+            "DB_POOL_TIMEOUT": 1.5,
+            "DB_POOL_RECYCLE": 600,
+            "DB_POOL_PRE_PING": True,
+            "DB_STATEMENT_TIMEOUT_MS": 5000,
+            "DB_APPLICATION_NAME": "recs-test",
+        }
+        self.assertEqual(engine_options({**config, "SQLALCHEMY_DATABASE_URI": "sqlite:///test.db"}), {})
+        options = engine_options({**config, "SQLALCHEMY_DATABASE_URI": "postgresql://u:p@db:5432/recs"})
+        self.assertEqual(options["pool_size"], 3)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertEqual(options["pool_timeout"], 1.5)
+        self.assertEqual(options["pool_recycle"], 600)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(
+            options["connect_args"], {"application_name": "recs-test", "options": "-c statement_timeout=5000"}
+        )
+        config["DB_STATEMENT_TIMEOUT_MS"] = 0
+        options = engine_options({**config, "SQLALCHEMY_DATABASE_URI": "postgresql+psycopg2://db/recs"})
+        self.assertEqual(options["connect_args"], {"application_name": "recs-test"})
+        options = engine_options({**config, "SQLALCHEMY_DATABASE_URI": "mysql://db/recs"})
+        self.assertNotIn("connect_args", options)
+
+    def test_init_db_replaces_engine_options(self):
+        """It should work out the engine options anew for each database"""
+        self.app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_size": 5, "connect_args": {"application_name": "x"}}
+        self.app.config["DB_ENGINE_OPTIONS"] = {"echo_pool": False}
+        try:
+            Recommendation.init_db(self.app)
+            self.assertEqual(self.app.config["SQLALCHEMY_ENGINE_OPTIONS"], {"echo_pool": False})
+            RecommendationFactory().create()
+            self.assertEqual(len(Recommendation.all()), 1)
+        finally:
+            del self.app.config["DB_ENGINE_OPTIONS"]
+            Recommendation.init_db(self.app)
+
+    def test_pool_stats(self):
+        """It should report the connections of a pool until it is exhausted"""
+        self.assertIsNone(pool_stats(create_engine("sqlite://").pool))
+        engine = create_engine("sqlite://", poolclass=QueuePool, pool_size=1, max_overflow=1, pool_timeout=0.01)
+        first = engine.connect()
+        second = engine.connect()
+        stats = pool_stats(engine.pool)
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["checked_out"], 2)
+        self.assertEqual(stats["overflow"], 1)
+        self.assertEqual(stats["max_overflow"], 1)
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+        first.close()
+        second.close()
+        self.assertEqual(pool_stats(engine.pool)["checked_out"], 0)
+        engine.dispose()
+
+
+######################################################################
+#  P O S T G R E S Q L   T E S T   C A S E S
+######################################################################
+@unittest.skipUnless(DATABASE_URI.startswith("postgresql"), "needs a PostgreSQL DATABASE_URI")
+class TestRecommendationPostgres(unittest.TestCase):
+    """Test Cases for the PostgreSQL statements of the Recommendation Model"""
+
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        cls.app = Flask(__name__)
+        cls.app.config["TESTING"] = True
+        cls.app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        cls.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        Recommendation.init_db(cls.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        db.session.close()
+
+    def setUp(self):
+        """This runs before each test"""
+        db.session.query(Recommendation).delete()
+        db.session.query(Tombstone).delete()
+        db.session.commit()
+        list_cache.clear()
+        top_cache.clear()
+        adjacency.clear()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_create_stamps_updated_at(self):
+        """It should create a Rec whose updated_at is its created_at"""
+        rec = RecommendationFactory()
+        rec.create()
+        self.assertEqual(rec.updated_at, rec.created_at)
+        self.assertEqual(rec.version, 1)
+
+    def test_bulk_create(self):
+        """It should bulk Create with multi-row INSERTs and skip duplicate edges"""
+        existing = RecommendationFactory()
+        existing.create()
+        rows = [
+            {name: getattr(rec, name) for name in DATA_COLUMNS}
+            for rec in (RecommendationFactory(), existing, RecommendationFactory(), RecommendationFactory())
+        ]
+        rows.append(dict(rows[0]))
+        ids = Recommendation.bulk_create(rows, chunk_size=3)
+        self.assertIsNotNone(ids[0])
+        self.assertIsNone(ids[1])
+        self.assertIsNotNone(ids[2])
+        self.assertIsNotNone(ids[3])
+        self.assertIsNone(ids[4])
+        self.assertNotIn("created_at", rows[0])
+        created = [Recommendation.find(id) for id in (ids[0], ids[2], ids[3])]
+        for rec in created:
+            self.assertEqual(rec.updated_at, rec.created_at)
+        self.assertEqual(created[0].created_at, created[1].created_at)
+        self.assertLess(created[1].created_at, created[2].created_at)
+        self.assertEqual(len(Recommendation.all()), 4)
+
+    def test_copy_import_keeps_last_row(self):
+        """It should import the last row of a repeated edge and stamp new rows once"""
+        existing = RecommendationFactory(product_id=1, rec_id=3, rec_type=Type.UP_SELL, like_num=1)
+        existing.create()
+        rows = (
+            "1,Phone,2,Case,BUY_WITH,5\n"
+            "1,Phone,3,Charger,UP_SELL,6\n"
+            "1,Phone,2,Cover,BUY_WITH,7\n"
+        )
+        copied, inserted, updated = Recommendation.copy_import(io.StringIO(rows))
+        self.assertEqual((copied, inserted, updated), (3, 1, 1))
+        db.session.expire_all()
+        created = Recommendation.query.filter_by(product_id=1, rec_id=2, rec_type=Type.BUY_WITH).one()
+        self.assertEqual((created.rec_name, created.like_num), ("Cover", 7))
+        self.assertEqual(created.updated_at, created.created_at)
+        changed = Recommendation.find(existing.id)
+        self.assertEqual((changed.rec_name, changed.like_num, changed.version), ("Charger", 6, 2))
+        self.assertEqual(changed.updated_at, created.updated_at)
+        self.assertGreater(changed.updated_at, changed.created_at)
@@ -0,0 +1,117 @@
+"""
+Test cases for the request profiler
+
+"""
+import os
+import pstats
+import tempfile
+import time
+import unittest
+
+from flask import Flask, Response
+
+from service.utils.profiling import Profiler
+
+
+######################################################################
+#  P R O F I L E R   T E S T   C A S E S
+######################################################################
+class TestProfiler(unittest.TestCase):
+    """Test Cases for the request profiler"""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+
+        @self.app.route("/slow")
+        def slow():
+            time.sleep(0.03)
+            return "done"
+
+        @self.app.route("/stream")
+        def stream():
+            def chunks():
+                yield "a"
+                time.sleep(0.03)
+                yield "b"
+            return Response(chunks())
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def install(self, **options):
+        """Wraps the app in a profiler writing to the test folder"""
+        profiler = Profiler(self.app.wsgi_app, self.folder.name, interval=0.001, **options)
+        self.app.wsgi_app = profiler
+        return profiler
+
+    def test_profiles_on_request(self):
+        """It should only profile requests whose X-Profile header is the token"""
+        profiler = self.install(token="s3cr3t")
+        client = self.app.test_client()
+        client.get("/slow")
+        client.get("/slow", headers={"X-Profile": "guess"})
+        self.assertEqual(profiler.recent(), [])
+        response = client.get("/slow", headers={"X-Profile": "s3cr3t"})
+        self.assertEqual(response.data, b"done")
+        # the profile is saved when the server closes the response
+        self.assertEqual(profiler.recent(), [])
+        response.close()
+        profiles = profiler.recent()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]["method"], "GET")
+        self.assertEqual(profiles[0]["path"], "/slow")
+        self.assertEqual(profiles[0]["status"], 200)
+        self.assertGreaterEqual(profiles[0]["duration_ms"], 30)
+        with open(os.path.join(self.folder.name, profiles[0]["file"]), encoding="utf-8") as folded:
+            lines = folded.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertGreater(int(count), 0)
+        self.assertIn("slow (test_profiling.py:", stack)
+
+    def test_cprofile(self):
+        """It should write pstats files in cprofile mode"""
+        profiler = self.install(mode="cprofile", token="s3cr3t")
+        self.app.test_client().get("/slow", headers={"X-Profile": "s3cr3t"}).close()
+        profile = profiler.recent()[0]
+        self.assertTrue(profile["file"].endswith(".prof"))
+        stats = pstats.Stats(os.path.join(self.folder.name, profile["file"]))
+        self.assertIn("slow", {function for _, _, function in stats.stats})
+
+    def test_no_token(self):
+        """It should ignore the header when no token is set"""
+        profiler = self.install()
+        self.app.test_client().get("/slow", headers={"X-Profile": ""})
+        self.assertEqual(profiler.recent(), [])
+
+    def test_sampling(self):
+        """It should profile a share of the requests"""
+        draws = iter([0.5, 0.05])
+        profiler = self.install(sample_rate=0.1, rand=lambda: next(draws))
+        client = self.app.test_client()
+        client.get("/slow").close()
+        client.get("/slow").close()
+        self.assertEqual(len(profiler.recent()), 1)
+
+    def test_streamed(self):
+        """It should profile a streamed response until it has been sent"""
+        profiler = self.install(sample_rate=1.0)
+        response = self.app.test_client().get("/stream")
+        self.assertEqual(response.data, b"ab")
+        response.close()
+        self.assertGreaterEqual(profiler.recent()[0]["duration_ms"], 30)
+
+    def test_keeps_newest(self):
+        """It should delete the oldest profiles beyond the number kept"""
+        profiler = self.install(sample_rate=1.0, keep=2)
+        client = self.app.test_client()
+        for _ in range(4):
+            client.get("/slow").close()
+        self.assertEqual(len(profiler.recent()), 2)
+        self.assertEqual(len(os.listdir(self.folder.name)), 4)
+
+    def test_unknown_mode(self):
+        """It should refuse an unknown profiling mode"""
+        with self.assertRaises(ValueError):
+            Profiler(self.app.wsgi_app, self.folder.name, mode="perf")
@@ -0,0 +1,89 @@
+"""
+Test cases for the query log
+
+"""
+import logging
+import unittest
+
+from flask import Flask
+from sqlalchemy import create_engine, text
+
+from service.utils.query_log import QueryLog, assert_max_queries, count_queries, query_log
+
+
+######################################################################
+#  Q U E R Y   L O G   T E S T   C A S E S
+######################################################################
+class TestQueryLog(unittest.TestCase):
+    """Test Cases for the query log"""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        self.app = Flask(__name__)
+        self.saved = (query_log.slow_ms, query_log.max_queries)
+        query_log.init_app(self.app, self.engine)
+
+        @self.app.route("/widgets/<int:count>")
+        def widgets(count):
+            with self.engine.connect() as conn:
+                for number in range(count):
+                    conn.execute(text("SELECT :number"), {"number": number})
+            return ""
+
+    def tearDown(self):
+        query_log.configure(*self.saved)
+
+    def test_count_queries(self):
+        """It should count the statements of a block, nested blocks included"""
+        with count_queries() as outer:
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                with count_queries() as inner:
+                    conn.execute(text("SELECT 2"))
+        self.assertEqual(outer.count, 2)
+        self.assertEqual(inner.statements, ["SELECT 2"])
+        self.assertGreaterEqual(outer.duration, inner.duration)
+
+    def test_assert_max_queries(self):
+        """It should fail listing the statements when a block runs too many"""
+        client = self.app.test_client()
+        with assert_max_queries(2):
+            client.get("/widgets/2")
+        with self.assertRaises(AssertionError) as raised:
+            with assert_max_queries(2):
+                client.get("/widgets/3")
+        self.assertIn("3 queries executed, expected at most 2", str(raised.exception))
+        self.assertIn("SELECT ?", str(raised.exception))
+
+    def test_flags_many_queries(self):
+        """It should flag requests issuing more statements than allowed"""
+        query_log.configure(slow_ms=0, max_queries=3)
+        client = self.app.test_client()
+        with self.assertLogs("flask.app", logging.WARNING) as logs:
+            client.get("/widgets/4")
+            client.get("/widgets/3")
+            logging.getLogger("flask.app").warning("done")
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("GET /widgets/<int:count> issued 4 queries", logs.output[0])
+        self.assertEqual(logs.records[0].queries, 4)
+
+    def test_logs_slow_queries(self):
+        """It should log slow statements with their parameters and route"""
+        query_log.configure(slow_ms=1e-6, max_queries=0)
+        client = self.app.test_client()
+        with self.assertLogs("flask.app", logging.WARNING) as logs:
+            client.get("/widgets/1")
+        self.assertIn("from GET /widgets/<int:count>: SELECT ? parameters (0,)", logs.output[0])
+        self.assertEqual(logs.records[0].route, "GET /widgets/<int:count>")
+        with self.assertLogs("flask.app", logging.WARNING) as logs:
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        self.assertIn("outside a request", logs.output[0])
+
+    def test_init_app_once(self):
+        """It should instrument an engine and an app only once"""
+        QueryLog().init_app(self.app, self.engine)
+        query_log.init_app(self.app, self.engine)
+        with count_queries() as stats:
+            self.app.test_client().get("/widgets/1")
+        self.assertEqual(stats.count, 1)
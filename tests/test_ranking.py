@@ -0,0 +1,73 @@
+"""
+Test cases for the top-K Ranking
+
+"""
+import unittest
+
+from service.utils.ranking import Ranking
+
+
+def row(rec_id, likes):
+    """Returns a serialized recommendation with just an id and likes"""
+    return {"id": rec_id, "like_num": likes}
+
+
+######################################################################
+#  R A N K I N G   T E S T   C A S E S
+######################################################################
+class TestRanking(unittest.TestCase):
+    """Test Cases for Ranking"""
+
+    def ids(self, ranking, k=10):
+        """Returns the ids of the top k rows"""
+        return [rec["id"] for rec in ranking.top(k)]
+
+    def test_complete_ranking(self):
+        """It should serve any k from a ranking that holds every row"""
+        ranking = Ranking([row(1, 5), row(2, 3)], depth=10)
+        self.assertTrue(ranking.complete)
+        self.assertEqual(self.ids(ranking, 1), [1])
+        self.assertEqual(self.ids(ranking, 50), [1, 2])
+
+    def test_update_reorders(self):
+        """It should move re-counted rows to their place, ties by id"""
+        ranking = Ranking([row(1, 5), row(2, 3), row(3, 1)], depth=10)
+        ranking.update(row(3, 5))
+        self.assertEqual(self.ids(ranking), [1, 3, 2])
+        ranking.update(row(1, 0))
+        self.assertEqual(self.ids(ranking), [3, 2, 1])
+        ranking.update(row(4, 4))
+        self.assertEqual(self.ids(ranking), [3, 4, 2, 1])
+
+    def test_update_beyond_depth(self):
+        """It should keep only depth rows and mark the ranking incomplete"""
+        ranking = Ranking([row(1, 5), row(2, 3)], depth=2)
+        ranking.update(row(3, 4))
+        self.assertFalse(ranking.complete)
+        self.assertEqual(self.ids(ranking, 2), [1, 3])
+
+    def test_truncated_ranking(self):
+        """It should drop rows that fall below a truncated ranking"""
+        ranking = Ranking([row(1, 5), row(2, 3), row(3, 1)], depth=2)
+        self.assertFalse(ranking.complete)
+        self.assertEqual(len(ranking), 2)
+        self.assertIsNone(ranking.top(3))
+        ranking.update(row(9, 0))  # ranks below the held rows
+        self.assertEqual(self.ids(ranking, 2), [1, 2])
+        ranking.update(row(1, 0))
+        self.assertEqual(self.ids(ranking, 1), [2])
+        self.assertIsNone(ranking.top(2))
+
+    def test_remove(self):
+        """It should remove deleted rows"""
+        ranking = Ranking([row(1, 5), row(2, 3)], depth=10)
+        ranking.remove(1)
+        ranking.remove(7)
+        self.assertEqual(self.ids(ranking), [2])
+
+    def test_readers_keep_their_list(self):
+        """It should not change a list already returned to a reader"""
+        ranking = Ranking([row(1, 5), row(2, 3)], depth=10)
+        top = ranking.top(2)
+        ranking.update(row(2, 9))
+        self.assertEqual([rec["id"] for rec in top], [1, 2])
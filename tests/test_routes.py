@@ -5,13 +5,20 @@ Test cases can be run with the following:
   nosetests -v --with-spec --spec-color
   coverage report -m
 """
+import gzip
+import json
 import logging
 import os
-from unittest import TestCase
+import tempfile
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase, mock, skipUnless
 
-from service import app
+from sqlalchemy import exc, text
+
+from service import app, routes
 
 from service.models import (
+    DATA_COLUMNS,
     ID,
     PRODUCT_ID,
     PRODUCT_NAME,
@@ -20,16 +27,27 @@ from service.models import (
     REC_TYPE,
     LIKE_NUM,
     Recommendation,
+    VERSION,
+    Tombstone,
+    Type,
+    adjacency,
     db,
+    list_cache,
+    top_cache,
 )
 
-from service.routes import init_db
+from service.routes import encode_watermark, init_db
 from service.utils import status  # HTTP Status Codes
+from service.utils.like_buffer import LikeBuffer
+from service.utils.profiling import Profiler
+from service.utils.query_log import assert_max_queries
 
 from tests.factories import RecommendationFactory
 
 from flask.logging import create_logger
 
+# the database of the tests needing PostgreSQL, which are skipped on any other
+DATABASE_URI = os.getenv("DATABASE_URI", "")
 BASE_URL = "/api/recommendations"
 CONTENT_TYPE_JSON = "application/json"
 
@@ -49,6 +67,7 @@ class TestRecommendationServer(TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
             basedir, "database.db"
         )
+        app.config["CHANGES_SETTLE_SECONDS"] = 0
         create_logger(app).setLevel(logging.CRITICAL)
         init_db()
 
@@ -64,7 +83,11 @@ class TestRecommendationServer(TestCase):
         """This runs before each test"""
         self.client = app.test_client()
         db.session.query(Recommendation).delete()
+        db.session.query(Tombstone).delete()
         db.session.commit()
+        list_cache.clear()
+        top_cache.clear()
+        adjacency.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -141,6 +164,39 @@ class TestRecommendationServer(TestCase):
         data = response.get_json()
         self.assertEqual(data["product_name"], test_rec.product_name)
 
+    def test_get_recommendation_fields(self):
+        """It should Get only the requested fields of a Recommendation"""
+        test_rec = self._create_recommendations(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_rec.id}?fields=rec_id,rec_name,like_num")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.get_json(),
+            {REC_ID: test_rec.rec_id, REC_NAME: test_rec.rec_name, LIKE_NUM: test_rec.like_num},
+        )
+        response = self.client.get(f"{BASE_URL}/{test_rec.id}?fields=rec_type")
+        self.assertEqual(response.get_json(), {REC_TYPE: test_rec.rec_type.name})
+        response = self.client.get(f"{BASE_URL}/{test_rec.id}?fields=rec_id,password")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("password", response.get_json()["message"])
+
+    def test_list_recommendation_fields(self):
+        """It should list only the requested fields, with or without the cache"""
+        test_recs = self._create_recommendations(3)
+        response = self.client.get(f"{BASE_URL}?fields=rec_id,like_num&limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.get_json(),
+            [{REC_ID: rec.rec_id, LIKE_NUM: rec.like_num} for rec in test_recs[:2]],
+        )
+        response = self.client.get(f"{BASE_URL}?fields=rec_id&cursor={response.headers['X-Next-Cursor']}")
+        self.assertEqual(response.get_json(), [{REC_ID: test_recs[2].rec_id}])
+        response = self.client.get(f"{BASE_URL}?product_id={test_recs[1].product_id}&fields=id, rec_name")
+        self.assertEqual(response.get_json(), [{ID: test_recs[1].id, REC_NAME: test_recs[1].rec_name}])
+        response = self.client.get(f"{BASE_URL}?fields={','.join(reversed(DATA_COLUMNS))},id")
+        self.assertEqual(len(response.get_json()[0]), 7)
+        response = self.client.get(f"{BASE_URL}?fields=bogus")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_recommendation_not_found(self):
         """It should not Get a Recommendation thats not found"""
         response = self.client.get(f"{BASE_URL}/0")
@@ -158,6 +214,420 @@ class TestRecommendationServer(TestCase):
         data = response.get_json()
         self.assertEqual(data[0]["product_name"], test_rec.product_name)
 
+    def test_list_recommendation_pages(self):
+        """It should page through Recommendations with a cursor"""
+        test_recs = self._create_recommendations(5)
+        seen = []
+        url = f"{BASE_URL}?limit=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertLessEqual(len(data), 2)
+            seen.extend(rec["id"] for rec in data)
+            cursor = response.headers.get("X-Next-Cursor")
+            url = f"{BASE_URL}?limit=2&cursor={cursor}" if cursor else None
+        self.assertEqual(seen, sorted(rec.id for rec in test_recs))
+
+    def test_list_recommendation_page_size(self):
+        """It should bound the page size of a Recommendation list"""
+        self._create_recommendations(3)
+        app.config["MAX_PAGE_SIZE"] = 2
+        try:
+            response = self.client.get(f"{BASE_URL}?limit=100")
+            self.assertEqual(len(response.get_json()), 2)
+            self.assertIn("X-Next-Cursor", response.headers)
+        finally:
+            app.config["MAX_PAGE_SIZE"] = 1000
+        response = self.client.get(f"{BASE_URL}?limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{BASE_URL}")
+        self.assertEqual(len(response.get_json()), 3)
+        self.assertNotIn("X-Next-Cursor", response.headers)
+
+    def test_list_recommendation_bad_cursor(self):
+        """It should not list Recommendations with an invalid cursor"""
+        response = self.client.get(f"{BASE_URL}?cursor=not-a-cursor")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("Invalid cursor", response.get_json()["message"])
+
+    def test_bulk_create_recommendations(self):
+        """It should Create many Recommendations from a JSON array"""
+        test_recs = [RecommendationFactory().serialize() for _ in range(5)]
+        for data in test_recs:
+            del data[ID]
+        app.config["BULK_CHUNK_SIZE"] = 2
+        try:
+            response = self.client.post(f"{BASE_URL}/bulk", json=test_recs)
+        finally:
+            app.config["BULK_CHUNK_SIZE"] = 1000
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(len(data["created"]), 5)
+        self.assertEqual(data["errors"], [])
+        for rec_id, test_rec in zip(data["created"], test_recs):
+            response = self.client.get(f"{BASE_URL}/{rec_id}")
+            self.assertEqual(response.get_json()[PRODUCT_NAME], test_rec[PRODUCT_NAME])
+
+    def test_bulk_create_reports_errors(self):
+        """It should report the invalid items of a bulk Create by position"""
+        good = RecommendationFactory().serialize()
+        bad_type = RecommendationFactory().serialize()
+        bad_type[REC_TYPE] = "NOT_A_TYPE"
+        missing = {PRODUCT_ID: 1}
+        response = self.client.post(f"{BASE_URL}/bulk", json=[missing, good, bad_type])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(len(data["created"]), 1)
+        self.assertEqual([error["index"] for error in data["errors"]], [0, 2])
+        self.assertIn("missing", data["errors"][0]["message"])
+        self.assertIn("rec_type", data["errors"][1]["message"])
+        response = self.client.post(f"{BASE_URL}/bulk", json=[missing])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_create_checks_types(self):
+        """It should report the items of a bulk Create with null or mistyped fields"""
+        good = RecommendationFactory().serialize()
+        null_name = dict(RecommendationFactory().serialize(), product_name=None)
+        bad_likes = dict(RecommendationFactory().serialize(), like_num="lots")
+        true_id = dict(RecommendationFactory().serialize(), rec_id=True)
+        response = self.client.post(f"{BASE_URL}/bulk", json=[good, null_name, bad_likes, true_id])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(len(data["created"]), 1)
+        self.assertEqual([error["index"] for error in data["errors"]], [1, 2, 3])
+        self.assertIn("product_name must be a string", data["errors"][0]["message"])
+        self.assertIn("like_num must be an integer", data["errors"][1]["message"])
+        self.assertIn("rec_id must be an integer", data["errors"][2]["message"])
+        self.assertEqual(len(Recommendation.all()), 1)
+
+    def test_bulk_create_ndjson(self):
+        """It should Create many Recommendations from an NDJSON body"""
+        lines = [json.dumps(RecommendationFactory().serialize()) for _ in range(3)]
+        lines.insert(1, "{not json")
+        response = self.client.post(
+            f"{BASE_URL}/bulk",
+            data="\n".join(lines) + "\n",
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(len(data["created"]), 3)
+        self.assertEqual([error["index"] for error in data["errors"]], [1])
+
+    def test_bulk_create_limits(self):
+        """It should not bulk Create a bad body or too many Recommendations"""
+        response = self.client.post(f"{BASE_URL}/bulk", json={"not": "a list"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        app.config["BULK_MAX_ITEMS"] = 1
+        try:
+            response = self.client.post(f"{BASE_URL}/bulk", json=[{}, {}])
+        finally:
+            app.config["BULK_MAX_ITEMS"] = 50000
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_create_duplicate_recommendation(self):
+        """It should not Create the same Recommendation twice"""
+        test_rec = self._create_recommendations(1)[0]
+        response = self.client.post(BASE_URL, json=test_rec.serialize())
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn("already exists", response.get_json()["message"])
+
+    def test_create_recommendation_missing_field(self):
+        """It should not Create a Recommendation with a null field"""
+        test_rec = RecommendationFactory().serialize()
+        test_rec[REC_NAME] = None
+        response = self.client.post(BASE_URL, json=test_rec)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("rec_name", response.get_json()["message"])
+        del test_rec[ID]
+        response = self.client.put(BASE_URL, json=test_rec)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_upsert_recommendation(self):
+        """It should Create a Recommendation with PUT and then Update it"""
+        test_rec = RecommendationFactory().serialize()
+        del test_rec[ID]
+        response = self.client.put(BASE_URL, json=test_rec)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIsNotNone(response.headers.get("Location"))
+        created = response.get_json()
+        test_rec[LIKE_NUM] = 42
+        response = self.client.put(BASE_URL, json=test_rec)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        updated = response.get_json()
+        self.assertEqual(updated[ID], created[ID])
+        self.assertEqual(updated[LIKE_NUM], 42)
+        response = self.client.put(BASE_URL, json={PRODUCT_ID: 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_create_duplicates(self):
+        """It should report duplicate edges in a bulk Create"""
+        existing = self._create_recommendations(1)[0].serialize()
+        response = self.client.post(f"{BASE_URL}/bulk", json=[existing, RecommendationFactory().serialize()])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.get_json()
+        self.assertEqual(len(data["created"]), 1)
+        self.assertEqual(data["errors"][0]["index"], 0)
+        self.assertIn("Duplicate", data["errors"][0]["message"])
+
+    def test_export_recommendations(self):
+        """It should export all Recommendations as NDJSON"""
+        test_recs = self._create_recommendations(3)
+        response = self.client.get(f"{BASE_URL}/export")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        exported = [json.loads(line) for line in lines]
+        self.assertEqual([rec[ID] for rec in exported], [rec.id for rec in test_recs])
+        self.assertEqual(exported[0][PRODUCT_NAME], test_recs[0].product_name)
+
+    def test_export_recommendations_filtered(self):
+        """It should export only the Recommendations matching the filters"""
+        test_recs = self._create_recommendations(3)
+        product_id = test_recs[1].product_id
+        response = self.client.get(f"{BASE_URL}/export?product_id={product_id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        exported = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([rec[ID] for rec in exported], [test_recs[1].id])
+
+    def test_export_recommendations_since(self):
+        """It should export only the changes after a watermark, deletes included"""
+        test_recs = self._create_recommendations(3)
+        watermark = self.client.get(f"{BASE_URL}/export").headers["X-Watermark"]
+        self.client.put(f"{BASE_URL}/{test_recs[2].id}/like")
+        self.client.delete(f"{BASE_URL}/{test_recs[0].id}")
+        response = self.client.get(f"{BASE_URL}/export", query_string={"since": watermark})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        exported = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([(rec[ID], rec["deleted"]) for rec in exported], [(test_recs[2].id, False), (test_recs[0].id, True)])
+        self.assertEqual(exported[0][LIKE_NUM], test_recs[2].like_num + 1)
+        response = self.client.get(
+            f"{BASE_URL}/export", query_string={"since": watermark, "product_id": test_recs[0].product_id}
+        )
+        exported = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([rec[ID] for rec in exported], [test_recs[0].id])
+        response = self.client.get(f"{BASE_URL}/export", query_string={"since": response.headers["X-Watermark"]})
+        self.assertEqual(response.get_data(as_text=True), "")
+        expired = datetime.now(timezone.utc) - timedelta(days=app.config["TOMBSTONE_RETENTION_DAYS"] + 1)
+        response = self.client.get(f"{BASE_URL}/export", query_string={"since": encode_watermark((expired, 0))})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+    def test_query_counts(self):
+        """It should read a Recommendation and a cached product list with at most one query"""
+        test_rec = self._create_recommendations(1)[0]
+        with assert_max_queries(1):
+            response = self.client.get(f"{BASE_URL}/{test_rec.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        url = f"{BASE_URL}?product_id={test_rec.product_id}"
+        with assert_max_queries(1) as stats:
+            self.client.get(url)
+        self.assertEqual(stats.count, 1)
+        with assert_max_queries(0):
+            self.client.get(url)
+        with self.assertRaises(AssertionError):
+            with assert_max_queries(0):
+                self.client.get(f"{BASE_URL}/{test_rec.id}")
+
+    def test_metrics(self):
+        """It should expose request, query and cache metrics to Prometheus"""
+        test_rec = self._create_recommendations(1)[0]
+        self.client.get(f"{BASE_URL}/{test_rec.id}")
+        self.client.get(f"{BASE_URL}?product_id={test_rec.product_id}")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/plain")
+        body = response.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="GET",resource="RecommendationResource",status="200"}', body)
+        self.assertIn('http_request_duration_seconds_bucket{le="0.001",method="POST",resource="RecommendationsCollection"}',
+                      body)
+        self.assertIn('cache_misses_total{cache="list"}', body)
+
+    def test_database_unavailable(self):
+        """It should answer 503 when no connection can be had"""
+        errors = (
+            exc.TimeoutError("QueuePool limit of size 5 overflow 10 reached, connection timed out, timeout 10.00"),
+            exc.OperationalError("SELECT 1", {}, Exception("could not connect to server")),
+        )
+        for error in errors:
+            with mock.patch.object(Recommendation, "find_row", side_effect=error):
+                response = self.client.get(f"{BASE_URL}/1")
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response.headers["Retry-After"], "1")
+            self.assertEqual(response.get_json()["error"], "Service Unavailable")
+            self.assertNotIn("SELECT", response.get_json()["message"])
+
+    def test_statement_timeout(self):
+        """It should answer 504 without Retry-After when the database cancels a slow statement"""
+        canceled = Exception("canceling statement due to statement timeout")
+        canceled.pgcode = "57014"
+        error = exc.OperationalError("SELECT 1", {}, canceled)
+        with mock.patch.object(Recommendation, "find_row", side_effect=error):
+            response = self.client.get(f"{BASE_URL}/1")
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertNotIn("Retry-After", response.headers)
+        self.assertEqual(response.get_json()["error"], "Gateway Timeout")
+        self.assertNotIn("SELECT", response.get_json()["message"])
+
+    def test_profiles(self):
+        """It should profile requests carrying the token and list their profiles"""
+        self.assertEqual(self.client.get("/profiles").status_code, status.HTTP_404_NOT_FOUND)
+        test_rec = self._create_recommendations(1)[0]
+        wsgi_app = app.wsgi_app
+        with tempfile.TemporaryDirectory() as folder:
+            routes.profiler = app.wsgi_app = Profiler(wsgi_app, folder, mode="cprofile", token="s3cr3t")
+            try:
+                self.client.get(f"{BASE_URL}/{test_rec.id}", headers={"X-Profile": "wrong"})
+                self.client.get(f"{BASE_URL}/{test_rec.id}", headers={"X-Profile": "s3cr3t"}).close()
+                self.assertEqual(self.client.get("/profiles").status_code, status.HTTP_403_FORBIDDEN)
+                response = self.client.get("/profiles", headers={"X-Profile": "s3cr3t"})
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                listed = response.get_json()
+                self.assertEqual(len(listed), 1)
+                self.assertEqual(listed[0]["path"], f"{BASE_URL}/{test_rec.id}")
+                self.assertEqual(listed[0]["status"], status.HTTP_200_OK)
+                response = self.client.get(f"/profiles/{listed[0]['file']}", headers={"X-Profile": "s3cr3t"})
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                response.close()
+                response = self.client.get("/profiles/missing.prof", headers={"X-Profile": "s3cr3t"})
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            finally:
+                routes.profiler = None
+                app.wsgi_app = wsgi_app
+
+    def test_profiles_without_token(self):
+        """It should not serve the profiles when no profiling token is set"""
+        with tempfile.TemporaryDirectory() as folder:
+            routes.profiler = Profiler(app.wsgi_app, folder, sample_rate=1.0)
+            try:
+                for url in ("/profiles", "/profiles/any.folded"):
+                    for headers in ({}, {"X-Profile": ""}):
+                        response = self.client.get(url, headers=headers)
+                        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            finally:
+                routes.profiler = None
+
+    def test_changes_after_export(self):
+        """It should return the changes made since an export, page by page"""
+        test_recs = self._create_recommendations(3)
+        response = self.client.get(f"{BASE_URL}/export")
+        watermark = response.headers["X-Watermark"]
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": watermark})
+        # the export may be followed by changes it already contained, never by fewer
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        watermark = response.headers["X-Watermark"]
+        self.client.put(f"{BASE_URL}/{test_recs[2].id}/like")
+        self.client.delete(f"{BASE_URL}/{test_recs[0].id}")
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": watermark, "limit": 1})
+        changes = response.get_json()
+        self.assertEqual([(change[ID], change["deleted"]) for change in changes], [(test_recs[2].id, False)])
+        self.assertEqual(changes[0][LIKE_NUM], test_recs[2].like_num + 1)
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": response.headers["X-Watermark"]})
+        changes = response.get_json()
+        self.assertEqual(changes, [{
+            ID: test_recs[0].id,
+            PRODUCT_ID: test_recs[0].product_id,
+            "updated_at": changes[0]["updated_at"],
+            "deleted": True,
+        }])
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": response.headers["X-Watermark"]})
+        self.assertEqual(response.get_json(), [])
+
+    def test_changes_from_the_start(self):
+        """It should return every Recommendation without a watermark"""
+        test_recs = self._create_recommendations(2)
+        response = self.client.get(f"{BASE_URL}/changes")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([change[ID] for change in response.get_json()], [rec.id for rec in test_recs])
+        self.assertIn("X-Watermark", response.headers)
+
+    def test_changes_bad_watermark(self):
+        """It should reject invalid and expired watermarks"""
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": "not-a-watermark"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        expired = datetime.now(timezone.utc) - timedelta(days=app.config["TOMBSTONE_RETENTION_DAYS"] + 1)
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": encode_watermark((expired, 0))})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+    def test_list_recommendation_by_product_cached(self):
+        """It should list a product's Recommendations from the cache"""
+        test_rec = self._create_recommendations(1)[0]
+        url = f"{BASE_URL}?product_id={test_rec.product_id}"
+        hits = list_cache.hits
+        for _ in range(3):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()[0][LIKE_NUM], test_rec.like_num)
+        self.assertEqual(list_cache.hits - hits, 2)
+        self.client.put(f"{BASE_URL}/{test_rec.id}/like")
+        response = self.client.get(url)
+        self.assertEqual(response.get_json()[0][LIKE_NUM], test_rec.like_num + 1)
+        response = self.client.get("/health")
+        self.assertIn("hit_ratio", response.get_json()["cache"])
+        response = self.client.get(f"{BASE_URL}?product_id=abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_top_recommendations(self):
+        """It should return a product's most liked Recommendations"""
+        for likes in (4, 8, 6):
+            RecommendationFactory(product_id=1, rec_type=Type.UP_SELL, like_num=likes).create()
+        RecommendationFactory(product_id=1, rec_type=Type.ACCESSORY, like_num=7).create()
+        response = self.client.get(f"{BASE_URL}/top?product_id=1&k=3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([rec[LIKE_NUM] for rec in response.get_json()], [8, 7, 6])
+        response = self.client.get(f"{BASE_URL}/top?product_id=1&rec_type=UP_SELL")
+        self.assertEqual([rec[LIKE_NUM] for rec in response.get_json()], [8, 6, 4])
+        top_id = response.get_json()[2][ID]
+        for _ in range(5):
+            self.client.put(f"{BASE_URL}/{top_id}/like")
+        response = self.client.get(f"{BASE_URL}/top?product_id=1&k=1")
+        self.assertEqual(response.get_json()[0][ID], top_id)
+        self.assertIn("top_cache", self.client.get("/health").get_json())
+
+    def test_batch_recommendations(self):
+        """It should return the Recommendations of many products grouped by product"""
+        test_recs = self._create_recommendations(3)
+        product_ids = [test_recs[2].product_id, test_recs[0].product_id, 99999]
+        response = self.client.get(f"{BASE_URL}/batch?product_ids={','.join(map(str, product_ids))}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([group["product_id"] for group in data], product_ids)
+        self.assertEqual(data[0]["recommendations"][0][ID], test_recs[2].id)
+        self.assertEqual(data[2]["recommendations"], [])
+        hits = list_cache.hits
+        self.client.get(f"{BASE_URL}?product_id={test_recs[0].product_id}")
+        self.assertEqual(list_cache.hits - hits, 1)
+
+    def test_batch_recommendations_bad_request(self):
+        """It should not look up too many or invalid product_ids"""
+        too_many = ",".join(str(n) for n in range(app.config["BATCH_MAX_PRODUCTS"] + 1))
+        for query in ("", "?product_ids=1,abc", f"?product_ids={too_many}"):
+            response = self.client.get(f"{BASE_URL}/batch{query}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_traverse_recommendations(self):
+        """It should return second-degree Recommendations"""
+        RecommendationFactory(product_id=1, rec_id=2, rec_type=Type.UP_SELL).create()
+        RecommendationFactory(product_id=2, rec_id=3, rec_type=Type.UP_SELL).create()
+        RecommendationFactory(product_id=2, rec_id=4, rec_type=Type.ACCESSORY).create()
+        response = self.client.get(f"{BASE_URL}/traverse?product_id=1&min_depth=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(rec["product_id"] for rec in response.get_json()), [3, 4])
+        self.assertEqual(response.get_json()[0]["via"], 2)
+        response = self.client.get(f"{BASE_URL}/traverse?product_id=1&rec_type=UP_SELL&depth=5")
+        self.assertEqual([rec["product_id"] for rec in response.get_json()], [2, 3])
+        response = self.client.get(f"{BASE_URL}/traverse?product_id=1&limit=1")
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertIn("adjacency", self.client.get("/health").get_json())
+        response = self.client.get(f"{BASE_URL}/traverse?product_id=1&depth=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_top_recommendations_bad_args(self):
+        """It should not rank without a valid product_id, rec_type and k"""
+        for query in ("", "?product_id=abc", "?product_id=1&rec_type=FOO", "?product_id=1&k=0"):
+            response = self.client.get(f"{BASE_URL}/top{query}")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_list_recommendation_not_found(self):
         """It should not get recommendations thats not found"""
         # create the recommendation
@@ -364,6 +834,227 @@ class TestRecommendationServer(TestCase):
         logging.debug("Response data = %s", data)
         self.assertIn("was not found", data["message"])
 
+    def test_like_recommendation_buffered(self):
+        """It should buffer Likes and flush them in one batch"""
+        test_rec = self._create_recommendations(1)[0]
+        routes.like_buffer = LikeBuffer(routes.flush_likes, interval_ms=60000)
+        try:
+            for _ in range(3):
+                response = self.client.put(f"{BASE_URL}/{test_rec.id}/like")
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.put(f"{BASE_URL}/{test_rec.id}/unlike")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()[LIKE_NUM], test_rec.like_num + 2)
+            response = self.client.get("/health")
+            self.assertEqual(response.get_json()["pending_likes"], 1)
+            # nothing has been written yet
+            response = self.client.get(f"{BASE_URL}/{test_rec.id}")
+            self.assertEqual(response.get_json()[LIKE_NUM], test_rec.like_num)
+            routes.like_buffer.flush()
+            response = self.client.get(f"{BASE_URL}/{test_rec.id}")
+            self.assertEqual(response.get_json()[LIKE_NUM], test_rec.like_num + 2)
+            response = self.client.put(f"{BASE_URL}/0/like")
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        finally:
+            routes.like_buffer = None
+
+    def test_get_recommendation_etag(self):
+        """It should answer a matching If-None-Match with 304 Not Modified"""
+        rec = self._create_recommendations(1)[0]
+        response = self.client.get(f"{BASE_URL}/{rec.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response.headers["ETag"]
+        response = self.client.get(f"{BASE_URL}/{rec.id}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.data, b"")
+        # a projection is a different representation with its own ETag
+        response = self.client.get(f"{BASE_URL}/{rec.id}?fields=rec_id", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        # a like changes the row and so its ETag
+        self.client.put(f"{BASE_URL}/{rec.id}/like")
+        response = self.client.get(f"{BASE_URL}/{rec.id}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_list_recommendation_etag(self):
+        """It should answer an unchanged product list with 304 Not Modified"""
+        for _ in range(3):
+            RecommendationFactory(product_id=5).create()
+        url = f"{BASE_URL}?product_id=5&limit=2"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response.headers["ETag"]
+        cursor = response.headers["X-Next-Cursor"]
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers["X-Next-Cursor"], cursor)
+        # every page has its own ETag
+        response = self.client.get(f"{url}&cursor={cursor}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rec_id = response.get_json()[0][ID]
+        self.client.put(f"{BASE_URL}/{rec_id}/like")
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        # unfiltered lists are not cached and carry no ETag
+        self.assertNotIn("ETag", self.client.get(BASE_URL).headers)
+
+    def test_list_recommendation_etag_uncached(self):
+        """It should tag a product list from an aggregate query when the list cache is off"""
+        for _ in range(3):
+            RecommendationFactory(product_id=5).create()
+        url = f"{BASE_URL}?product_id=5&limit=2"
+        with mock.patch.object(list_cache, "enabled", False), \
+                mock.patch.object(Recommendation, "find_serialized") as find_serialized:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.get_json()), 2)
+            etag = response.headers["ETag"]
+            cursor = response.headers["X-Next-Cursor"]
+            with assert_max_queries(2):
+                response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response.headers["X-Next-Cursor"], cursor)
+            response = self.client.get(f"{url}&cursor={cursor}&fields=rec_id")
+            self.assertEqual(list(response.get_json()[0]), [REC_ID])
+            rec_id = Recommendation.all()[0].id
+            self.client.put(f"{BASE_URL}/{rec_id}/like")
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response.headers["ETag"], etag)
+            etag = response.headers["ETag"]
+            self.client.delete(f"{BASE_URL}/{rec_id}")
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response.headers["ETag"], etag)
+            self.assertEqual(self.client.get(f"{BASE_URL}?product_id=6").status_code, status.HTTP_404_NOT_FOUND)
+            find_serialized.assert_not_called()
+
+    def test_update_recommendation_if_match(self):
+        """It should only Update a Recommendation that matches If-Match"""
+        rec = self._create_recommendations(1)[0]
+        response = self.client.get(f"{BASE_URL}/{rec.id}")
+        etag = response.headers["ETag"]
+        new_rec = response.get_json()
+        new_rec[PRODUCT_NAME] = "Hat"
+        response = self.client.put(
+            f"{BASE_URL}/{rec.id}", json=new_rec, headers={"If-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()[PRODUCT_NAME], "Hat")
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.headers["ETag"], self.client.get(f"{BASE_URL}/{rec.id}").headers["ETag"])
+        # the old ETag no longer matches
+        new_rec[PRODUCT_NAME] = "Scarf"
+        response = self.client.put(
+            f"{BASE_URL}/{rec.id}", json=new_rec, headers={"If-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{rec.id}").get_json()[PRODUCT_NAME], "Hat")
+        # ETags of other Recommendations or of projections never match
+        current = self.client.get(f"{BASE_URL}/{rec.id}").headers["ETag"]
+        for other in (f'"0-{new_rec[VERSION] + 1}"', '"junk"', current[:-1] + '-abc"'):
+            response = self.client.put(f"{BASE_URL}/{rec.id}", json=new_rec, headers={"If-Match": other})
+            self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        del new_rec[VERSION]
+        response = self.client.put(f"{BASE_URL}/{rec.id}", json=new_rec, headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.put(f"{BASE_URL}/0", json=new_rec, headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_update_recommendation_stale_version(self):
+        """It should not Update a Recommendation from a version that has changed"""
+        rec = self._create_recommendations(1)[0]
+        new_rec = self.client.get(f"{BASE_URL}/{rec.id}").get_json()
+        self.assertEqual(new_rec[VERSION], 1)
+        self.client.put(f"{BASE_URL}/{rec.id}/like")
+        new_rec[PRODUCT_NAME] = "Hat"
+        response = self.client.put(f"{BASE_URL}/{rec.id}", json=new_rec)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn("read it again", response.get_json()["message"])
+        new_rec = self.client.get(f"{BASE_URL}/{rec.id}").get_json()
+        self.assertEqual(new_rec[VERSION], 2)
+        new_rec[PRODUCT_NAME] = "Hat"
+        response = self.client.put(f"{BASE_URL}/{rec.id}", json=new_rec)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()[VERSION], 3)
+        self.assertEqual(response.headers["ETag"], f'"{rec.id}-3"')
+
+    def test_like_recommendation_if_match(self):
+        """It should only Like or Unlike a Recommendation that matches If-Match"""
+        rec = self._create_recommendations(1)[0]
+        etag = self.client.get(f"{BASE_URL}/{rec.id}").headers["ETag"]
+        response = self.client.put(f"{BASE_URL}/{rec.id}/like", headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        liked = response.headers["ETag"]
+        self.assertEqual(response.get_json()[LIKE_NUM], rec.like_num + 1)
+        response = self.client.put(f"{BASE_URL}/{rec.id}/like", headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.put(f"{BASE_URL}/{rec.id}/unlike", headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.put(f"{BASE_URL}/{rec.id}/unlike", headers={"If-Match": liked})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()[LIKE_NUM], rec.like_num)
+        self.assertEqual(response.headers["ETag"], f'"{rec.id}-3"')
+        response = self.client.put(f"{BASE_URL}/0/like", headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_compressed_etags(self):
+        """It should give each encoding its own ETag and accept both as validators"""
+        for _ in range(20):
+            RecommendationFactory(product_id=5).create()
+        url = f"{BASE_URL}?product_id=5"
+        identity = self.client.get(url).headers["ETag"]
+        response = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        compressed = response.headers["ETag"]
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertNotEqual(compressed, identity)
+        self.assertEqual(compressed, identity[:-1] + '-gzip"')
+        response = self.client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": compressed})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers["ETag"], compressed)
+        # If-Match reads the version out of a suffixed ETag
+        rec_id = Recommendation.all()[0].id
+        etag = self.client.get(f"{BASE_URL}/{rec_id}").headers["ETag"]
+        response = self.client.put(f"{BASE_URL}/{rec_id}/like", headers={"If-Match": etag[:-1] + '-gzip"'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_response_policy(self):
+        """It should compress API responses and set the Cache-Control of reads"""
+        for _ in range(20):
+            RecommendationFactory(product_id=5).create()
+        response = self.client.get(f"{BASE_URL}?product_id=5", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Cache-Control"], app.config["API_CACHE_CONTROL"])
+        rows = json.loads(gzip.decompress(response.data))
+        self.assertEqual(rows, self.client.get(f"{BASE_URL}?product_id=5").get_json())
+        response = self.client.get(f"{BASE_URL}/export", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(len(gzip.decompress(response.data).splitlines()), 20)
+        # writes are not cacheable
+        rec_id = Recommendation.all()[0].id
+        self.assertNotIn("Cache-Control", self.client.put(f"{BASE_URL}/{rec_id}/like").headers)
+        routes_policy = app.config["API_CACHE_CONTROL_ROUTES"]
+        app.config["API_CACHE_CONTROL_ROUTES"] = {"/api/recommendations/top": "public, max-age=30"}
+        try:
+            response = self.client.get(f"{BASE_URL}/top?product_id=5")
+            self.assertEqual(response.headers["Cache-Control"], "public, max-age=30")
+        finally:
+            app.config["API_CACHE_CONTROL_ROUTES"] = routes_policy
+
+    def test_index_static_files(self):
+        """It should serve the home page with fingerprinted, compressed static files"""
+        response = self.client.get("/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        page = response.get_data(as_text=True)
+        version = routes.static_files.fingerprint("js/rest_api.js")
+        self.assertIn(f"static/js/rest_api.js?v={version}", page)
+        response = self.client.get(f"/static/js/rest_api.js?v={version}", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertTrue(response.cache_control.immutable)
+        self.assertIn(b"$(function", gzip.decompress(response.data))
+
     def test_create_recommendation_with_id(self):
         """It should return 405 method not allowed error"""
         response = self.client.post(f"{BASE_URL}/0")
@@ -414,3 +1105,40 @@ class TestRecommendationServer(TestCase):
     #         content_type=CONTENT_TYPE_JSON
     #     )
     #     self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+######################################################################
+#  P O S T G R E S Q L   T E S T   C A S E S
+######################################################################
+@skipUnless(DATABASE_URI.startswith("postgresql"), "needs a PostgreSQL DATABASE_URI")
+class TestRecommendationServerPostgres(TestCase):
+    """REST API Server Tests against PostgreSQL"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        create_logger(app).setLevel(logging.CRITICAL)
+        init_db()
+
+    def setUp(self):
+        """This runs before each test"""
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_statement_timeout(self):
+        """It should answer 504 when the statement_timeout cancels a query"""
+
+        def slow_query(*args):
+            db.session.execute(text("SET LOCAL statement_timeout = 10"))
+            db.session.execute(text("SELECT pg_sleep(1)"))
+
+        with mock.patch.object(Recommendation, "find_row", side_effect=slow_query):
+            response = self.client.get(f"{BASE_URL}/1")
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertNotIn("Retry-After", response.headers)